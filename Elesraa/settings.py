@@ -149,8 +149,44 @@ PRINTER_SETTINGS = {
     # printer, in mm. Adjust to match the roll you actually load — measure the
     # paper width if invoices print cut off or with a big blank margin.
     'INVOICE_PAPER_WIDTH': int(os.getenv('INVOICE_PAPER_WIDTH', '48')),
+    # How labels are printed: 'image' (the default) is the full-label image
+    # printed through the Windows GDI driver; 'tspl' queues native TSPL
+    # commands (printer-drawn barcode and text, see pharmacy/labels.py) and
+    # batches a received purchase's labels into one job.
+    'LABEL_MODE': os.getenv('LABEL_MODE', 'image'),
 }
 
+# Thermal print queue (see pharmacy/print_spooler.py). Checkout and reprints
+# only enqueue a job; a background worker renders and sends it.
+# TRANSPORT: 'win32' (raw job to PRINTER_PATH via the Windows spooler),
+# 'file' (write each job as a .prn into FILE_DIR, handy on Linux/for tests),
+# 'tcp' (raw socket to a network printer, TCP_HOST:TCP_PORT), or a dotted
+# path to a transport class.
+# WORKER: 'thread' starts the worker inside the web process; set 'none' when
+# running `python manage.py print_spooler` as a separate process instead.
+PRINT_SPOOLER = {
+    'TRANSPORT': os.getenv('PRINT_TRANSPORT', 'win32' if os.name == 'nt' else 'file'),
+    'FILE_DIR': os.getenv('PRINT_FILE_DIR', os.path.join(BASE_DIR, 'media', 'print_spool')),
+    'TCP_HOST': os.getenv('PRINT_TCP_HOST', '127.0.0.1'),
+    'TCP_PORT': int(os.getenv('PRINT_TCP_PORT', '9100')),
+    'WORKER': os.getenv('PRINT_SPOOLER_WORKER', 'thread'),
+    'POLL_SECONDS': float(os.getenv('PRINT_SPOOLER_POLL', '2')),
+    'MAX_ATTEMPTS': int(os.getenv('PRINT_MAX_ATTEMPTS', '5')),
+    'RETRY_BASE_SECONDS': float(os.getenv('PRINT_RETRY_BASE', '2')),
+    'RETRY_MAX_SECONDS': float(os.getenv('PRINT_RETRY_MAX', '60')),
+    # Identical reprints within this window reuse the earlier job
+    'DEDUPE_SECONDS': int(os.getenv('PRINT_DEDUPE_SECONDS', '30')),
+}
+
+# Process-wide barcode -> product cache used by every scan view (see
+# pharmacy/barcode_lookup.py). Entries are invalidated on Medicine/StockEntry
+# changes; the TTL only bounds staleness across separate server processes.
+BARCODE_CACHE_SIZE = int(os.getenv('BARCODE_CACHE_SIZE', '2048'))
+BARCODE_CACHE_TTL = int(os.getenv('BARCODE_CACHE_TTL', '60'))
+# Rendered barcode PNGs kept in memory by pharmacy/barcodes.py (they are
+# also stored under MEDIA_ROOT/barcodes/ean13/)
+BARCODE_IMAGE_CACHE_SIZE = int(os.getenv('BARCODE_IMAGE_CACHE_SIZE', '256'))
+
 # Static files settings
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
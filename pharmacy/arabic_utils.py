@@ -25,3 +25,17 @@ def normalize_text(text):
     text = text.replace('ئ', 'ي')  # ئ -> ي
     text = _WHITESPACE.sub(' ', text).strip()
     return text.lower()
+
+
+try:
+    import arabic_reshaper
+    from bidi.algorithm import get_display
+
+    def shape_arabic(text):
+        """Reshape and reorder Arabic text for drawing with Pillow (which
+        does no shaping or bidi of its own)."""
+        reshaped = arabic_reshaper.reshape(text)
+        return get_display(reshaped)
+except ImportError:
+    def shape_arabic(text):
+        return text
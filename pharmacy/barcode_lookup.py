@@ -0,0 +1,126 @@
+"""
+Process-wide barcode -> product lookup cache.
+
+Every scan at the till resolves a barcode several times (get_expiration_dates,
+pos_add_to_cart, the stock pages, label printing). lookup_barcode() answers
+those from an in-memory LRU of immutable ProductSnapshot tuples instead of
+hitting Medicine.objects.get(barcode_number=...) each time.
+
+Entries are dropped by the post_save/post_delete receivers in
+pharmacy.signals whenever a Medicine or one of its StockEntry rows changes,
+and by the bulk stock writers that bypass signals. The cache is per process,
+so BARCODE_CACHE_TTL also bounds how stale a snapshot can get when several
+server processes share the database.
+"""
+from collections import OrderedDict, namedtuple
+import threading
+import time
+
+from django.conf import settings
+
+from .models import Medicine
+
+
+SNAPSHOT_FIELDS = (
+    'id', 'name', 'barcode_number', 'price', 'purchase_price',
+    'strips_per_box', 'can_sell_strips', 'strip_price', 'stock', 'is_active',
+)
+
+
+class ProductSnapshot(namedtuple('ProductSnapshot', SNAPSHOT_FIELDS)):
+    """Read-only view of the Medicine fields the POS and label pages need.
+    Attribute names match Medicine so templates can use either."""
+    __slots__ = ()
+
+    @property
+    def pk(self):
+        return self.id
+
+    def get_strip_price(self):
+        if self.strip_price:
+            return self.strip_price
+        return self.price / self.strips_per_box if self.strips_per_box > 0 else self.price
+
+    @classmethod
+    def from_medicine(cls, medicine):
+        return cls(*(getattr(medicine, field) for field in SNAPSHOT_FIELDS))
+
+
+class BarcodeLookup:
+    """Thread-safe LRU of ProductSnapshot keyed by barcode number."""
+
+    def __init__(self, maxsize=2048, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # barcode -> (snapshot, loaded_at)
+        self._barcode_by_id = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, barcode):
+        """Return the ProductSnapshot for barcode, or None if no medicine has it."""
+        if not barcode:
+            return None
+        barcode = str(barcode).strip()
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(barcode)
+            if cached is not None and now - cached[1] < self.ttl:
+                self._entries.move_to_end(barcode)
+                self.hits += 1
+                return cached[0]
+            self.misses += 1
+
+        medicine = Medicine.objects.filter(barcode_number=barcode).only(*SNAPSHOT_FIELDS).first()
+        if medicine is None:
+            return None
+        snapshot = ProductSnapshot.from_medicine(medicine)
+        with self._lock:
+            self._entries[barcode] = (snapshot, now)
+            self._entries.move_to_end(barcode)
+            self._barcode_by_id[snapshot.id] = barcode
+            while len(self._entries) > self.maxsize:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._barcode_by_id.pop(evicted.id, None)
+        return snapshot
+
+    def invalidate(self, medicine_ids):
+        with self._lock:
+            for medicine_id in medicine_ids:
+                barcode = self._barcode_by_id.pop(medicine_id, None)
+                if barcode is not None and self._entries.pop(barcode, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._barcode_by_id.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+            }
+
+
+barcode_lookup = BarcodeLookup(
+    maxsize=getattr(settings, 'BARCODE_CACHE_SIZE', 2048),
+    ttl=getattr(settings, 'BARCODE_CACHE_TTL', 60),
+)
+
+
+def lookup_barcode(barcode):
+    return barcode_lookup.get(barcode)
+
+
+def invalidate_medicines(medicine_ids):
+    barcode_lookup.invalidate(medicine_ids)
@@ -0,0 +1,131 @@
+"""
+Barcode numbers and barcode images.
+
+Medicine.save() used to draw an EAN-13 image into media/barcodes/ on every
+new medicine, and to pick a number for medicines without one by trying
+random numbers with an exists() query per attempt. Images are now drawn
+when first asked for: barcode_png() renders a medicine's number once, keeps
+the PNG in a small in-process LRU and in the media storage
+(barcodes/ean13/<code>.png), and the barcode_image view serves it with an
+ETag and long-lived cache headers. Only numbers of existing medicines are
+drawn, and each is keyed on its full code (check digit recomputed), so
+12- and 13-digit spellings of a number share one image, and so one ETag.
+
+new_barcode_numbers() hands out unused numbers, checking a whole batch of
+random candidates with one query.
+"""
+from collections import OrderedDict
+from io import BytesIO
+import random
+import threading
+
+import barcode
+from barcode.writer import ImageWriter
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from .models import Medicine
+
+NUMBER_LENGTH = 12
+# Candidates checked per query
+CANDIDATE_BATCH = 400
+# Bump when the rendering changes, so clients and the disk cache refetch
+RENDER_VERSION = 1
+
+
+def new_barcode_numbers(count):
+    """count distinct 12-digit numbers not used by any medicine."""
+    numbers = set()
+    while len(numbers) < count:
+        wanted = min(count - len(numbers), CANDIDATE_BATCH)
+        candidates = {f'{random.randrange(10 ** NUMBER_LENGTH):0{NUMBER_LENGTH}d}' for _ in range(wanted)}
+        candidates -= numbers
+        candidates -= set(
+            Medicine.objects.filter(barcode_number__in=candidates).values_list('barcode_number', flat=True)
+        )
+        numbers |= candidates
+    return list(numbers)[:count]
+
+
+def new_barcode_number():
+    return new_barcode_numbers(1)[0]
+
+
+def full_code(number):
+    """The 13-digit EAN-13 code, check digit recomputed, of a 12 (or 13)
+    digit number; ValueError if it is not one."""
+    if not number.isdigit() or len(number) not in (12, 13):
+        raise ValueError(f'Not an EAN-13 number: {number!r}')
+    return barcode.get_barcode_class('ean13')(number).get_fullcode()
+
+
+def image_name(code):
+    return f'barcodes/ean13/{code}.png'
+
+
+def image_etag(number):
+    """ETag of a number's image, or None if it is not an EAN-13 number."""
+    try:
+        code = full_code(number)
+    except ValueError:
+        return None
+    return f'"ean13-{code}-v{RENDER_VERSION}"'
+
+
+def is_medicine_barcode(number, code):
+    return Medicine.objects.filter(barcode_number__in={number, number[:NUMBER_LENGTH], code}).exists()
+
+
+def render_png(code):
+    """PNG bytes of the EAN-13 barcode of a full code."""
+    buffer = BytesIO()
+    barcode.get_barcode_class('ean13')(code, writer=ImageWriter()).write(buffer)
+    return buffer.getvalue()
+
+
+class BarcodeImages:
+    """LRU of rendered PNGs in front of the media storage."""
+
+    def __init__(self, maxsize=256, storage=default_storage):
+        self.maxsize = maxsize
+        self.storage = storage
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, number):
+        """PNG of a medicine's barcode number; ValueError if it is not an
+        EAN-13 number or no medicine has it."""
+        code = full_code(number)
+        with self._lock:
+            png = self._images.get(code)
+            if png is not None:
+                self._images.move_to_end(code)
+                return png
+        # Nothing is drawn or stored for numbers off arbitrary URLs
+        if not is_medicine_barcode(number, code):
+            raise ValueError(f'No medicine has barcode {number!r}')
+        name = image_name(code)
+        if self.storage.exists(name):
+            with self.storage.open(name, 'rb') as stored:
+                png = stored.read()
+        else:
+            png = render_png(code)
+            self.storage.save(name, ContentFile(png))
+        with self._lock:
+            self._images[code] = png
+            self._images.move_to_end(code)
+            while len(self._images) > self.maxsize:
+                self._images.popitem(last=False)
+        return png
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+
+
+barcode_images = BarcodeImages(maxsize=getattr(settings, 'BARCODE_IMAGE_CACHE_SIZE', 256))
+
+
+def barcode_png(number):
+    return barcode_images.get(number)
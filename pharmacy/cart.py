@@ -0,0 +1,228 @@
+"""
+POS cart helpers shared by the POS views and the JSON scan endpoint.
+
+The cart is a Cart row per cashier with one CartLine per scanned line
+(pharmacy.models). Adding, removing and re-pricing only write the lines they
+affect, prices are stored as Decimal, and the whole cart is read back with
+its medicines in one query (cart_lines) for display and checkout.
+"""
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db.models import Count, DecimalField, F, Sum
+
+from .models import Cart, CartLine
+from .stock_allocation import LotBook, lot_units, parse_cart_date
+
+
+CENT = Decimal('0.01')
+
+
+def unit_prices(medicine, unit_type, customer=None):
+    """Return (original_price, discounted_price) for one unit.
+
+    FAMILY customers pay cost + 10%; other customers get their discount
+    percentage but never below cost + 10%.
+    """
+    original_price = medicine.get_strip_price() if unit_type == 'STRIP' else medicine.price
+
+    # Calculate minimum profitable price (cost + 10%)
+    min_profitable_price = medicine.purchase_price * Decimal('1.10')
+    if unit_type == 'STRIP':
+        min_profitable_price = min_profitable_price / medicine.strips_per_box
+
+    if customer is None:
+        return original_price, original_price
+    if customer.customer_type == 'FAMILY':
+        return original_price, min_profitable_price
+    discount = customer.discount_percentage / 100
+    discounted_price = original_price * (1 - discount)
+    if discounted_price < min_profitable_price:
+        discounted_price = min_profitable_price
+    return original_price, discounted_price
+
+
+def lot_summary(book, medicine_id):
+    """Box/strip counts per sellable lot, earliest expiry first (lots the
+    book has used up are left out)."""
+    return [
+        {
+            'expiration_date': entry.expiration_date.strftime('%Y-%m-%d'),
+            'boxes': lot_units(entry, 'BOX'),
+            'strips': lot_units(entry, 'STRIP'),
+        }
+        for entry in book.lots(medicine_id)
+        if lot_units(entry, 'STRIP') > 0
+    ]
+
+
+def get_cart(request):
+    """The cashier's open cart, created on first use.
+
+    Carts from before the cart tables existed lived in
+    request.session['cart']; such a cart is moved into CartLine rows once.
+    """
+    cart, _ = Cart.objects.get_or_create(user=request.user)
+    legacy = request.session.pop('cart', None)
+    if legacy:
+        CartLine.objects.bulk_create([
+            CartLine(
+                cart=cart,
+                medicine_id=item['medicine_id'],
+                quantity=item['quantity'],
+                unit_type=item.get('unit_type', 'BOX'),
+                expiration_date=parse_cart_date(item['expiration_date']) if item.get('expiration_date') else None,
+                original_price=Decimal(str(item['original_price'])).quantize(CENT),
+                discounted_price=Decimal(str(item['discounted_price'])).quantize(CENT),
+            )
+            for item in legacy
+        ])
+    return cart
+
+
+def cart_lines(cart):
+    """Every line of the cart with its Medicine, in scan order (one query)."""
+    return list(cart.lines.select_related('medicine'))
+
+
+def reserve_cart_lines(book, lines, medicine):
+    """Take the cart's lines for medicine out of book; ValidationError when
+    stock has dropped below what they hold."""
+    for line in lines:
+        if line.medicine_id != medicine.id:
+            continue
+        book.take(medicine.id, line.unit_type, line.quantity, preferred_expiry=line.expiration_date,
+                  name=medicine.name)
+
+
+def lots_left(book, cart, medicine):
+    """lot_summary() of what the cart's lines for medicine leave of book's
+    lots; [] when they already take more than there is."""
+    try:
+        reserve_cart_lines(book, cart.lines.filter(medicine_id=medicine.id), medicine)
+    except ValidationError:
+        return []
+    return lot_summary(book, medicine.id)
+
+
+def reserve_line(book, lines, medicine, unit_type, quantity, expiration_date=None):
+    """Check that quantity can still be sold once the lines already in the
+    cart for this medicine are accounted for. Nothing is written; raises
+    ValidationError when stock is short, including when stock has dropped
+    below what the cart already holds."""
+    reserve_cart_lines(book, lines, medicine)
+    book.take(medicine.id, unit_type, quantity, preferred_expiry=expiration_date, name=medicine.name)
+
+
+def price_line(line, medicine, customer=None):
+    """Set the line's Decimal prices for customer; True if they changed."""
+    original_price, discounted_price = unit_prices(medicine, line.unit_type, customer)
+    original_price = Decimal(original_price).quantize(CENT)
+    discounted_price = Decimal(discounted_price).quantize(CENT)
+    if (line.original_price, line.discounted_price) == (original_price, discounted_price):
+        return False
+    line.original_price = original_price
+    line.discounted_price = discounted_price
+    return True
+
+
+def add_to_cart(cart, medicine, quantity, unit_type='BOX', expiration_date=None, customer=None, book=None):
+    """Validate and insert one CartLine; returns the line.
+
+    medicine may be a Medicine or a barcode ProductSnapshot. Raises
+    ValidationError with a cashier-facing message on failure.
+    """
+    if quantity <= 0:
+        raise ValidationError('Invalid quantity')
+    if unit_type == 'STRIP' and not medicine.can_sell_strips:
+        raise ValidationError(f'Cannot sell {medicine.name} by strip')
+    if expiration_date:
+        try:
+            expiration_date = parse_cart_date(expiration_date)
+        except ValueError:
+            raise ValidationError('Invalid expiration date format')
+    else:
+        expiration_date = None
+
+    book = book or LotBook.load([medicine.id])
+    try:
+        reserve_line(book, cart.lines.filter(medicine_id=medicine.id), medicine,
+                     unit_type, quantity, expiration_date)
+    except ValidationError as e:
+        # Shortages keep the cashier's familiar wording; anything else keeps
+        # its own message
+        if 'Not enough stock' not in e.messages[0]:
+            raise
+        raise ValidationError('Insufficient stock')
+
+    line = CartLine(
+        cart=cart,
+        medicine_id=medicine.id,
+        quantity=quantity,
+        unit_type=unit_type,
+        expiration_date=expiration_date,
+    )
+    price_line(line, medicine, customer)
+    line.save()
+    return line
+
+
+def remove_line(cart, line_id):
+    """Delete one line of the cart; False if it is not in this cart."""
+    deleted, _ = cart.lines.filter(id=line_id).delete()
+    return bool(deleted)
+
+
+def reprice_cart(cart, customer=None):
+    """Switch the cart to customer and re-price its lines, writing only the
+    lines whose prices actually change."""
+    if cart.customer_id != (customer.id if customer else None):
+        cart.customer = customer
+        cart.save(update_fields=['customer', 'updated_at'])
+    changed = [line for line in cart_lines(cart) if price_line(line, line.medicine, customer)]
+    if changed:
+        CartLine.objects.bulk_update(changed, ['original_price', 'discounted_price'])
+    return changed
+
+
+def clear_cart(cart):
+    cart.lines.all().delete()
+    if cart.customer_id:
+        cart.customer = None
+        cart.save(update_fields=['customer', 'updated_at'])
+
+
+def line_data(line, name):
+    """JSON-friendly view of a CartLine for the POS page."""
+    return {
+        'id': line.id,
+        'medicine_id': line.medicine_id,
+        'name': name,
+        'quantity': line.quantity,
+        'unit_type': line.unit_type,
+        'expiration_date': line.expiration_date.strftime('%Y-%m-%d') if line.expiration_date else None,
+        'original_price': float(line.original_price),
+        'discounted_price': float(line.discounted_price),
+        'total': float(line.total),
+    }
+
+
+def cart_totals(lines):
+    """(original_total, cart_total) as shown on the POS page."""
+    original_total = sum((line.original_price * line.quantity for line in lines), Decimal('0'))
+    cart_total = sum((line.total for line in lines), Decimal('0'))
+    return original_total, cart_total
+
+
+def cart_summary(cart):
+    """Line count and totals computed in the database (one aggregate)."""
+    totals = cart.lines.aggregate(
+        count=Count('id'),
+        original_total=Sum(F('original_price') * F('quantity'), output_field=DecimalField()),
+        cart_total=Sum(F('discounted_price') * F('quantity'), output_field=DecimalField()),
+    )
+    return {
+        'count': totals['count'] or 0,
+        'original_total': float(totals['original_total'] or 0),
+        'cart_total': float(totals['cart_total'] or 0),
+    }
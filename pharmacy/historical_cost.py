@@ -0,0 +1,127 @@
+"""
+Sale lines costed at the purchase price of their day.
+
+The reports dashboard and the sales_summary_historical,
+sales_profit_by_medicine and price_anomalies commands each ran, for every
+new (medicine, day) among the sale lines,
+
+    PurchaseItem.objects.filter(medicine=..., purchase__date__date__lte=day)
+                        .order_by('-purchase__date').first()
+
+so a year of sales cost tens of thousands of queries. CostHistory reads
+every purchase price once, in one query sorted by medicine and date, and
+answers "what did we last pay for this medicine on or before that day" with
+a bisect over the medicine's purchase days. sale_lines() streams the sale
+lines from one more query and costs each one that way (an as-of join done
+in Python): two queries for any number of sales.
+
+Days are local dates on both sides (the old lookups compared the sale's
+UTC date with the purchases' local dates). A medicine never purchased
+before the sale is costed at its current purchase_price, as the reports
+always did.
+"""
+from bisect import bisect_right
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import PurchaseItem, SaleItem
+
+FAMILY_MARGIN = Decimal('1.10')
+
+LINE_FIELDS = (
+    'sale_id', 'sale__created_at', 'medicine_id', 'medicine__name', 'unit_type', 'quantity', 'price',
+    'medicine__strips_per_box', 'medicine__purchase_price',
+    'sale__customer__customer_type', 'sale__customer__discount_percentage',
+)
+
+
+class CostHistory:
+    """Every medicine's purchase prices by purchase day, read once."""
+
+    def __init__(self, until=None):
+        self._days = defaultdict(list)
+        self._prices = defaultdict(list)
+        purchases = PurchaseItem.objects.all()
+        if until is not None:
+            purchases = purchases.filter(purchase__date__date__lte=until)
+        rows = (
+            purchases.annotate(day=TruncDate('purchase__date'))
+            .order_by('medicine_id', 'purchase__date', 'id')
+            .values_list('medicine_id', 'day', 'price')
+        )
+        for medicine_id, day, price in rows.iterator(chunk_size=5000):
+            self._days[medicine_id].append(day)
+            self._prices[medicine_id].append(price)
+
+    def price_on(self, medicine_id, day):
+        """Price of the medicine's last purchase on or before day, or None."""
+        days = self._days.get(medicine_id)
+        if not days:
+            return None
+        position = bisect_right(days, day)
+        return self._prices[medicine_id][position - 1] if position else None
+
+
+class CostedLine(namedtuple('CostedLine', (
+        'sale_id sale_created_at medicine_id medicine_name unit_type quantity price subtotal '
+        'strips_per_box purchase_price hist_price unit_cost'))):
+    """One sale line with its historical cost; unit_cost is per unit sold
+    (strip or box), hist_price per box."""
+    __slots__ = ()
+
+    @property
+    def unit_profit(self):
+        return self.price - self.unit_cost
+
+    @property
+    def profit(self):
+        return self.unit_profit * self.quantity
+
+    @property
+    def current_profit(self):
+        """SaleItem.profit: the line costed at today's purchase price."""
+        cost = self.purchase_price
+        if self.unit_type == 'STRIP':
+            cost = cost / (self.strips_per_box or 1)
+        return (self.price - cost) * self.quantity
+
+
+def costed_line(history, sale_id, created_at, medicine_id, name, unit_type, quantity, price,
+                strips_per_box, purchase_price, customer_type, discount_percentage):
+    """CostedLine from the LINE_FIELDS of one SaleItem."""
+    price = Decimal(price or 0)
+    purchase_price = Decimal(purchase_price or 0)
+    quantity = quantity or 0
+    # SaleItem.subtotal (discounted_price * quantity), without the instance
+    if customer_type == 'FAMILY':
+        subtotal = purchase_price * FAMILY_MARGIN * quantity
+    elif customer_type is not None:
+        subtotal = price * (1 - Decimal(discount_percentage or 0) / 100) * quantity
+    else:
+        subtotal = price * quantity
+
+    hist_price = history.price_on(medicine_id, timezone.localtime(created_at).date())
+    hist_price = purchase_price if hist_price is None else Decimal(hist_price)
+    unit_cost = hist_price / (strips_per_box or 1) if unit_type == 'STRIP' else hist_price
+    return CostedLine(
+        sale_id, created_at, medicine_id, name, unit_type, quantity, price, subtotal,
+        strips_per_box, purchase_price, hist_price, unit_cost,
+    )
+
+
+def sale_lines(start=None, end=None, history=None, chunk_size=2000):
+    """Yield a CostedLine for every line of the completed sales made from
+    start to end (local dates, both optional), oldest first."""
+    items = SaleItem.objects.filter(sale__is_completed=True)
+    if start is not None:
+        items = items.filter(sale__created_at__date__gte=start)
+    if end is not None:
+        items = items.filter(sale__created_at__date__lte=end)
+    if history is None:
+        history = CostHistory(until=end)
+    rows = items.order_by('sale__created_at', 'id').values_list(*LINE_FIELDS)
+    for values in rows.iterator(chunk_size=chunk_size):
+        yield costed_line(history, *values)
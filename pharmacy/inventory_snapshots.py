@@ -0,0 +1,211 @@
+"""
+Daily inventory snapshots: what the sellable stock was worth each day.
+
+Inventory value over time used to mean running current_inventory_value by
+hand and keeping the CSVs. take_snapshot() (nightly: `python manage.py
+inventory_snapshot`) stores the day's valuation (pharmacy.inventory_valuation)
+as one InventorySnapshot with its totals plus one InventorySnapshotLine per
+medicine in stock, the lines written in one bulk INSERT. The history pages
+read these rows and never re-derive stock.
+
+Days before the job ran are rebuilt by backfill_snapshots() from the stock
+history, in one pass per direction:
+
+* from the first StockCheckpoint on, by replaying the stock ledger
+  (pharmacy.stock_ledger) forwards, day by day;
+* before it, by walking back from that checkpoint and undoing each day's
+  sales and received purchases. Stock added or edited by hand before the
+  ledger existed left no history, so it is taken as already there.
+
+Backfilled days are priced at today's prices and marked backfilled.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .inventory_valuation import InventoryTotals, medicine_values, valued_medicines, value_holdings
+from .models import (
+    InventorySnapshot, InventorySnapshotLine, Medicine, PurchaseItem, SaleItem, StockCheckpoint,
+    StockMovement,
+)
+from .stock_ledger import take_checkpoint
+
+
+def day_end(day):
+    """The moment day ends (the next day starts), in the local time zone."""
+    return timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+
+
+def write_snapshot(day, rows, backfilled=False):
+    """Store ValuedMedicine rows as the snapshot for day (replacing any)."""
+    totals = InventoryTotals()
+    lines = []
+    for row in rows:
+        if not row.in_stock:
+            continue
+        totals.add(row)
+        lines.append(InventorySnapshotLine(
+            medicine_id=row.id, boxes=row.boxes, strips=row.strips,
+            cost_value=round(row.cost, 2), selling_value=round(row.selling, 2),
+        ))
+    with transaction.atomic():
+        InventorySnapshot.objects.filter(date=day).delete()
+        snapshot = InventorySnapshot.objects.create(
+            date=day, medicines_in_stock=totals.count,
+            boxes=sum(line.boxes for line in lines), strips=sum(line.strips for line in lines),
+            cost_value=round(totals.cost, 2), selling_value=round(totals.selling, 2),
+            backfilled=backfilled,
+        )
+        for line in lines:
+            line.snapshot = snapshot
+        InventorySnapshotLine.objects.bulk_create(lines)
+    return snapshot
+
+
+def take_snapshot(day=None):
+    """Snapshot of the stock right now (from the stock counters) for day
+    (default today)."""
+    return write_snapshot(day or timezone.localdate(), valued_medicines(in_stock_only=True))
+
+
+def sellable(lots, day):
+    """{medicine_id: (boxes, strips)} over lots still good on day."""
+    totals = defaultdict(lambda: [0, 0])
+    for (medicine_id, expiry), (boxes, strips) in lots.items():
+        if expiry >= day and (boxes > 0 or strips > 0):
+            total = totals[medicine_id]
+            total[0] += max(boxes, 0)
+            total[1] += max(strips, 0)
+    return {medicine_id: tuple(total) for medicine_id, total in totals.items()}
+
+
+def _checkpoint_lots(checkpoint):
+    lots = defaultdict(lambda: [0, 0])
+    for medicine_id, expiry, boxes, strips in checkpoint.lines.values_list(
+            'medicine_id', 'expiration_date', 'boxes', 'strips'):
+        lots[medicine_id, expiry] = [boxes, strips]
+    return lots
+
+
+def holdings_forward(checkpoint, start, end):
+    """Yield (day, sellable holdings at the end of day) for the days from
+    the checkpoint's day (or start, if later) to end, replaying the ledger."""
+    lots = _checkpoint_lots(checkpoint)
+    day = timezone.localtime(checkpoint.taken_at).date()
+    movements = (
+        StockMovement.objects.filter(created_at__gt=checkpoint.taken_at, created_at__lt=day_end(end))
+        .annotate(day=TruncDate('created_at'))
+        .values('day', 'medicine_id', 'expiration_date')
+        .annotate(boxes=Sum('boxes'), strips=Sum('strips'))
+        .order_by('day')
+        .values_list('day', 'medicine_id', 'expiration_date', 'boxes', 'strips')
+    )
+    movements = iter(movements.iterator(chunk_size=2000))
+    pending = next(movements, None)
+    while day <= end:
+        while pending is not None and pending[0] <= day:
+            _, medicine_id, expiry, boxes, strips = pending
+            lot = lots[medicine_id, expiry]
+            lot[0] += boxes
+            lot[1] += strips
+            pending = next(movements, None)
+        if day >= start:
+            yield day, sellable(lots, day)
+        day += timedelta(days=1)
+
+
+def holdings_backward(checkpoint, start, end):
+    """Yield (day, sellable holdings at the end of day) for the days before
+    the checkpoint's day, latest first, undoing completed sales and received
+    purchases."""
+    lots = _checkpoint_lots(checkpoint)
+    checkpoint_day = timezone.localtime(checkpoint.taken_at).date()
+    window = dict(gte=day_end(start), lte=checkpoint.taken_at)
+    strips_per_box = dict(Medicine.objects.values_list('id', 'strips_per_box'))
+
+    events = defaultdict(list)
+    sold = (
+        SaleItem.objects.filter(sale__is_completed=True, sale__created_at__gte=window['gte'],
+                                sale__created_at__lte=window['lte'])
+        .annotate(day=TruncDate('sale__created_at'))
+        .values('day', 'medicine_id', 'expiry_date', 'unit_type')
+        .annotate(quantity=Sum('quantity'))
+        .values_list('day', 'medicine_id', 'expiry_date', 'unit_type', 'quantity')
+    )
+    for day, medicine_id, expiry, unit_type, quantity in sold:
+        events[day].append((medicine_id, expiry, unit_type, quantity))
+    received = (
+        PurchaseItem.objects.filter(purchase__status='RECEIVED', purchase__date__gte=window['gte'],
+                                    purchase__date__lte=window['lte'])
+        .annotate(day=TruncDate('purchase__date'))
+        .values('day', 'medicine_id', 'expiry_date')
+        .annotate(quantity=Sum('quantity'))
+        .values_list('day', 'medicine_id', 'expiry_date', 'quantity')
+    )
+    for day, medicine_id, expiry, quantity in received:
+        events[day].append((medicine_id, expiry, None, quantity))
+
+    day = checkpoint_day
+    while day > start:
+        # Undo what happened on day, leaving the stock as it was the night before
+        for medicine_id, expiry, unit_type, quantity in events.get(day, ()):
+            per_box = strips_per_box.get(medicine_id) or 1
+            lot = lots[medicine_id, expiry]
+            if unit_type == 'STRIP':
+                lot[1] += quantity
+                lot[0] = lot[1] // per_box
+            elif unit_type == 'BOX':
+                lot[0] += quantity
+                lot[1] += quantity * per_box
+            else:
+                lot[0] = max(lot[0] - quantity, 0)
+                lot[1] = max(lot[1] - quantity * per_box, 0)
+        day -= timedelta(days=1)
+        if day <= end:
+            yield day, sellable(lots, day)
+
+
+def backfill_snapshots(start, end=None, overwrite=False):
+    """Write snapshots for the days start..end (default yesterday) from the
+    stock history; days that already have one are kept unless overwrite.
+    Returns the number of snapshots written."""
+    end = end or timezone.localdate() - timedelta(days=1)
+    if start > end:
+        return 0
+    checkpoint = StockCheckpoint.objects.order_by('taken_at').first() or take_checkpoint()
+    existing = set() if overwrite else set(
+        InventorySnapshot.objects.filter(date__range=(start, end)).values_list('date', flat=True)
+    )
+    values_by_medicine = medicine_values()
+    written = 0
+    for holdings in (holdings_backward(checkpoint, start, end), holdings_forward(checkpoint, start, end)):
+        for day, held in holdings:
+            if day in existing:
+                continue
+            write_snapshot(day, value_holdings(held, values_by_medicine), backfilled=True)
+            written += 1
+    return written
+
+
+def valuation_history(start, end=None):
+    """Snapshot totals from start to end, oldest first (for charts)."""
+    snapshots = InventorySnapshot.objects.filter(date__gte=start)
+    if end is not None:
+        snapshots = snapshots.filter(date__lte=end)
+    return snapshots.order_by('date').values(
+        'date', 'medicines_in_stock', 'boxes', 'strips', 'cost_value', 'selling_value', 'backfilled',
+    )
+
+
+def medicine_history(medicine_id, start, end=None):
+    """One medicine's snapshot lines from start to end, oldest first."""
+    lines = InventorySnapshotLine.objects.filter(medicine_id=medicine_id, snapshot__date__gte=start)
+    if end is not None:
+        lines = lines.filter(snapshot__date__lte=end)
+    return lines.order_by('snapshot__date').values(
+        'snapshot__date', 'boxes', 'strips', 'cost_value', 'selling_value',
+    )
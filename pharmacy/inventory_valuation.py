@@ -0,0 +1,152 @@
+"""
+What the stock on hand is worth, at selling price and at cost.
+
+The inventory pages, their CSV exports, the reports dashboard, the
+current_inventory_value / export_current_inventory commands and
+scripts/compute_current_purchase_cost.py each had their own copy of the
+same loop: load every Medicine, read its boxes and strips, split off the
+loose strips and price both. valued_medicines() does it once, from a single
+streamed query over the medicine columns it needs; boxes and strips come
+from the stock counters (pharmacy.stock_counters), so no lot is read.
+
+The money arithmetic stays in Python with Decimal: SQLite has no decimal
+type and would sum the prices as floats.
+
+Quantities are the sellable (non-expired) boxes plus the loose strips that
+do not make up a full box, so a box is never counted twice. value_holdings()
+prices quantities from elsewhere (a past day) the same way.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db.models import F, Q
+
+from .models import Medicine
+
+ZERO = Decimal('0')
+
+CATEGORY_NAMES = dict(Medicine.CATEGORY_CHOICES)
+
+VALUE_FIELDS = (
+    'id', 'name', 'barcode_number', 'category', 'reorder_level',
+    'stock', 'strips_available', 'strips_per_box', 'price', 'purchase_price', 'strip_price',
+)
+
+
+class ValuedMedicine(namedtuple('ValuedMedicine', (
+        'id name barcode_number category reorder_level boxes strips '
+        'box_price box_purchase strip_price strip_purchase '
+        'selling_box cost_box selling_strip cost_strip'))):
+    """One medicine's stock and its value; strips are the loose ones."""
+    __slots__ = ()
+
+    @property
+    def category_display(self):
+        return CATEGORY_NAMES.get(self.category, self.category)
+
+    @property
+    def selling(self):
+        return self.selling_box + self.selling_strip
+
+    @property
+    def cost(self):
+        return self.cost_box + self.cost_strip
+
+    @property
+    def in_stock(self):
+        return self.boxes > 0 or self.strips > 0
+
+
+class InventoryTotals:
+    """Running totals over ValuedMedicines (add() them as they stream by)."""
+
+    def __init__(self):
+        self.count = 0
+        self.selling_box = ZERO
+        self.cost_box = ZERO
+        self.selling_strip = ZERO
+        self.cost_strip = ZERO
+
+    def add(self, row):
+        if row.in_stock:
+            self.count += 1
+        self.selling_box += row.selling_box
+        self.cost_box += row.cost_box
+        self.selling_strip += row.selling_strip
+        self.cost_strip += row.cost_strip
+        return row
+
+    @property
+    def selling(self):
+        return self.selling_box + self.selling_strip
+
+    @property
+    def cost(self):
+        return self.cost_box + self.cost_strip
+
+    @property
+    def profit(self):
+        return self.selling - self.cost
+
+
+def value_medicine(id, name, barcode_number, category, reorder_level, stock, strips_available,
+                   strips_per_box, price, purchase_price, strip_price):
+    """ValuedMedicine from the VALUE_FIELDS of one medicine."""
+    boxes = int(stock or 0)
+    per_box = strips_per_box or 1
+    strips = max(0, int(strips_available or 0) - boxes * per_box)
+
+    box_price = Decimal(price or 0)
+    box_purchase = Decimal(purchase_price or 0)
+    # Medicine.get_strip_price(), without needing the instance
+    if strip_price:
+        strip_price = Decimal(strip_price)
+    else:
+        strip_price = (box_price / per_box) if strips_per_box else box_price
+    strip_price = strip_price or box_price
+    strip_purchase = box_purchase / per_box
+
+    return ValuedMedicine(
+        id, name, barcode_number, category, reorder_level, boxes, strips,
+        box_price, box_purchase, strip_price, strip_purchase,
+        box_price * boxes, box_purchase * boxes, strip_price * strips, strip_purchase * strips,
+    )
+
+
+def valued_medicines(medicines=None, in_stock_only=False, chunk_size=2000):
+    """Yield a ValuedMedicine for each medicine of the queryset (default:
+    active medicines by name), streamed from one query."""
+    if medicines is None:
+        medicines = Medicine.objects.filter(is_active=True).order_by('name')
+    if in_stock_only:
+        medicines = medicines.filter(Q(stock__gt=0) | Q(strips_available__gt=F('stock') * F('strips_per_box')))
+    for values in medicines.values_list(*VALUE_FIELDS).iterator(chunk_size=chunk_size):
+        yield value_medicine(*values)
+
+
+def inventory_totals(medicines=None):
+    """InventoryTotals over valued_medicines(medicines)."""
+    totals = InventoryTotals()
+    for row in valued_medicines(medicines, in_stock_only=True):
+        totals.add(row)
+    return totals
+
+
+def medicine_values(medicines=None):
+    """{medicine_id: VALUE_FIELDS} for value_holdings(), read once."""
+    if medicines is None:
+        medicines = Medicine.objects.filter(is_active=True)
+    return {values[0]: values for values in medicines.values_list(*VALUE_FIELDS).iterator(chunk_size=2000)}
+
+
+def value_holdings(holdings, values_by_medicine=None):
+    """Yield a ValuedMedicine for each medicine in holdings, a dict of
+    {medicine_id: (boxes, strips)} held at some other moment (see
+    pharmacy.inventory_snapshots), priced at today's prices. Medicines
+    missing from values_by_medicine (default: medicine_values()) are left out."""
+    if values_by_medicine is None:
+        values_by_medicine = medicine_values()
+    for medicine_id, (boxes, strips) in holdings.items():
+        values = values_by_medicine.get(medicine_id)
+        if values is not None:
+            yield value_medicine(*values[:5], boxes, strips, *values[7:])
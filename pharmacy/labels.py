@@ -0,0 +1,202 @@
+"""
+Barcode labels as native TSPL commands.
+
+barcode_print used to draw the whole 40x25 mm label in Pillow (with the
+code128 barcode written to a temp PNG by python-barcode and read back) and
+push the picture through GDI once per copy. render_label_tspl() instead lets
+the printer draw what its firmware can: the barcode (BARCODE), the price and
+the expiry date (TEXT). Only the Arabic text, which the printer's built-in
+fonts cannot show, goes as small BITMAPs cropped to the text, and copies are
+a single "PRINT 1,n". A label job is about 1.5 KB instead of a full-label
+bitmap per copy, and render_labels_tspl() puts a whole delivery's labels
+into one job.
+
+The output only depends on its arguments and the fonts in use, so it can be
+compared byte for byte with a golden .prn (see the tests).
+"""
+from functools import lru_cache
+
+import barcode as pybarcode
+from django.conf import settings
+from PIL import Image, ImageDraw
+
+from .models import PrintJob
+from .print_spooler import enqueue_print_job
+from .raster import bitmap_command
+from .render_context import MM_TO_INCH, get_font, shaped
+
+PHARMACY_NAME = "صيدلية الإسراء"
+CURRENCY = "ج.م"
+
+# Built-in TSPL font "2" is 12x20 dots, "3" is 16x24 dots
+EXPIRY_FONT = ("2", 12, 20)
+PRICE_FONT = ("3", 16, 24)
+NAME_SIZES = (24, 20, 16)  # product name shrinks until it fits
+MARGIN = 5
+EXPIRY_STRIP = 24  # dots kept free on the right for the vertical expiry date
+
+
+def label_size():
+    """(width_mm, height_mm, width_dots, height_dots) from PRINTER_SETTINGS."""
+    dpi = settings.PRINTER_SETTINGS['PRINTER_DPI']
+    width_mm = settings.PRINTER_SETTINGS.get('LABEL_WIDTH', 40)
+    height_mm = settings.PRINTER_SETTINGS.get('LABEL_HEIGHT', 25)
+    return width_mm, height_mm, int(width_mm / MM_TO_INCH * dpi), int(height_mm / MM_TO_INCH * dpi)
+
+
+def expiry_text(expiration_date):
+    """MM/YY as printed on labels ('MM/YY' placeholder when unknown)."""
+    if not expiration_date:
+        return 'MM/YY'
+    return f"{expiration_date.month:02d}/{expiration_date.year % 100:02d}"
+
+
+@lru_cache(maxsize=512)
+def text_bitmap(text, size):
+    """Shaped text drawn black on white, cropped to its ink ("L" image)."""
+    font = get_font('regular', size)
+    text = shaped(text)
+    left, top, right, bottom = font.getbbox(text)
+    image = Image.new("L", (max(1, right - left), max(1, bottom - top)), 255)
+    ImageDraw.Draw(image).text((-left, -top), text, font=font, fill=0)
+    return image
+
+
+def tspl_string(value):
+    # TSPL escapes a double quote inside a string as \["]
+    return '"' + str(value).replace('"', '\\["]') + '"'
+
+
+def tspl_mode():
+    """True if labels go out as TSPL commands, which deployments opt into
+    with PRINTER_SETTINGS['LABEL_MODE'] = 'tspl' (the default is 'image')."""
+    return settings.PRINTER_SETTINGS.get('LABEL_MODE', 'image') == 'tspl'
+
+
+def tspl_barcode_ok(value):
+    """True if value can be printed by a TSPL BARCODE "128" command: a
+    non-empty string of printable ASCII. Other (legacy) barcodes have to go
+    through the image labels."""
+    value = str(value)
+    return bool(value) and all(' ' <= char <= '~' for char in value)
+
+
+def code128_modules(value):
+    """Width of value's code128 symbol in modules (without quiet zones)."""
+    return len(pybarcode.get('code128', value).build()[0])
+
+
+def label_commands(name, barcode_value, price, expiry='MM/YY'):
+    """The drawing commands for one label (everything between CLS and PRINT)."""
+    width_mm, height_mm, width_px, height_px = label_size()
+    barcode_value = str(barcode_value)
+    if not tspl_barcode_ok(barcode_value):
+        raise ValueError(f'Barcode {barcode_value!r} cannot be printed as code128')
+    usable_px = width_px - EXPIRY_STRIP
+    commands = []
+
+    y = MARGIN
+    for text, sizes in ((PHARMACY_NAME, NAME_SIZES[:1]), (name, NAME_SIZES)):
+        for size in sizes:
+            bitmap = text_bitmap(text, size)
+            if bitmap.width <= usable_px - 2 * MARGIN:
+                break
+        if bitmap.width > usable_px - 2 * MARGIN:
+            # Still too long at the smallest size: keep the start of the name
+            # (the right-hand end, as Arabic reads)
+            bitmap = bitmap.crop((bitmap.width - (usable_px - 2 * MARGIN), 0, bitmap.width, bitmap.height))
+        commands.append(bitmap_command(bitmap, x=(usable_px - bitmap.width) // 2, y=y))
+        y += bitmap.height + 4
+
+    # Price along the bottom: number in a printer font, currency as a bitmap
+    price_text = f"{price}"
+    font_name, char_w, char_h = PRICE_FONT
+    currency = text_bitmap(CURRENCY, 20)
+    price_w = len(price_text) * char_w + 6 + currency.width
+    price_x = (usable_px - price_w) // 2
+    price_y = height_px - char_h - MARGIN
+    commands.append(bitmap_command(currency, x=price_x, y=price_y + char_h - currency.height))
+    commands.append(
+        f"TEXT {price_x + currency.width + 6},{price_y},{tspl_string(font_name)},0,1,1,{tspl_string(price_text)}"
+        .encode('ascii')
+    )
+
+    # Barcode fills the space between the names and the price
+    barcode_height = max(24, price_y - 4 - (y + 2))
+    narrow = 2 if code128_modules(barcode_value) * 2 <= usable_px - 2 * MARGIN else 1
+    barcode_x = max(0, (usable_px - code128_modules(barcode_value) * narrow) // 2)
+    commands.append(
+        f"BARCODE {barcode_x},{y + 2},\"128\",{barcode_height},0,0,{narrow},{narrow},{tspl_string(barcode_value)}"
+        .encode('ascii')
+    )
+
+    # Expiry date reading bottom to top along the right edge
+    font_name, char_w, char_h = EXPIRY_FONT
+    expiry_w = len(expiry) * char_w
+    commands.append(
+        f"TEXT {width_px - char_h - 2},{(height_px + expiry_w) // 2},{tspl_string(font_name)},270,1,1,{tspl_string(expiry)}"
+        .encode('ascii')
+    )
+
+    return b"\r\n".join(commands)
+
+
+def job_header():
+    width_mm, height_mm, _, _ = label_size()
+    return (
+        f"SIZE {width_mm} mm, {height_mm} mm\r\n"
+        "GAP 2 mm, 0 mm\r\n"
+        "DENSITY 8\r\n"
+        "DIRECTION 0\r\n"
+        "REFERENCE 0,0\r\n"
+    ).encode('ascii')
+
+
+def label_block(commands, copies):
+    return b"CLS\r\n" + commands + f"\r\nPRINT 1,{copies}\r\n".encode('ascii')
+
+
+def render_label_tspl(name, barcode_value, price, expiry='MM/YY', copies=1):
+    """The TSPL job for copies identical labels; returns the bytes to send."""
+    return job_header() + label_block(label_commands(name, barcode_value, price, expiry), copies)
+
+
+def medicine_label_tspl(medicine, expiration_date=None, copies=1):
+    """render_label_tspl() for a Medicine (or barcode ProductSnapshot)."""
+    return render_label_tspl(
+        medicine.name, medicine.barcode_number, medicine.price, expiry_text(expiration_date), copies,
+    )
+
+
+def render_labels_tspl(labels):
+    """One TSPL job for a batch of labels.
+
+    labels is an iterable of (medicine, expiration_date, copies). Rows that
+    would print the same label (same medicine details and expiry month) are
+    merged, so each distinct label is drawn once and printed with
+    "PRINT 1,<total copies>". Returns (payload, label_count).
+    """
+    batch = {}
+    for medicine, expiration_date, copies in labels:
+        if copies <= 0:
+            continue
+        key = (medicine.name, str(medicine.barcode_number), str(medicine.price), expiry_text(expiration_date))
+        batch[key] = batch.get(key, 0) + copies
+    if not batch:
+        return b"", 0
+    payload = job_header() + b"".join(
+        label_block(label_commands(*key), copies) for key, copies in batch.items()
+    )
+    return payload, sum(batch.values())
+
+
+def enqueue_labels(labels, title='Labels', printer_name=None):
+    """Queue a batch of labels as a single print job.
+
+    Returns (job, label_count); job is None when there is nothing to print.
+    """
+    payload, count = render_labels_tspl(labels)
+    if not count:
+        return None, 0
+    job, _ = enqueue_print_job(PrintJob.RAW, payload=payload, title=title, printer_name=printer_name)
+    return job, count
@@ -1,4 +1,5 @@
 from django.core.management.base import BaseCommand
+from pharmacy.barcodes import new_barcode_numbers
 from pharmacy.models import Medicine
 from django.core.files import File
 from django.conf import settings
@@ -46,6 +47,7 @@ class Command(BaseCommand):
         ]
 
         created_count = 0
+        barcodes = new_barcode_numbers(count)
         
         self.stdout.write("Starting to create dummy products...")
         
@@ -54,8 +56,7 @@ class Command(BaseCommand):
                 # Generate random product name
                 name = f"{random.choice(prefixes)}{random.choice(suffixes)} {random.choice(forms)} {random.choice(strengths)}"
                 
-                # Generate random barcode (12 digits)
-                barcode = ''.join([str(random.randint(0, 9)) for _ in range(12)])
+                barcode = barcodes[i]
                 
                 # Generate random description
                 desc_template = random.choice(descriptions)
@@ -0,0 +1,91 @@
+"""
+Fill in SaleItem.unit_cost and SaleItem.lot for lines sold before
+pos_complete_sale recorded them (see pharmacy.sale_costs).
+
+A line is costed at the price of the medicine's last purchase on or before
+its sale day (pharmacy.historical_cost.CostHistory, read once), or at the
+current purchase price for a medicine not bought by then. Lines are read
+--chunk-size at a time in id order, and each chunk is written with one
+UPDATE for the costs and one for the lots, in its own transaction, so the
+command can be stopped and run again: it only looks at lines still without
+a cost. The daily sales rollup of the days it costed is rebuilt at the end.
+"""
+from collections import defaultdict
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Case, Exists, Max, Min, OuterRef, Subquery, Value, When
+from django.utils import timezone
+
+from pharmacy.historical_cost import CostHistory
+from pharmacy.models import SaleItem, StockEntry
+from pharmacy.sale_costs import MONEY, unit_cost
+from pharmacy.sales_rollup import rebuild
+
+LINE_FIELDS = (
+    'pk', 'sale__created_at', 'medicine_id', 'unit_type', 'medicine__strips_per_box', 'medicine__purchase_price',
+)
+
+
+def costed_chunk(history, rows):
+    """{unit_cost: [sale_item_id, ...]} for a chunk of LINE_FIELDS rows."""
+    costs = defaultdict(list)
+    for pk, created_at, medicine_id, unit_type, strips_per_box, purchase_price in rows:
+        box_cost = history.price_on(medicine_id, timezone.localtime(created_at).date())
+        if box_cost is None:
+            box_cost = purchase_price
+        costs[unit_cost(box_cost, unit_type, strips_per_box)].append(pk)
+    return costs
+
+
+class Command(BaseCommand):
+    help = 'Record the cost of goods (and the lot) on sale items sold before costs were recorded'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Sale items per transaction (default 2000)')
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        pending = SaleItem.objects.filter(unit_cost__isnull=True)
+        total = pending.count()
+        if not total:
+            self.stdout.write(self.style.SUCCESS('Every sale item already has its cost'))
+            return
+
+        sold = pending.aggregate(first=Min('sale__created_at'), last=Max('sale__created_at'))
+        first_day, last_day = (timezone.localtime(sold[end]).date() for end in ('first', 'last'))
+        started = time.monotonic()
+        history = CostHistory()
+        lot = StockEntry.objects.filter(medicine_id=OuterRef('medicine_id'), expiration_date=OuterRef('expiry_date'))
+        done = lots = 0
+        last = 0
+        while True:
+            rows = list(pending.filter(pk__gt=last).order_by('pk').values_list(*LINE_FIELDS)[:chunk_size])
+            if not rows:
+                break
+            last = rows[-1][0]
+            ids = [row[0] for row in rows]
+            costs = costed_chunk(history, rows)
+            with transaction.atomic():
+                # One WHEN per distinct cost, not per line
+                done += SaleItem.objects.filter(pk__in=ids).update(unit_cost=Case(
+                    *(When(pk__in=cost_ids, then=Value(cost)) for cost, cost_ids in costs.items()),
+                    output_field=MONEY,
+                ))
+                # The lot is still there if it has not been emptied and cleaned up
+                lots += SaleItem.objects.filter(pk__in=ids, lot__isnull=True).filter(Exists(lot)) \
+                    .update(lot=Subquery(lot.values('pk')[:1]))
+            elapsed = time.monotonic() - started
+            self.stdout.write(f'  {done}/{total} sale items, {done / elapsed if elapsed else done:.0f}/s')
+
+        # The rollup summed these lines at today's price
+        rows = rebuild(first_day, last_day)
+        self.stdout.write(self.style.SUCCESS(
+            f'Costed {done} sale item(s), {lots} linked to their lot, in {time.monotonic() - started:.1f}s; '
+            f'rebuilt {rows} daily sales row(s)'
+        ))
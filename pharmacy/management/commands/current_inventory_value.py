@@ -1,9 +1,8 @@
 from django.core.management.base import BaseCommand
 import csv
 from decimal import Decimal
-from django.utils import timezone
 
-from pharmacy.models import Medicine
+from pharmacy.inventory_valuation import valued_medicines
 
 
 class Command(BaseCommand):
@@ -16,7 +15,6 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         out_path = options.get('out')
         unit = options.get('unit') or 'both'
-        today = timezone.now().date()
 
         headers = []
         if unit in ('box', 'both'):
@@ -28,56 +26,23 @@ class Command(BaseCommand):
         total_selling = Decimal('0')
         total_cost = Decimal('0')
 
-        qs = Medicine.objects.filter(is_active=True).order_by('name')
         count_in_stock = 0
-        for m in qs:
-            try:
-                box_qty = int(m.calculate_available_stock() or 0)
-            except Exception:
-                box_qty = int(m.stock or 0)
-
-            # Compute strips not already counted as full boxes
-            try:
-                total_strips = int(m.strips_in_stock or 0)
-            except Exception:
-                total_strips = box_qty * (m.strips_per_box or 1) if box_qty else 0
-            strips_per_box = m.strips_per_box or 1
-            strip_qty = total_strips - (box_qty * strips_per_box)
-            if strip_qty < 0:
-                strip_qty = 0
-
-            box_price = Decimal(m.price or 0)
-            box_purchase = Decimal(m.purchase_price or 0)
-
-            strips_per_box = m.strips_per_box or 1
-            try:
-                strip_price = Decimal(m.get_strip_price() or box_price)
-            except Exception:
-                strip_price = box_price
-            strip_purchase = (box_purchase / Decimal(strips_per_box)) if strips_per_box else Decimal('0')
-
-            total_selling_box = box_price * Decimal(box_qty)
-            total_cost_box = box_purchase * Decimal(box_qty)
-
-            total_selling_strip = strip_price * Decimal(strip_qty)
-            total_cost_strip = strip_purchase * Decimal(strip_qty)
-
-            if box_qty > 0 or strip_qty > 0:
-                count_in_stock += 1
-                row = [m.id, m.name]
-                if unit in ('box', 'both'):
-                    row += [box_qty, f"{box_price:.2f}", f"{box_purchase:.2f}", f"{total_selling_box:.2f}", f"{total_cost_box:.2f}"]
-                if unit in ('strip', 'both'):
-                    row += [strip_qty, f"{strip_price:.2f}", f"{strip_purchase:.2f}", f"{total_selling_strip:.2f}", f"{total_cost_strip:.2f}"]
-                rows.append(row)
-
-                # accumulate totals depending on unit selection
-                if unit in ('box', 'both'):
-                    total_selling += total_selling_box
-                    total_cost += total_cost_box
-                if unit in ('strip', 'both'):
-                    total_selling += total_selling_strip
-                    total_cost += total_cost_strip
+        for m in valued_medicines(in_stock_only=True):
+            count_in_stock += 1
+            row = [m.id, m.name]
+            if unit in ('box', 'both'):
+                row += [m.boxes, f"{m.box_price:.2f}", f"{m.box_purchase:.2f}", f"{m.selling_box:.2f}", f"{m.cost_box:.2f}"]
+            if unit in ('strip', 'both'):
+                row += [m.strips, f"{m.strip_price:.2f}", f"{m.strip_purchase:.2f}", f"{m.selling_strip:.2f}", f"{m.cost_strip:.2f}"]
+            rows.append(row)
+
+            # accumulate totals depending on unit selection
+            if unit in ('box', 'both'):
+                total_selling += m.selling_box
+                total_cost += m.cost_box
+            if unit in ('strip', 'both'):
+                total_selling += m.selling_strip
+                total_cost += m.cost_strip
 
         # print a concise report
         self.stdout.write(f"Products currently in stock: {count_in_stock}")
@@ -1,9 +1,7 @@
 from django.core.management.base import BaseCommand
 import csv
-from decimal import Decimal
-from django.utils import timezone
 
-from pharmacy.models import Medicine
+from pharmacy.inventory_valuation import valued_medicines
 
 
 class Command(BaseCommand):
@@ -14,7 +12,6 @@ class Command(BaseCommand):
 
     def handle(self, *args, **options):
         out_path = options.get('out') or 'current_inventory.csv'
-        today = timezone.now().date()
 
         headers = [
             'id', 'name',
@@ -23,45 +20,12 @@ class Command(BaseCommand):
         ]
 
         rows = []
-        for m in Medicine.objects.filter(is_active=True).order_by('name'):
-            try:
-                box_qty = int(m.calculate_available_stock() or 0)
-            except Exception:
-                box_qty = int(m.stock or 0)
-
-            # Compute strips not already counted as full boxes
-            try:
-                total_strips = int(m.strips_in_stock or 0)
-            except Exception:
-                total_strips = box_qty * (m.strips_per_box or 1) if box_qty else 0
-            strips_per_box = m.strips_per_box or 1
-            strip_qty = total_strips - (box_qty * strips_per_box)
-            if strip_qty < 0:
-                strip_qty = 0
-
-            box_price = Decimal(m.price or 0)
-            box_purchase = Decimal(m.purchase_price or 0)
-
-            strips_per_box = m.strips_per_box or 1
-            try:
-                strip_price = Decimal(m.get_strip_price() or box_price)
-            except Exception:
-                strip_price = box_price
-
-            strip_purchase = (box_purchase / Decimal(strips_per_box)) if strips_per_box else Decimal('0')
-
-            total_selling_value_box = box_price * Decimal(box_qty)
-            total_cost_value_box = box_purchase * Decimal(box_qty)
-
-            total_selling_value_strip = strip_price * Decimal(strip_qty)
-            total_cost_value_strip = strip_purchase * Decimal(strip_qty)
-
-            if box_qty > 0 or strip_qty > 0:
-                rows.append([
-                    m.id, m.name,
-                    box_qty, f"{box_price:.2f}", f"{box_purchase:.2f}", f"{total_selling_value_box:.2f}", f"{total_cost_value_box:.2f}",
-                    strip_qty, f"{strip_price:.2f}", f"{strip_purchase:.2f}", f"{total_selling_value_strip:.2f}", f"{total_cost_value_strip:.2f}",
-                ])
+        for m in valued_medicines(in_stock_only=True):
+            rows.append([
+                m.id, m.name,
+                m.boxes, f"{m.box_price:.2f}", f"{m.box_purchase:.2f}", f"{m.selling_box:.2f}", f"{m.cost_box:.2f}",
+                m.strips, f"{m.strip_price:.2f}", f"{m.strip_purchase:.2f}", f"{m.selling_strip:.2f}", f"{m.cost_strip:.2f}",
+            ])
 
         with open(out_path, 'w', newline='', encoding='utf-8-sig') as f:
             writer = csv.writer(f)
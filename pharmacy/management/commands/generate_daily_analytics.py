@@ -1,12 +1,25 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from pharmacy.models import ProfitAnalytics
 from django.utils import timezone
 
+from .generate_profit_analytics import backfill, parse_day
+
 class Command(BaseCommand):
-    help = 'Generate profit analytics for yesterday'
+    help = 'Generate profit analytics for yesterday, or for every day from --from to --to'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', help='First day of a range to (re)generate, YYYY-MM-DD')
+        parser.add_argument('--to', dest='end', help='Last day of the range (default yesterday)')
 
     def handle(self, *args, **options):
         yesterday = timezone.now().date() - timezone.timedelta(days=1)
+        if options.get('start'):
+            end = parse_day(options['end']) if options.get('end') else yesterday
+            backfill(self, parse_day(options['start']), end)
+            return
+        if options.get('end'):
+            raise CommandError('--to needs --from')
+
         analytics = ProfitAnalytics.generate_daily_report(yesterday)
         
         self.stdout.write(self.style.SUCCESS(f'Generated profit analytics for {yesterday}:'))
@@ -14,4 +27,4 @@ class Command(BaseCommand):
         self.stdout.write(f'Total Cost: ${analytics.total_cost}')
         self.stdout.write(f'Total Profit: ${analytics.total_profit}')
         self.stdout.write(f'Profit Margin: {analytics.profit_margin}%')
-        self.stdout.write(f'Number of Sales: {analytics.number_of_sales}')
\ No newline at end of file
+        self.stdout.write(f'Number of Sales: {analytics.number_of_sales}')
@@ -1,9 +1,33 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from pharmacy.models import ProfitAnalytics
+from pharmacy.profit_analytics import generate_range
 from django.utils import timezone
 
+
+def parse_day(value):
+    try:
+        return timezone.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f'Invalid date {value!r}; use YYYY-MM-DD')
+
+
+def backfill(command, start, end):
+    """Run generate_range() for a command's --from/--to and report."""
+    if start > end:
+        raise CommandError('--from is after --to')
+    started = timezone.now()
+    created, updated = generate_range(
+        start, end, progress=lambda day: command.stdout.write(f'  up to {day}')
+    )
+    elapsed = (timezone.now() - started).total_seconds()
+    command.stdout.write(command.style.SUCCESS(
+        f'Generated profit analytics for {start} to {end}: '
+        f'{created} created, {updated} updated in {elapsed:.1f}s'
+    ))
+
+
 class Command(BaseCommand):
-    help = 'Generate profit analytics report for a specific date or today'
+    help = 'Generate profit analytics report for a specific date or today, or every day of a range'
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -12,8 +36,17 @@ class Command(BaseCommand):
             help='Date in YYYY-MM-DD format. If not provided, will use today\'s date.',
             required=False
         )
+        parser.add_argument('--from', dest='start', help='First day of a range to (re)generate, YYYY-MM-DD')
+        parser.add_argument('--to', dest='end', help='Last day of the range (default today)')
 
     def handle(self, *args, **options):
+        if options.get('start'):
+            end = parse_day(options['end']) if options.get('end') else timezone.now().date()
+            backfill(self, parse_day(options['start']), end)
+            return
+        if options.get('end'):
+            raise CommandError('--to needs --from')
+
         date_str = options.get('date')
         if date_str:
             try:
@@ -33,4 +66,4 @@ class Command(BaseCommand):
         self.stdout.write(f'Profit Margin: {analytics.profit_margin}%')
         self.stdout.write(f'Number of Sales: {analytics.number_of_sales}')
         self.stdout.write(f'Average Profit per Sale: ${analytics.average_profit_per_sale}')
-        self.stdout.write(f'Most Profitable Category: {analytics.most_profitable_category}')
\ No newline at end of file
+        self.stdout.write(f'Most Profitable Category: {analytics.most_profitable_category}')
@@ -1,12 +1,109 @@
 """
 Import products from Excel file, including expiration dates.
+
+The sheet is streamed with openpyxl in read-only mode and handled in chunks
+of --chunk-size rows, each in one transaction: the rows are validated, the
+medicines they name are read with one query, changed ones are written back
+with bulk_update, new ones inserted with bulk_create, and their stock added
+with pharmacy.stock_intake.intake_lots(). Barcode images are not rendered
+during the import; pharmacy.barcodes draws each one when it is first shown.
+
+With --dry-run every chunk is rolled back, so the report shows what the
+import would do without changing anything.
 """
-from django.core.management.base import BaseCommand
-import pandas as pd
-from pharmacy.models import Medicine, StockEntry
-from django.utils import timezone
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
 import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from openpyxl import load_workbook
+from openpyxl.utils.datetime import from_excel
+
+from pharmacy.barcode_lookup import invalidate_medicines
+from pharmacy.models import Medicine, StockMovement
+from pharmacy.stock_intake import intake_lots
+from pharmacy.stock_ledger import movement_reason
+
+# Excel column -> row field
+COLUMNS = {
+    'الباركود': 'barcode',
+    'اسم الصنف': 'name',
+    'الكمية': 'quantity',
+    'سعر الشراء': 'purchase_price',
+    'سعر البيع': 'price',
+    'تاريخ انتهاء الصلاحيه': 'expiry_date',
+}
+
+DEFAULT_CATEGORY = 'OTHERS'
+DEFAULT_REORDER_LEVEL = 5
+CENT = Decimal('0.01')
+# Medicines per bulk INSERT / UPDATE statement
+BATCH_SIZE = 500
+
+
+class RowError(ValueError):
+    pass
+
+
+def parse_barcode(value):
+    if isinstance(value, float):
+        value = int(value)
+    barcode = str(value).strip()
+    if barcode.endswith('.0'):
+        barcode = barcode[:-2]
+    if not barcode.isdigit() or len(barcode) > 13:
+        raise RowError(f'invalid barcode {value!r}')
+    return barcode.zfill(12)
+
+
+def parse_price(value, label):
+    try:
+        price = Decimal(str(value).strip()).quantize(CENT)
+    except (InvalidOperation, ValueError):
+        raise RowError(f'invalid {label} {value!r}')
+    if price < 0:
+        raise RowError(f'negative {label} {price}')
+    return price
+
+
+def parse_date(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, (int, float)):
+        # A date cell without a date format comes through as its serial number
+        return from_excel(value).date()
+    try:
+        # "d/m/yyyy", with or without leading zeros
+        return datetime.strptime(str(value).strip(), '%d/%m/%Y').date()
+    except ValueError:
+        return None
+
+
+def parse_row(row, default_expiry):
+    """(barcode, name, quantity, purchase_price, price, expiry, defaulted)
+    from a row dict, or RowError."""
+    name = str(row['name'] or '').strip()
+    if not name:
+        raise RowError('empty name')
+    try:
+        quantity = int(row['quantity'])
+    except (TypeError, ValueError):
+        raise RowError(f'invalid quantity {row["quantity"]!r}')
+    if quantity < 0:
+        raise RowError(f'negative quantity {quantity}')
+    expiry = parse_date(row['expiry_date'])
+    return (
+        parse_barcode(row['barcode']), name[:200], quantity,
+        parse_price(row['purchase_price'], 'purchase price'), parse_price(row['price'], 'price'),
+        expiry or default_expiry, expiry is None,
+    )
 
 
 class Command(BaseCommand):
@@ -14,157 +111,149 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('excel_file', type=str, help='Path to the Excel file')
-
-    def parse_date(self, date_str):
-        if pd.isna(date_str):
-            return None
-        try:
-            # Try parsing date in format "d/m/yyyy"
-            return datetime.strptime(str(date_str).strip(), '%d/%m/%Y')
-        except ValueError:
-            try:
-                # Try parsing date in format "d/m/yyyy" with no leading zeros
-                return datetime.strptime(str(date_str).strip(), '%-d/%-m/%Y')
-            except ValueError:
-                return None
+        parser.add_argument('--chunk-size', type=int, default=2000,
+                            help='Rows per transaction (default 2000)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Validate and report without saving anything')
 
     def handle(self, *args, **options):
         file_path = options['excel_file']
-        
+        chunk_size = options['chunk_size']
         if not os.path.exists(file_path):
-            self.stdout.write(self.style.ERROR(f'File not found: {file_path}'))
-            return
-            
+            raise CommandError(f'File not found: {file_path}')
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be at least 1')
+        self.dry_run = options['dry_run']
+        self.verbosity = options['verbosity']
+        self.default_expiry = timezone.localdate() + timedelta(days=365)
+        self.totals = dict(created=0, updated=0, unchanged=0, lots=0, skipped=0, defaulted_expiry=0)
+
+        self.stdout.write(f'Reading file: {file_path}')
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
         try:
-            # Read Excel file
-            self.stdout.write(f'Reading file: {file_path}')
-            df = pd.read_excel(file_path)
-            
-            # Map Excel columns to model fields
-            column_mapping = {
-                'الباركود': 'barcode',
-                'اسم الصنف': 'name',
-                'الكمية': 'quantity',
-                'سعر الشراء': 'purchase_price',
-                'سعر البيع': 'price',
-                'تاريخ انتهاء الصلاحيه': 'expiry_date',
-                'إجمالي سعر البيع': 'total_sell_price'  # We won't use this in the model
-            }
-            
-            # Check if required columns exist
-            missing_columns = [col for col in column_mapping.keys() if col not in df.columns]
-            if missing_columns:
-                self.stdout.write(
-                    self.style.ERROR(
-                        f'Missing required columns: {", ".join(missing_columns)}'
-                    )
-                )
-                return
-            
-            # Rename columns
-            df = df.rename(columns=column_mapping)
-            
-            total_added = 0
-            total_updated = 0
-            
-            for _, row in df.iterrows():
-                try:
-                    # Skip rows with empty barcode
-                    if pd.isna(row['barcode']):
-                        continue
-                    
-                    self.stdout.write(f"Processing row: {row}")
-                    barcode = str(int(row['barcode']))  # Convert to string and remove decimals
-                    name = str(row['name']).strip()
-                    quantity = int(row['quantity'])
-                    self.stdout.write(f"Quantity from Excel: {quantity}")
-                    purchase_price = float(row['purchase_price'])
-                    price = float(row['price'])
-                    expiry_date = self.parse_date(row['expiry_date'])
-                    self.stdout.write(f"Parsed values: barcode={barcode}, name={name}, quantity={quantity}, price={price}, expiry_date={expiry_date}")
-                    
-                    if not name:
-                        self.stdout.write(self.style.WARNING(f'Skipping row with empty name: {row}'))
-                        continue
-                        
-                    if quantity < 0:
-                        self.stdout.write(self.style.WARNING(f'Invalid quantity for {name}: {quantity}'))
-                        continue
-                        
-                    if price < 0 or purchase_price < 0:
-                        self.stdout.write(self.style.WARNING(f'Invalid price for {name}: price={price}, purchase_price={purchase_price}'))
-                        continue
-
-                    if not expiry_date:
-                        self.stdout.write(self.style.WARNING(f'Invalid or missing expiry date for {name}, using default (1 year)'))
-                        expiry_date = timezone.now() + timezone.timedelta(days=365)
-                    
-                    # Try to get existing medicine or create new one
-                    medicine, created = Medicine.objects.get_or_create(
-                        barcode_number=barcode,
-                        defaults={
-                            'name': name,
-                            'price': price,
-                            'purchase_price': purchase_price,
-                            'category': 'OTHERS',  # Default category
-                            'reorder_level': 5,  # Default reorder level
-                        }
-                    )
-                    
-                    if not created:
-                        # Update existing medicine
-                        medicine.name = name
-                        medicine.price = price
-                        medicine.purchase_price = purchase_price
-                        medicine.save()
-                        total_updated += 1
-                        self.stdout.write(self.style.SUCCESS(f'Updated existing medicine: {name}'))
-                    else:
-                        total_added += 1
-                        self.stdout.write(self.style.SUCCESS(f'Created new medicine: {name}'))
-                    
-                    # Add stock entry for the quantity
-                    if quantity > 0:
-                        stock_entry, se_created = StockEntry.objects.get_or_create(
-                            medicine=medicine,
-                            expiration_date=expiry_date,
-                            defaults={'quantity': quantity, 'strips_remaining': quantity * medicine.strips_per_box}
-                        )
-                        if not se_created:
-                            stock_entry.quantity = (stock_entry.quantity or 0) + quantity
-                            if stock_entry.strips_remaining is None:
-                                stock_entry.strips_remaining = stock_entry.quantity * medicine.strips_per_box
-                            else:
-                                stock_entry.strips_remaining = (stock_entry.strips_remaining or 0) + (quantity * medicine.strips_per_box)
-                            stock_entry.save()
-
-                        # Update medicine stock using the new calculation method
-                        old_stock = medicine.stock
-                        medicine.update_stock()
-                        new_stock = medicine.stock
-
-                        action = "Updated" if not created else "Created new"
-                        self.stdout.write(
-                            self.style.SUCCESS(
-                                f'{action} stock entry for {medicine.name}:\n'
-                                f'- Quantity added: {quantity}\n'
-                                f'- Expiry date: {expiry_date.strftime("%d/%m/%Y")}\n'
-                                f'- Previous stock: {old_stock}\n'
-                                f'- New total stock: {new_stock}'
-                            )
-                        )
-                        
-                except (ValueError, TypeError) as e:
-                    self.stdout.write(self.style.WARNING(f'Error processing row: {row}. Error: {str(e)}'))
+            sheet = workbook.active
+            rows = sheet.iter_rows(values_only=True)
+            header = [str(cell).strip() if cell is not None else '' for cell in next(rows, ())]
+            missing = [column for column in COLUMNS if column not in header]
+            if missing:
+                raise CommandError(f'Missing required columns: {", ".join(missing)}')
+            positions = {field: header.index(column) for column, field in COLUMNS.items()}
+            total_rows = (sheet.max_row - 1) if sheet.max_row else None
+
+            started = time.monotonic()
+            read = 0
+            chunk = []
+            for line, values in enumerate(rows, start=2):
+                if not any(value is not None for value in values):
+                    continue
+                chunk.append((line, {field: values[i] if i < len(values) else None
+                                     for field, i in positions.items()}))
+                if len(chunk) >= chunk_size:
+                    read += self.import_chunk(chunk)
+                    self.progress(read, total_rows, started)
+                    chunk = []
+            if chunk:
+                read += self.import_chunk(chunk)
+                self.progress(read, total_rows, started)
+        finally:
+            workbook.close()
+
+        elapsed = time.monotonic() - started
+        totals = self.totals
+        if totals['defaulted_expiry']:
+            self.stdout.write(self.style.WARNING(
+                f'{totals["defaulted_expiry"]} row(s) had no valid expiry date; '
+                f'used {self.default_expiry:%d/%m/%Y}'
+            ))
+        summary = (
+            f'{read} rows in {elapsed:.1f}s ({read / elapsed if elapsed else read:.0f} rows/s): '
+            f'{totals["created"]} new, {totals["updated"]} updated, {totals["unchanged"]} unchanged '
+            f'medicines, stock added to {totals["lots"]} lot(s), {totals["skipped"]} row(s) skipped'
+        )
+        if self.dry_run:
+            self.stdout.write(self.style.WARNING(f'Dry run, nothing saved. {summary}'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Imported {summary}'))
+
+    def progress(self, read, total_rows, started):
+        elapsed = time.monotonic() - started
+        rate = read / elapsed if elapsed else read
+        of = f'/{total_rows}' if total_rows else ''
+        self.stdout.write(f'  {read}{of} rows, {rate:.0f} rows/s')
+
+    def import_chunk(self, chunk):
+        """Validate and import one chunk of (line, row) in one transaction;
+        returns the number of rows read."""
+        parsed = {}
+        for line, row in chunk:
+            try:
+                barcode, name, quantity, purchase_price, price, expiry, defaulted = \
+                    parse_row(row, self.default_expiry)
+            except RowError as e:
+                self.totals['skipped'] += 1
+                if self.verbosity > 1:
+                    self.stdout.write(self.style.WARNING(f'Row {line}: {e}, skipped'))
+                continue
+            self.totals['defaulted_expiry'] += defaulted
+            # A barcode listed twice keeps the last name and prices, and all its quantities
+            _, _, _, stock = parsed.get(barcode, (None, None, None, []))
+            if quantity:
+                stock.append((expiry, quantity))
+            parsed[barcode] = (name, purchase_price, price, stock)
+        if not parsed:
+            return len(chunk)
+
+        with transaction.atomic(), movement_reason(StockMovement.INTAKE, 'import'):
+            existing = Medicine.objects.only(
+                'id', 'barcode_number', 'name', 'price', 'purchase_price', 'strip_price', 'strips_per_box',
+            ).in_bulk(list(parsed), field_name='barcode_number')
+
+            changed = []
+            new = []
+            now = timezone.now()
+            for barcode, (name, purchase_price, price, _) in parsed.items():
+                medicine = existing.get(barcode)
+                if medicine is None:
+                    new.append(Medicine(
+                        barcode_number=barcode, name=name, price=price, purchase_price=purchase_price,
+                        strip_price=price, category=DEFAULT_CATEGORY, reorder_level=DEFAULT_REORDER_LEVEL,
+                    ))
+                    continue
+                # Medicine.save() derives the strip price from the box price
+                strip_price = (price / medicine.strips_per_box).quantize(CENT) \
+                    if medicine.strips_per_box > 0 else medicine.strip_price
+                if (medicine.name, medicine.price, medicine.purchase_price, medicine.strip_price) == \
+                        (name, price, purchase_price, strip_price):
+                    self.totals['unchanged'] += 1
                     continue
-                
-            self.stdout.write(
-                self.style.SUCCESS(
-                    f'Successfully imported {total_added} new medicines and updated {total_updated} existing ones'
+                medicine.name = name
+                medicine.price = price
+                medicine.purchase_price = purchase_price
+                medicine.strip_price = strip_price
+                medicine.updated_at = now
+                changed.append(medicine)
+
+            if changed:
+                Medicine.objects.bulk_update(
+                    changed, ['name', 'price', 'purchase_price', 'strip_price', 'updated_at'],
+                    batch_size=BATCH_SIZE,
                 )
+                invalidate_medicines([medicine.id for medicine in changed])
+            if new:
+                Medicine.objects.bulk_create(new, batch_size=BATCH_SIZE)
+                existing.update(
+                    Medicine.objects.only('id', 'barcode_number')
+                    .in_bulk([medicine.barcode_number for medicine in new], field_name='barcode_number')
+                )
+            self.totals['created'] += len(new)
+            self.totals['updated'] += len(changed)
+
+            lots = intake_lots(
+                (existing[barcode].id, expiry, quantity, purchase_price)
+                for barcode, (_, purchase_price, _, stock) in parsed.items()
+                for expiry, quantity in stock
             )
-            
-        except Exception as e:
-            self.stdout.write(
-                self.style.ERROR(f'Error importing products: {str(e)}')
-            )
+            self.totals['lots'] += len(lots)
+            if self.dry_run:
+                transaction.set_rollback(True)
+        return len(chunk)
@@ -0,0 +1,39 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pharmacy.inventory_snapshots import backfill_snapshots, take_snapshot
+
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f'Invalid date {value!r}; use YYYY-MM-DD')
+
+
+class Command(BaseCommand):
+    help = ("Store today's inventory valuation as a daily snapshot (run nightly), "
+            "or rebuild past days from the stock history with --backfill")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', dest='start', default=None,
+                            help='Rebuild snapshots from this day (YYYY-MM-DD) instead')
+        parser.add_argument('--to', dest='end', default=None,
+                            help='Last day to rebuild (YYYY-MM-DD, default yesterday)')
+        parser.add_argument('--overwrite', action='store_true',
+                            help='Also rebuild days that already have a snapshot')
+
+    def handle(self, *args, **options):
+        if options['start']:
+            start = parse_day(options['start'])
+            end = parse_day(options['end']) if options['end'] else None
+            count = backfill_snapshots(start, end, overwrite=options['overwrite'])
+            self.stdout.write(self.style.SUCCESS(f'Backfilled {count} snapshot(s)'))
+            return
+
+        snapshot = take_snapshot()
+        self.stdout.write(self.style.SUCCESS(
+            f'Snapshot for {snapshot.date}: {snapshot.medicines_in_stock} medicine(s), '
+            f'cost {snapshot.cost_value}, selling {snapshot.selling_value}'
+        ))
@@ -4,7 +4,8 @@ from decimal import Decimal
 import csv
 from collections import defaultdict
 
-from pharmacy.models import Medicine, SaleItem, PurchaseItem
+from pharmacy.historical_cost import sale_lines
+from pharmacy.models import Medicine
 
 
 class Command(BaseCommand):
@@ -24,14 +25,8 @@ class Command(BaseCommand):
         max_mult = Decimal(str(options.get('max_mult') or 10.0))
         csvfile = options.get('csvfile')
 
-        # Prepare sales filter
-        items_qs = SaleItem.objects.select_related('sale', 'medicine').filter(sale__is_completed=True)
-        if from_date:
-            fd = timezone.datetime.strptime(from_date, '%Y-%m-%d')
-            items_qs = items_qs.filter(sale__created_at__date__gte=fd.date())
-        if to_date:
-            td = timezone.datetime.strptime(to_date, '%Y-%m-%d')
-            items_qs = items_qs.filter(sale__created_at__date__lte=td.date())
+        start = timezone.datetime.strptime(from_date, '%Y-%m-%d').date() if from_date else None
+        end = timezone.datetime.strptime(to_date, '%Y-%m-%d').date() if to_date else None
 
         # Aggregate per medicine
         agg_qty = defaultdict(int)
@@ -40,37 +35,14 @@ class Command(BaseCommand):
         agg_unit_price_sum = defaultdict(Decimal)
         agg_unit_price_count = defaultdict(int)
 
-        purchase_cache = {}
-
-        for it in items_qs.iterator():
-            mid = it.medicine_id
-            qty = it.quantity or 0
-            unit_price = Decimal(str(it.price or 0))
-            agg_qty[mid] += qty
-            agg_revenue[mid] += unit_price * Decimal(qty)
-            agg_unit_price_sum[mid] += unit_price
+        # Each line costed at the last purchase price on or before its sale day
+        for line in sale_lines(start, end):
+            mid = line.medicine_id
+            agg_qty[mid] += line.quantity
+            agg_revenue[mid] += line.price * line.quantity
+            agg_unit_price_sum[mid] += line.price
             agg_unit_price_count[mid] += 1
-
-            # historical purchase price lookup
-            sale_date = it.sale.created_at
-            key = (mid, sale_date.date())
-            if key in purchase_cache:
-                hist_price = purchase_cache[key]
-            else:
-                pi = PurchaseItem.objects.filter(medicine=it.medicine, purchase__date__date__lte=sale_date.date()).order_by('-purchase__date').first()
-                if pi:
-                    hist_price = Decimal(str(pi.price))
-                else:
-                    hist_price = Decimal(str(it.medicine.purchase_price or 0))
-                purchase_cache[key] = hist_price
-
-            if it.unit_type == 'STRIP':
-                spb = it.medicine.strips_per_box or 1
-                unit_cost = (hist_price / Decimal(spb))
-            else:
-                unit_cost = hist_price
-
-            agg_profit_hist[mid] += (unit_price - unit_cost) * Decimal(qty)
+            agg_profit_hist[mid] += line.profit
 
         # Prepare output
         anomalies = []
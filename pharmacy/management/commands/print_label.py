@@ -4,6 +4,7 @@ from PIL import Image, ImageDraw, ImageFont
 import os
 import math
 from pharmacy.models import Medicine
+from pharmacy.raster import pack_bitmap
 
 class Command(BaseCommand):
     help = 'Print a label for a medicine using a thermal printer'
@@ -164,22 +165,7 @@ class Command(BaseCommand):
 
     def convert_to_bitmap(self, image, width_px, height_px):
         """Convert image to bitmap data for printer"""
-        bitmap_data = bytearray()
-        pixels = image.load()
-        for y in range(height_px):
-            byte = 0
-            count = 0
-            for x in range(width_px):
-                byte = (byte << 1) | (0 if pixels[x, y] == 0 else 1)
-                count += 1
-                if count == 8:
-                    bitmap_data.append(byte)
-                    byte = 0
-                    count = 0
-            if count > 0:
-                byte = byte << (8 - count)
-                bitmap_data.append(byte)
-        return bitmap_data
+        return pack_bitmap(image)[2]
 
     def get_windows_printer(self, printer_name=None):
         """Get appropriate Windows printer"""
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from pharmacy.models import PrintJob
+from pharmacy.print_spooler import drain, requeue_stale_jobs, spooler_setting
+
+
+class Command(BaseCommand):
+    help = ('Run the thermal print queue worker in the foreground. Use with '
+            'PRINT_SPOOLER_WORKER=none so the web processes only enqueue.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Print every job that is due, then exit')
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Give FAILED jobs another round of attempts first')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            count = PrintJob.objects.filter(status=PrintJob.FAILED).update(
+                status=PrintJob.PENDING, attempts=0)
+            self.stdout.write(f'Requeued {count} failed job(s)')
+        requeue_stale_jobs()
+
+        if options['once']:
+            count = drain()
+            self.stdout.write(self.style.SUCCESS(f'Ran {count} print job(s)'))
+            return
+
+        poll = spooler_setting('POLL_SECONDS', 2)
+        self.stdout.write(f'Print spooler running (transport: {spooler_setting("TRANSPORT")}), Ctrl+C to stop')
+        try:
+            while True:
+                if not drain():
+                    time.sleep(poll)
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped')
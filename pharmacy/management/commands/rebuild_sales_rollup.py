@@ -0,0 +1,34 @@
+from datetime import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pharmacy.sales_rollup import rebuild
+
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError(f'Invalid date {value!r}; use YYYY-MM-DD')
+
+
+class Command(BaseCommand):
+    help = 'Regenerate the daily sales rollup behind the profit pages from the sale lines'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='start', default=None,
+                            help='First day to rebuild (YYYY-MM-DD, default the first sale)')
+        parser.add_argument('--to', dest='end', default=None,
+                            help='Last day to rebuild (YYYY-MM-DD, default the last sale)')
+
+    def handle(self, *args, **options):
+        start = parse_day(options['start']) if options['start'] else None
+        end = parse_day(options['end']) if options['end'] else None
+        if start and end and start > end:
+            raise CommandError('--from is after --to')
+        started = time.monotonic()
+        rows = rebuild(start, end)
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {rows} daily sales row(s) in {time.monotonic() - started:.1f}s'
+        ))
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from pharmacy.stock_counters import find_drift, rewrite_counters, rollover_expired
+
+
+class Command(BaseCommand):
+    help = ('Check the Medicine stock counters (boxes, strips, nearest expiry) '
+            'against a full recompute from the stock entries')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Rewrite the counters that differ')
+        parser.add_argument('--rollover', action='store_true',
+                            help='Only take lots that have expired out of the counters (run nightly)')
+
+    def handle(self, *args, **options):
+        if options['rollover']:
+            with transaction.atomic():
+                count = rollover_expired()
+            self.stdout.write(self.style.SUCCESS(f'Rolled over expired stock for {count} medicine(s)'))
+            return
+
+        with transaction.atomic():
+            drift = find_drift()
+            for medicine, stored, wanted in drift:
+                self.stdout.write(
+                    f'{medicine.name} (id={medicine.id}): stored boxes={stored[0]} strips={stored[1]} '
+                    f'nearest={stored[2]}, actual boxes={wanted[0]} strips={wanted[1]} nearest={wanted[2]}'
+                )
+            if not drift:
+                self.stdout.write(self.style.SUCCESS('All stock counters match'))
+                return
+            if options['fix']:
+                count = rewrite_counters(drift)
+                self.stdout.write(self.style.SUCCESS(f'Fixed {count} medicine(s)'))
+                return
+        raise CommandError(f'{len(drift)} medicine(s) have drifted counters; rerun with --fix')
@@ -3,7 +3,7 @@ from django.utils import timezone
 from decimal import Decimal
 from collections import defaultdict
 
-from pharmacy.models import SaleItem, PurchaseItem
+from pharmacy.historical_cost import sale_lines
 
 
 class Command(BaseCommand):
@@ -19,43 +19,17 @@ class Command(BaseCommand):
         to_date = options.get('to_date')
         top = options.get('top') or 20
 
-        items_qs = SaleItem.objects.select_related('sale', 'medicine').filter(sale__is_completed=True)
-        if from_date:
-            fd = timezone.datetime.strptime(from_date, '%Y-%m-%d')
-            items_qs = items_qs.filter(sale__created_at__date__gte=fd.date())
-        if to_date:
-            td = timezone.datetime.strptime(to_date, '%Y-%m-%d')
-            items_qs = items_qs.filter(sale__created_at__date__lte=td.date())
+        start = timezone.datetime.strptime(from_date, '%Y-%m-%d').date() if from_date else None
+        end = timezone.datetime.strptime(to_date, '%Y-%m-%d').date() if to_date else None
 
-        # We'll compute historical purchase price like the historical summary
-        purchase_cache = {}
+        # Historical purchase prices, like the historical summary
         agg = defaultdict(lambda: {'sold': Decimal('0'), 'profit': Decimal('0'), 'count': 0})
 
-        for it in items_qs.iterator():
-            sale_date = it.sale.created_at
-            agg[it.medicine.name]['sold'] += Decimal(str(it.subtotal))
-            agg[it.medicine.name]['count'] += 1
-
-            key = (it.medicine_id, sale_date.date())
-            if key in purchase_cache:
-                hist_price = purchase_cache[key]
-            else:
-                pi = PurchaseItem.objects.filter(medicine=it.medicine, purchase__date__date__lte=sale_date.date()).order_by('-purchase__date').first()
-                if pi:
-                    hist_price = Decimal(str(pi.price))
-                else:
-                    hist_price = Decimal(str(it.medicine.purchase_price or 0))
-                purchase_cache[key] = hist_price
-
-            if it.unit_type == 'STRIP':
-                spb = it.medicine.strips_per_box or 1
-                unit_cost_hist = (hist_price / Decimal(spb))
-            else:
-                unit_cost_hist = hist_price
-
-            unit_price = Decimal(str(it.price))
-            profit_hist = (unit_price - unit_cost_hist) * Decimal(it.quantity)
-            agg[it.medicine.name]['profit'] += profit_hist
+        for line in sale_lines(start, end):
+            data = agg[line.medicine_name]
+            data['sold'] += line.subtotal
+            data['count'] += 1
+            data['profit'] += line.profit
 
         # Prepare lists
         entries = [(name, data['sold'], data['profit'], data['count']) for name, data in agg.items()]
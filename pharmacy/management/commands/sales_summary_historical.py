@@ -3,7 +3,7 @@ from django.utils import timezone
 from decimal import Decimal
 import csv
 
-from pharmacy.models import SaleItem, PurchaseItem
+from pharmacy.historical_cost import sale_lines
 
 
 class Command(BaseCommand):
@@ -19,19 +19,16 @@ class Command(BaseCommand):
         to_date = options.get('to_date')
         csvfile = options.get('csvfile')
 
-        items_qs = SaleItem.objects.select_related('sale', 'medicine').filter(sale__is_completed=True)
-
+        start = end = None
         if from_date:
             try:
-                fd = timezone.datetime.strptime(from_date, '%Y-%m-%d')
-                items_qs = items_qs.filter(sale__created_at__date__gte=fd.date())
+                start = timezone.datetime.strptime(from_date, '%Y-%m-%d').date()
             except Exception as e:
                 self.stderr.write(self.style.ERROR(f'Invalid --from date: {e}'))
                 return
         if to_date:
             try:
-                td = timezone.datetime.strptime(to_date, '%Y-%m-%d')
-                items_qs = items_qs.filter(sale__created_at__date__lte=td.date())
+                end = timezone.datetime.strptime(to_date, '%Y-%m-%d').date()
             except Exception as e:
                 self.stderr.write(self.style.ERROR(f'Invalid --to date: {e}'))
                 return
@@ -50,55 +47,26 @@ class Command(BaseCommand):
                 'subtotal', 'profit_old', 'hist_purchase_price', 'unit_cost_hist', 'unit_profit_hist', 'profit_hist'
             ])
 
-        # simple cache for latest purchase price per medicine before a date to reduce DB hits
-        purchase_cache = {}
-
-        for it in items_qs.iterator():
-            sale_date = it.sale.created_at
-            total_sold += Decimal(str(it.subtotal))
-
-            # find historical purchase price: latest PurchaseItem.price where purchase.date <= sale_date
-            key = (it.medicine_id, sale_date.date())
-            hist_price = None
-            if key in purchase_cache:
-                hist_price = purchase_cache[key]
-            else:
-                pi = PurchaseItem.objects.filter(medicine=it.medicine, purchase__date__date__lte=sale_date.date()).order_by('-purchase__date').first()
-                if pi:
-                    hist_price = Decimal(str(pi.price))
-                else:
-                    # fallback to medicine current purchase_price
-                    hist_price = Decimal(str(it.medicine.purchase_price or 0))
-                purchase_cache[key] = hist_price
-
-            # compute unit cost based on unit_type
-            if it.unit_type == 'STRIP':
-                spb = it.medicine.strips_per_box or 1
-                unit_cost_hist = (hist_price / Decimal(spb))
-            else:
-                unit_cost_hist = hist_price
-
-            unit_price = Decimal(str(it.price))
-            unit_profit_hist = unit_price - unit_cost_hist
-            profit_hist = unit_profit_hist * Decimal(it.quantity)
-
-            total_profit += profit_hist
+        # Each line costed at the last purchase price on or before its sale day
+        for line in sale_lines(start, end):
+            total_sold += line.subtotal
+            total_profit += line.profit
             count += 1
 
             if csv_writer:
                 csv_writer.writerow([
-                    it.sale.id,
-                    it.sale.created_at.strftime('%Y-%m-%d %H:%M'),
-                    it.medicine.name,
-                    it.unit_type,
-                    it.quantity,
-                    f'{unit_price:.2f}',
-                    f'{Decimal(str(it.subtotal)):.2f}',
-                    f'{Decimal(str(it.profit)):.2f}',
-                    f'{hist_price:.2f}',
-                    f'{unit_cost_hist:.2f}',
-                    f'{unit_profit_hist:.2f}',
-                    f'{profit_hist:.2f}'
+                    line.sale_id,
+                    timezone.localtime(line.sale_created_at).strftime('%Y-%m-%d %H:%M'),
+                    line.medicine_name,
+                    line.unit_type,
+                    line.quantity,
+                    f'{line.price:.2f}',
+                    f'{line.subtotal:.2f}',
+                    f'{line.current_profit:.2f}',
+                    f'{line.hist_price:.2f}',
+                    f'{line.unit_cost:.2f}',
+                    f'{line.unit_profit:.2f}',
+                    f'{line.profit:.2f}'
                 ])
 
         if csv_handle:
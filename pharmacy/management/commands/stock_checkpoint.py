@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from pharmacy.stock_ledger import take_checkpoint
+
+
+class Command(BaseCommand):
+    help = ('Store what every stock lot holds now, so past inventory can be '
+            'rebuilt from the nearest checkpoint plus the stock movements (run nightly)')
+
+    def handle(self, *args, **options):
+        checkpoint = take_checkpoint()
+        self.stdout.write(self.style.SUCCESS(
+            f'Checkpoint {checkpoint.id} at {checkpoint.taken_at:%Y-%m-%d %H:%M} '
+            f'({checkpoint.lines.count()} lot(s))'
+        ))
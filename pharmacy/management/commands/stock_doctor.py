@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pharmacy.stock_doctor import CHECKS, run
+
+
+class Command(BaseCommand):
+    help = ('Check the stock entries for duplicates, negatives, box/strip mismatches, empty lots '
+            'and drifted Medicine counters (see pharmacy/stock_doctor.py)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true',
+                            help='Repair what is found, in one transaction')
+        parser.add_argument('--only', nargs='+', choices=CHECKS, default=list(CHECKS),
+                            help='Run only these checks')
+        parser.add_argument('--report', metavar='FILE',
+                            help="Write the report as JSON to FILE ('-' for stdout)")
+
+    def handle(self, *args, **options):
+        report = run(options['only'], fix=options['fix'])
+
+        if options['report'] == '-':
+            self.stdout.write(json.dumps(report, indent=2))
+        elif options['report']:
+            with open(options['report'], 'w', encoding='utf-8') as out:
+                json.dump(report, out, indent=2)
+
+        if options['report'] != '-':
+            self.stdout.write(f'Checked {report["lots"]} stock entries')
+            for check, result in report['checks'].items():
+                line = f'  {check}: {result["found"]} found'
+                if report['fixed'] is not None:
+                    line += f', {report["fixed"].get(check, 0)} fixed'
+                self.stdout.write(line)
+
+        found = sum(result['found'] for result in report['checks'].values())
+        if not found:
+            self.stdout.write(self.style.SUCCESS('No problems found'))
+        elif report['fixed'] is not None:
+            self.stdout.write(self.style.SUCCESS('Repaired'))
+        else:
+            raise CommandError(f'{found} problem(s) found; rerun with --fix')
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pharmacy', '0013_remove_guestprescriptionrequest_replied_by_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Cart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('customer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='pharmacy.customer')),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='pos_cart', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CartLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('unit_type', models.CharField(choices=[('BOX', 'Box'), ('STRIP', 'Strip')], default='BOX', max_length=5)),
+                ('expiration_date', models.DateField(blank=True, null=True)),
+                ('original_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('discounted_price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('cart', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='pharmacy.cart')),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='pharmacy.medicine')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
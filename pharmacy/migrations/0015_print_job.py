@@ -0,0 +1,38 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:26
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0014_pos_cart'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PrintJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('INVOICE', 'Invoice'), ('RAW', 'Raw TSPL')], max_length=10)),
+                ('title', models.CharField(blank=True, max_length=100)),
+                ('printer_name', models.CharField(blank=True, max_length=200)),
+                ('data', models.JSONField(blank=True, default=dict)),
+                ('payload', models.BinaryField(blank=True, null=True)),
+                ('dedupe_key', models.CharField(db_index=True, max_length=64)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('PRINTING', 'Printing'), ('DONE', 'Done'), ('FAILED', 'Failed')], default='PENDING', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=5)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('printed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='pharmacy_pr_status_15b577_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:39
+
+from django.db import migrations, models
+from django.db.models import F, Min, Q, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+
+def fill_counters(apps, schema_editor):
+    """Initial counters from the lots (same rules as stock_counters)."""
+    Medicine = apps.get_model('pharmacy', 'Medicine')
+    StockEntry = apps.get_model('pharmacy', 'StockEntry')
+    lots = StockEntry.objects.filter(expiration_date__gte=timezone.now().date())
+    totals = {
+        row['medicine_id']: row
+        for row in lots.values('medicine_id').annotate(
+            boxes=Coalesce(Sum('quantity'), 0),
+            strips=Coalesce(Sum(Coalesce('strips_remaining', F('quantity') * F('medicine__strips_per_box'))), 0),
+        )
+    }
+    nearest = dict(
+        lots.filter(Q(quantity__gt=0) | Q(strips_remaining__gt=0))
+        .values('medicine_id').annotate(first=Min('expiration_date')).values_list('medicine_id', 'first')
+    )
+    changed = []
+    for medicine in Medicine.objects.only('id', 'stock', 'strips_available', 'nearest_expiry').iterator():
+        row = totals.get(medicine.id)
+        medicine.stock = row['boxes'] if row else 0
+        medicine.strips_available = row['strips'] if row else 0
+        medicine.nearest_expiry = nearest.get(medicine.id)
+        changed.append(medicine)
+    Medicine.objects.bulk_update(changed, ['stock', 'strips_available', 'nearest_expiry'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0015_print_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medicine',
+            name='nearest_expiry',
+            field=models.DateField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='medicine',
+            name='strips_available',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def baseline_checkpoint(apps, schema_editor):
+    """The ledger starts from what the lots hold when it is installed."""
+    StockCheckpoint = apps.get_model('pharmacy', 'StockCheckpoint')
+    StockCheckpointLine = apps.get_model('pharmacy', 'StockCheckpointLine')
+    StockEntry = apps.get_model('pharmacy', 'StockEntry')
+    checkpoint = StockCheckpoint.objects.create(taken_at=django.utils.timezone.now())
+    lines = []
+    lots = StockEntry.objects.values_list(
+        'medicine_id', 'expiration_date', 'quantity', 'strips_remaining', 'medicine__strips_per_box',
+    )
+    for medicine_id, expiry, quantity, strips, strips_per_box in lots.iterator():
+        quantity = quantity or 0
+        strips = strips if strips is not None else quantity * strips_per_box
+        if quantity or strips:
+            lines.append(StockCheckpointLine(
+                checkpoint=checkpoint, medicine_id=medicine_id, expiration_date=expiry,
+                boxes=quantity, strips=strips,
+            ))
+    StockCheckpointLine.objects.bulk_create(lines, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0016_medicine_stock_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField(db_index=True)),
+            ],
+            options={
+                'ordering': ['-taken_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockCheckpointLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expiration_date', models.DateField()),
+                ('boxes', models.IntegerField()),
+                ('strips', models.IntegerField()),
+                ('checkpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='pharmacy.stockcheckpoint')),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pharmacy.medicine')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('expiration_date', models.DateField()),
+                ('boxes', models.IntegerField(help_text='Change in boxes (negative for stock going out)')),
+                ('strips', models.IntegerField(help_text='Change in strips')),
+                ('reason', models.CharField(choices=[('SALE', 'Sale'), ('RETURN', 'Return'), ('INTAKE', 'Stock intake'), ('PURCHASE', 'Purchase received'), ('EDIT', 'Manual edit'), ('WRITE_OFF', 'Expiry write-off')], max_length=10)),
+                ('reference', models.CharField(blank=True, max_length=50)),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='pharmacy.medicine')),
+            ],
+            options={
+                'ordering': ['created_at', 'id'],
+                'indexes': [models.Index(fields=['medicine', 'created_at'], name='pharmacy_st_medicin_3d9615_idx')],
+            },
+        ),
+        migrations.RunPython(baseline_checkpoint, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:50
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0017_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventorySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('taken_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('medicines_in_stock', models.IntegerField(default=0)),
+                ('boxes', models.IntegerField(default=0)),
+                ('strips', models.IntegerField(default=0, help_text='Loose strips (not making up a full box)')),
+                ('cost_value', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('selling_value', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('backfilled', models.BooleanField(default=False)),
+            ],
+            options={
+                'ordering': ['date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='InventorySnapshotLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('boxes', models.IntegerField()),
+                ('strips', models.IntegerField()),
+                ('cost_value', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('selling_value', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='pharmacy.medicine')),
+                ('snapshot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='pharmacy.inventorysnapshot')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['medicine', 'snapshot'], name='pharmacy_in_medicin_6ea431_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0018_inventory_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stockentry',
+            name='unit_cost',
+            field=models.DecimalField(blank=True, decimal_places=2, help_text='Purchase cost per box, averaged over the deliveries into this lot', max_digits=10, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:13
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0019_stockentry_unit_cost'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='saleitem',
+            name='lot',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sale_items', to='pharmacy.stockentry'),
+        ),
+        migrations.AddField(
+            model_name='saleitem',
+            name='unit_cost',
+            field=models.DecimalField(blank=True, decimal_places=4, max_digits=12, null=True),
+        ),
+    ]
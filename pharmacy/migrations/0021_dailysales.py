@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0020_saleitem_unit_cost_lot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('unit_type', models.CharField(choices=[('BOX', 'Box'), ('STRIP', 'Strip')], max_length=5)),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('cost', models.DecimalField(decimal_places=4, default=0, max_digits=14)),
+                ('medicine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='pharmacy.medicine')),
+            ],
+            options={
+                'verbose_name_plural': 'Daily sales',
+                'ordering': ['day', 'medicine'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dailysales',
+            constraint=models.UniqueConstraint(fields=('day', 'medicine', 'unit_type'), name='unique_daily_sales'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:18
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0021_dailysales'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profitanalytics',
+            name='date',
+            field=models.DateField(default=django.utils.timezone.localdate),
+        ),
+    ]
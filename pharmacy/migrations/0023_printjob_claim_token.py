@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0022_profitanalytics_date'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='printjob',
+            name='claim_token',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+    ]
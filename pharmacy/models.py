@@ -1,9 +1,5 @@
-from django.db import models
+from django.db import models, transaction
 from django.urls import reverse
-import barcode
-from barcode.writer import ImageWriter
-from io import BytesIO
-from django.core.files import File
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.contrib.auth.models import User
@@ -83,7 +79,8 @@ class Sale(models.Model):
     @property
     def total_profit(self):
         """Calculate total profit for this sale"""
-        return sum(item.profit for item in self.items.all())
+        from .sale_costs import profit_totals
+        return profit_totals(self.items.all())['profit']
 
     @property
     def profit_margin_percentage(self):
@@ -94,29 +91,18 @@ class Sale(models.Model):
         
     def get_profit_by_category(self):
         """Get profits broken down by medicine category"""
-        category_profits = {}
-        for item in self.items.all():
-            category = item.medicine.get_category_display()
-            if category not in category_profits:
-                category_profits[category] = 0
-            category_profits[category] += item.profit
-        return category_profits
+        from .sale_costs import profit_by
+        names = dict(Medicine.CATEGORY_CHOICES)
+        return {names.get(row['key'], row['key']): row['profit'] for row in profit_by(self.items.all(), 'category')}
 
 class Medicine(models.Model):
     @property
     def strips_in_stock(self):
         """
         Return total strips available (not expired) for this medicine, using strips_remaining if set.
+        Kept current by pharmacy.stock_counters, so reading it does not query.
         """
-        from django.utils import timezone
-        today = timezone.now().date()
-        total_strips = 0
-        for entry in self.stock_entries.filter(expiration_date__gte=today):
-            if entry.strips_remaining is not None:
-                total_strips += entry.strips_remaining
-            else:
-                total_strips += entry.quantity * self.strips_per_box
-        return total_strips
+        return self.strips_available
     CATEGORY_CHOICES = [
         ('OTC', 'Over The Counter'),
         ('PRE', 'Prescription'),
@@ -132,7 +118,11 @@ class Medicine(models.Model):
         decimal_places=2,
         help_text="Cost price of the product"
     )
+    # stock, strips_available and nearest_expiry summarize the non-expired
+    # StockEntry lots; they are maintained by pharmacy.stock_counters
     stock = models.IntegerField(default=0)
+    strips_available = models.IntegerField(default=0)
+    nearest_expiry = models.DateField(null=True, blank=True, db_index=True)
     category = models.CharField(max_length=3, choices=CATEGORY_CHOICES)
     image = models.ImageField(upload_to='medicines/', null=True, blank=True)
     barcode = models.ImageField(upload_to='barcodes/', blank=True)
@@ -176,30 +166,20 @@ class Medicine(models.Model):
 
         # Generate barcode if needed
         if not self.barcode_number:
-            import random
-            while True:
-                number = ''.join(random.choices('0123456789', k=12))
-                if not Medicine.objects.filter(barcode_number=number).exists():
-                    self.barcode_number = number
-                    break
+            from .barcodes import new_barcode_number
+            self.barcode_number = new_barcode_number()
         else:
             self.barcode_number = self.barcode_number.zfill(12)
+        # The barcode image is drawn when first shown (pharmacy.barcodes)
 
-        # Generate barcode image if needed
-        if not self.barcode:
-            try:
-                EAN = barcode.get_barcode_class('ean13')
-                ean = EAN(self.barcode_number)
-                buffer = BytesIO()
-                ean.write(buffer)
-                self.barcode.save(
-                    f'barcode_{self.barcode_number}.png',
-                    File(buffer),
-                    save=False
-                )
-            except Exception as e:
-                print(f"Error generating barcode: {e}")
-                pass
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # The stock counters are updated in place by stock_counters; a
+            # full save of an instance loaded earlier must not put old values back
+            from .stock_counters import COUNTER_FIELDS
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in COUNTER_FIELDS
+            ]
 
         super().save(*args, **kwargs)
 
@@ -239,12 +219,11 @@ class Medicine(models.Model):
         )['total'] or 0
     
     def update_stock(self, commit=True):
-        """Update stock based on non-expired stock entries"""
-        available = self.calculate_available_stock()
-        if self.stock != available:
-            self.stock = available
-            if commit:
-                self.save(update_fields=['stock'])
+        """Reload the stock counters (kept current by every StockEntry write)
+        and return the non-expired box count."""
+        from .stock_counters import COUNTER_FIELDS
+        if self.pk:
+            self.refresh_from_db(fields=list(COUNTER_FIELDS))
         return self.stock
 
     def validate_stock(self):
@@ -259,6 +238,10 @@ class StockEntry(models.Model):
     quantity = models.IntegerField()
     strips_remaining = models.IntegerField(null=True, blank=True, help_text="Actual strips remaining in this entry")
     expiration_date = models.DateField(null=False, blank=False)
+    unit_cost = models.DecimalField(
+        max_digits=10, decimal_places=2, null=True, blank=True,
+        help_text="Purchase cost per box, averaged over the deliveries into this lot"
+    )
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -270,9 +253,26 @@ class StockEntry(models.Model):
     def __str__(self):
         return f"{self.medicine.name} - {self.quantity} units (Expires: {self.expiration_date})"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if all(name in instance.__dict__ for name in ('medicine_id', 'quantity', 'strips_remaining', 'expiration_date')):
+            # What this row counts for in Medicine's counters, for the delta on save
+            from .stock_counters import remember_counted_state
+            remember_counted_state(instance)
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        if fields is None:
+            from .stock_counters import remember_counted_state
+            remember_counted_state(self)
+
     def save(self, *args, **kwargs):
         """Clamp negative quantities/strips to zero and log if found.
         This prevents negative stock values from being persisted.
+        The medicine's stock counters and the stock ledger are updated in the
+        same transaction.
         """
         logger = logging.getLogger(__name__)
         if self.quantity is None:
@@ -287,12 +287,109 @@ class StockEntry(models.Model):
             if self.strips_remaining < 0:
                 logger.warning(f'StockEntry {getattr(self, "id", "new")} had negative strips_remaining {self.strips_remaining}; clamping to 0')
                 self.strips_remaining = 0
-        super().save(*args, **kwargs)
+        # Views pass the date as a 'YYYY-MM-DD' string or a datetime at times
+        self.expiration_date = self._meta.get_field('expiration_date').to_python(self.expiration_date)
+        from .stock_counters import lot_changes, remember_counted_state
+        from .stock_ledger import lots_changed
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            lots_changed(lot_changes(self))
+        remember_counted_state(self)
 
     def clean(self):
         if self.expiration_date and self.expiration_date < timezone.now().date():
             raise ValidationError('Expiration date cannot be in the past')
 
+class StockMovement(models.Model):
+    """One change to one lot (medicine + expiration date), append-only.
+
+    Written next to every StockEntry change by pharmacy.stock_ledger, so
+    stock held at any past moment can be rebuilt from a StockCheckpoint plus
+    the movements after it (stock_ledger.inventory_at()).
+    """
+    SALE = 'SALE'
+    RETURN = 'RETURN'
+    INTAKE = 'INTAKE'
+    PURCHASE = 'PURCHASE'
+    EDIT = 'EDIT'
+    WRITE_OFF = 'WRITE_OFF'
+    REASON_CHOICES = [
+        (SALE, 'Sale'),
+        (RETURN, 'Return'),
+        (INTAKE, 'Stock intake'),
+        (PURCHASE, 'Purchase received'),
+        (EDIT, 'Manual edit'),
+        (WRITE_OFF, 'Expiry write-off'),
+    ]
+
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE, related_name='stock_movements')
+    expiration_date = models.DateField()
+    boxes = models.IntegerField(help_text="Change in boxes (negative for stock going out)")
+    strips = models.IntegerField(help_text="Change in strips")
+    reason = models.CharField(max_length=10, choices=REASON_CHOICES)
+    # e.g. "sale:12" or "purchase:5"
+    reference = models.CharField(max_length=50, blank=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [models.Index(fields=['medicine', 'created_at'])]
+
+    def __str__(self):
+        return f"{self.get_reason_display()} {self.boxes:+d} boxes / {self.strips:+d} strips of {self.medicine_id} ({self.expiration_date})"
+
+
+class StockCheckpoint(models.Model):
+    """Stock held in every lot at taken_at (see StockCheckpointLine)."""
+    taken_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        ordering = ['-taken_at']
+
+    def __str__(self):
+        return f"Stock checkpoint {self.taken_at:%Y-%m-%d %H:%M}"
+
+
+class StockCheckpointLine(models.Model):
+    checkpoint = models.ForeignKey(StockCheckpoint, on_delete=models.CASCADE, related_name='lines')
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE, related_name='+')
+    expiration_date = models.DateField()
+    boxes = models.IntegerField()
+    strips = models.IntegerField()
+
+
+class InventorySnapshot(models.Model):
+    """Sellable stock and its value at the end of one day (see
+    pharmacy.inventory_snapshots); one line per medicine in stock."""
+    date = models.DateField(unique=True)
+    taken_at = models.DateTimeField(default=timezone.now)
+    medicines_in_stock = models.IntegerField(default=0)
+    boxes = models.IntegerField(default=0)
+    strips = models.IntegerField(default=0, help_text="Loose strips (not making up a full box)")
+    cost_value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    selling_value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # Rebuilt afterwards from the stock history rather than taken that night
+    backfilled = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ['date']
+
+    def __str__(self):
+        return f"Inventory {self.date}: cost {self.cost_value}, selling {self.selling_value}"
+
+
+class InventorySnapshotLine(models.Model):
+    snapshot = models.ForeignKey(InventorySnapshot, on_delete=models.CASCADE, related_name='lines')
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE, related_name='+')
+    boxes = models.IntegerField()
+    strips = models.IntegerField()
+    cost_value = models.DecimalField(max_digits=12, decimal_places=2)
+    selling_value = models.DecimalField(max_digits=12, decimal_places=2)
+
+    class Meta:
+        indexes = [models.Index(fields=['medicine', 'snapshot'])]
+
+
 class SaleItem(models.Model):
     UNIT_CHOICES = [
         ('BOX', 'Box'),
@@ -309,6 +406,11 @@ class SaleItem(models.Model):
         choices=UNIT_CHOICES,
         default='BOX'
     )
+    # Cost of one unit sold (box or strip), recorded at sale time
+    unit_cost = models.DecimalField(max_digits=12, decimal_places=4, null=True, blank=True)
+    lot = models.ForeignKey(
+        'StockEntry', on_delete=models.SET_NULL, null=True, blank=True, related_name='sale_items'
+    )
 
     @property
     def discounted_price(self):
@@ -339,7 +441,10 @@ class SaleItem(models.Model):
         except Exception:
             sold_price = Decimal('0')
 
-        if self.unit_type == 'STRIP':
+        if self.unit_cost is not None:
+            # Cost recorded when the item was sold
+            unit_cost = Decimal(self.unit_cost)
+        elif self.unit_type == 'STRIP':
             # purchase cost per strip
             spb = self.medicine.strips_per_box or 1
             purchase_per_strip = (self.medicine.purchase_price or Decimal('0')) / Decimal(spb)
@@ -357,6 +462,127 @@ class SaleItem(models.Model):
             return (self.profit / self.subtotal) * 100
         return 0
 
+class DailySales(models.Model):
+    """Completed sales of one medicine on one (local) day, per unit type.
+
+    A rollup of SaleItem kept current by checkout and returns (see
+    pharmacy.sales_rollup), so the profit pages read a row per medicine per
+    day instead of every sale line.
+    """
+    day = models.DateField()
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE, related_name='daily_sales')
+    unit_type = models.CharField(max_length=5, choices=SaleItem.UNIT_CHOICES)
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    cost = models.DecimalField(max_digits=14, decimal_places=4, default=0)
+
+    class Meta:
+        ordering = ['day', 'medicine']
+        verbose_name_plural = "Daily sales"
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'medicine', 'unit_type'], name='unique_daily_sales')
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.medicine_id} {self.unit_type}: {self.quantity}"
+
+    @property
+    def profit(self):
+        return self.revenue - self.cost
+
+
+class Cart(models.Model):
+    """Open POS cart of one cashier (terminal).
+
+    Kept in the database rather than the session so every add/remove only
+    writes the affected CartLine row, and the cart survives a refresh or a
+    second tab on the same terminal.
+    """
+    user = models.OneToOneField('auth.User', on_delete=models.CASCADE, related_name='pos_cart')
+    customer = models.ForeignKey(Customer, on_delete=models.SET_NULL, null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Cart of {self.user}"
+
+
+class CartLine(models.Model):
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='lines')
+    medicine = models.ForeignKey(Medicine, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    unit_type = models.CharField(max_length=5, choices=SaleItem.UNIT_CHOICES, default='BOX')
+    # Lot the cashier picked; the sale still spills into later lots (FEFO)
+    expiration_date = models.DateField(null=True, blank=True)
+    original_price = models.DecimalField(max_digits=10, decimal_places=2)
+    discounted_price = models.DecimalField(max_digits=10, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+
+    @property
+    def name(self):
+        return self.medicine.name
+
+    @property
+    def total(self):
+        return self.discounted_price * self.quantity
+
+    def __str__(self):
+        return f"{self.quantity} {self.unit_type} x {self.medicine_id}"
+
+
+class PrintJob(models.Model):
+    """A job in the thermal printer queue (see pharmacy.print_spooler).
+
+    INVOICE jobs keep the completed-sale dict in data and are rendered by
+    the spooler worker; RAW jobs carry the printer bytes in payload.
+    """
+    INVOICE = 'INVOICE'
+    RAW = 'RAW'
+    KIND_CHOICES = [
+        (INVOICE, 'Invoice'),
+        (RAW, 'Raw TSPL'),
+    ]
+
+    PENDING = 'PENDING'
+    PRINTING = 'PRINTING'
+    DONE = 'DONE'
+    FAILED = 'FAILED'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (PRINTING, 'Printing'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    title = models.CharField(max_length=100, blank=True)
+    printer_name = models.CharField(max_length=200, blank=True)
+    data = models.JSONField(default=dict, blank=True)
+    payload = models.BinaryField(null=True, blank=True)
+    # Hash of kind/printer/data/payload: identical reprints share it
+    dedupe_key = models.CharField(max_length=64, db_index=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    # New on every claim: only the attempt holding it records the outcome
+    claim_token = models.CharField(max_length=32, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # While PRINTING, the lease: renewed by the worker sending the job
+    updated_at = models.DateTimeField(auto_now=True)
+    printed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f"{self.title or self.kind} ({self.status})"
+
+
 class UserProfile(models.Model):
     ROLE_CHOICES = [
         ('ADMIN', 'Administrator'),
@@ -487,7 +713,8 @@ class SearchHistory(models.Model):
         return f"{self.user.username} - {self.query}"
 
 class ProfitAnalytics(models.Model):
-    date = models.DateField(auto_now_add=True)
+    # Not auto_now_add, which stamped reports for past days with today
+    date = models.DateField(default=timezone.localdate)
     total_sales = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     total_cost = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     total_profit = models.DecimalField(max_digits=12, decimal_places=2, default=0)
@@ -530,34 +757,20 @@ class ProfitAnalytics(models.Model):
         total_sales = daily_totals['total_sales'] or 0
         number_of_sales = daily_totals['number_of_sales']
         
-        # Calculate total cost and profit
-        total_cost = 0
-        total_profit = 0
-        category_profits = {}
-        medicine_profits = {}
-        
-        for sale in sales:
-            for item in sale.items.all():
-                if item.unit_type == 'STRIP':
-                    cost = item.medicine.purchase_price / item.medicine.strips_per_box * item.quantity
-                else:
-                    cost = item.medicine.purchase_price * item.quantity
-                    
-                profit = item.profit
-                total_cost += cost
-                total_profit += profit
-                
-                # Track category profits
-                category = item.medicine.get_category_display()
-                category_profits[category] = category_profits.get(category, 0) + profit
-                
-                # Track individual medicine profits
-                medicine_id = item.medicine.id
-                medicine_profits[medicine_id] = medicine_profits.get(medicine_id, 0) + profit
-        
+        # Cost and profit summed in SQL, from the costs recorded on the items
+        from .sale_costs import profit_by, profit_totals
+        items = SaleItem.objects.filter(sale__in=sales)
+        totals = profit_totals(items)
+        total_cost = totals['cost']
+        total_profit = totals['profit']
+
         # Find most profitable category and medicine
-        most_profitable_category = max(category_profits.items(), key=lambda x: x[1])[0] if category_profits else ''
-        most_profitable_medicine_id = max(medicine_profits.items(), key=lambda x: x[1])[0] if medicine_profits else None
+        top_category = profit_by(items, 'category').order_by('-profit', 'key').first()
+        most_profitable_category = (
+            dict(Medicine.CATEGORY_CHOICES).get(top_category['key'], top_category['key']) if top_category else ''
+        )
+        top_medicine = profit_by(items, 'medicine').order_by('-profit', 'key').first()
+        most_profitable_medicine_id = top_medicine['key'] if top_medicine else None
         
         # Calculate averages
         average_profit = total_profit / number_of_sales if number_of_sales > 0 else 0
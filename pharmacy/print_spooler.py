@@ -0,0 +1,327 @@
+"""
+Thermal printer job queue.
+
+Checkout and invoice reprints used to render the receipt and push it through
+win32print inside the request, so a slow or jammed printer held up the till.
+Now they call enqueue_print_job(), which only inserts a PrintJob row and
+wakes the worker; the worker (a daemon thread in the web process, or
+`python manage.py print_spooler` on its own) renders and sends jobs in
+order, retrying failures with exponential backoff.
+
+A claimed job carries a fresh claim_token and a lease (its updated_at) that
+the worker renews while the transport is sending, however long that takes.
+requeue_stale_jobs() only takes back jobs whose lease ran out, i.e. whose
+worker died, and an attempt whose claim was taken back cannot record its
+outcome, so a slow printer does not print a job twice.
+
+Where the bytes go is decided by the transport in
+settings.PRINT_SPOOLER['TRANSPORT']: the Windows spooler in the shop, or a
+.prn file / raw TCP socket elsewhere.
+"""
+from datetime import timedelta
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from django.utils.text import slugify
+
+from .models import PrintJob
+
+logger = logging.getLogger(__name__)
+
+# Jobs whose lease was not renewed this long (worker died mid-job) are
+# picked up again
+STALE_PRINTING_SECONDS = 300
+# How often a worker renews the lease of the job it is sending
+LEASE_RENEW_SECONDS = 60
+
+
+def spooler_setting(name, default=None):
+    return getattr(settings, 'PRINT_SPOOLER', {}).get(name, default)
+
+
+class Win32Transport:
+    """Raw job through the Windows print spooler (the shop's USB printer)."""
+
+    def send(self, printer_name, title, payload):
+        import win32print
+
+        hprinter = win32print.OpenPrinter(printer_name)
+        try:
+            win32print.StartDocPrinter(hprinter, 1, (title, None, "RAW"))
+            try:
+                win32print.StartPagePrinter(hprinter)
+                win32print.WritePrinter(hprinter, payload)
+                win32print.EndPagePrinter(hprinter)
+            finally:
+                win32print.EndDocPrinter(hprinter)
+        finally:
+            win32print.ClosePrinter(hprinter)
+
+
+class FileTransport:
+    """Writes every job to its own .prn file; `copy /b file.prn PRINTER` or
+    `cat file.prn > /dev/usb/lp0` replays it on real hardware."""
+
+    def __init__(self, directory=None):
+        self.directory = str(directory or spooler_setting('FILE_DIR'))
+
+    def send(self, printer_name, title, payload):
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{timezone.now():%Y%m%d-%H%M%S}-{slugify(title) or 'job'}-{uuid.uuid4().hex[:6]}.prn"
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(payload)
+        return path
+
+
+class TcpTransport:
+    """Raw TSPL over a socket (network printers listen on port 9100)."""
+
+    def __init__(self, host=None, port=None, timeout=10):
+        self.host = host or spooler_setting('TCP_HOST', '127.0.0.1')
+        self.port = int(port or spooler_setting('TCP_PORT', 9100))
+        self.timeout = timeout
+
+    def send(self, printer_name, title, payload):
+        with socket.create_connection((self.host, self.port), timeout=self.timeout) as conn:
+            conn.sendall(payload)
+
+
+TRANSPORTS = {
+    'win32': Win32Transport,
+    'file': FileTransport,
+    'tcp': TcpTransport,
+}
+
+
+def get_transport():
+    name = spooler_setting('TRANSPORT', 'win32')
+    transport_class = TRANSPORTS.get(name) or import_string(name)
+    return transport_class()
+
+
+def dedupe_key_for(kind, printer_name, data, payload):
+    digest = hashlib.sha256()
+    digest.update(f"{kind}\0{printer_name}\0".encode())
+    digest.update(json.dumps(data, sort_keys=True, default=str).encode())
+    digest.update(b"\0" + (payload or b""))
+    return digest.hexdigest()
+
+
+def enqueue_print_job(kind, data=None, payload=None, title='', printer_name=None, dedupe=False):
+    """Queue a job and wake the worker; returns (job, created).
+
+    With dedupe=True an identical job that is still waiting, printing, or
+    was printed within DEDUPE_SECONDS is returned instead of a new one, so
+    a double-clicked reprint comes out once.
+    """
+    data = data or {}
+    printer_name = printer_name or settings.PRINTER_SETTINGS['PRINTER_PATH']
+    key = dedupe_key_for(kind, printer_name, data, payload)
+    if dedupe:
+        recent = timezone.now() - timedelta(seconds=spooler_setting('DEDUPE_SECONDS', 30))
+        existing = PrintJob.objects.filter(dedupe_key=key).filter(
+            Q(status__in=[PrintJob.PENDING, PrintJob.PRINTING])
+            | Q(status=PrintJob.DONE, printed_at__gte=recent)
+        ).order_by('-id').first()
+        if existing is not None:
+            return existing, False
+
+    job = PrintJob.objects.create(
+        kind=kind,
+        title=title[:100],
+        printer_name=printer_name,
+        data=data,
+        payload=payload,
+        dedupe_key=key,
+        max_attempts=spooler_setting('MAX_ATTEMPTS', 5),
+    )
+    transaction.on_commit(wake_worker)
+    return job, True
+
+
+def render_job(job):
+    """The bytes to send for job."""
+    if job.payload is not None:
+        return bytes(job.payload)
+    if job.kind == PrintJob.INVOICE:
+        from .receipts import render_invoice_tspl
+        return render_invoice_tspl(job.data)
+    raise ValueError(f'Nothing to print for {job.kind} job {job.id}')
+
+
+def retry_delay(attempts):
+    """Seconds to wait after the given number of failed attempts."""
+    base = spooler_setting('RETRY_BASE_SECONDS', 2)
+    return min(base * 2 ** (attempts - 1), spooler_setting('RETRY_MAX_SECONDS', 60))
+
+
+def claim_next_job():
+    """Mark the oldest due job PRINTING and return it (None if idle).
+
+    The claim is a conditional UPDATE, so two workers never take the same job.
+    """
+    now = timezone.now()
+    due = PrintJob.objects.filter(
+        status=PrintJob.PENDING, next_attempt_at__lte=now,
+    ).order_by('id').values_list('id', flat=True)[:10]
+    for job_id in due:
+        claimed = PrintJob.objects.filter(id=job_id, status=PrintJob.PENDING).update(
+            status=PrintJob.PRINTING, attempts=F('attempts') + 1, updated_at=now, claim_token=uuid.uuid4().hex,
+        )
+        if claimed:
+            return PrintJob.objects.get(id=job_id)
+    return None
+
+
+def claimed(job):
+    """The job's row, if this attempt's claim on it still holds."""
+    return PrintJob.objects.filter(id=job.id, status=PrintJob.PRINTING, claim_token=job.claim_token)
+
+
+class JobLease:
+    """Renews a claimed job's lease every LEASE_RENEW_SECONDS while the
+    block runs (in a thread, as the transport blocks)."""
+
+    def __init__(self, job, interval=None):
+        self.job = job
+        self.interval = interval or LEASE_RENEW_SECONDS
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._renew, name=f'print-lease-{job.id}', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._done.set()
+        self._thread.join()
+
+    def renew(self):
+        claimed(self.job).update(updated_at=timezone.now())
+
+    def _renew(self):
+        try:
+            while not self._done.wait(self.interval):
+                self.renew()
+        except Exception:
+            logger.exception(f"Could not renew the lease of print job {self.job.id}")
+        finally:
+            connection.close()
+
+
+def record_outcome(job, **fields):
+    """Save an attempt's outcome on job, unless its claim was taken back
+    (requeued as stale) meanwhile; returns whether it was saved."""
+    fields['updated_at'] = timezone.now()
+    if not claimed(job).update(**fields):
+        logger.warning(f"Print job {job.id} attempt {job.attempts} lost its claim; outcome not recorded")
+        return False
+    for name, value in fields.items():
+        setattr(job, name, value)
+    return True
+
+
+def run_job(job, transport=None):
+    """Render and send one claimed job, then record the outcome."""
+    try:
+        payload = render_job(job)
+        with JobLease(job):
+            (transport or get_transport()).send(job.printer_name, job.title or f"Job {job.id}", payload)
+    except Exception as e:
+        logger.warning(f"Print job {job.id} attempt {job.attempts} failed: {e}", exc_info=True)
+        if job.attempts >= job.max_attempts:
+            record_outcome(job, status=PrintJob.FAILED, last_error=str(e)[:1000])
+        else:
+            record_outcome(job, status=PrintJob.PENDING, last_error=str(e)[:1000],
+                           next_attempt_at=timezone.now() + timedelta(seconds=retry_delay(job.attempts)))
+        return False
+
+    record_outcome(job, status=PrintJob.DONE, printed_at=timezone.now(), last_error='')
+    return True
+
+
+def process_next_job(transport=None):
+    """Claim and run one due job; False when there was nothing to do."""
+    job = claim_next_job()
+    if job is None:
+        return False
+    run_job(job, transport)
+    return True
+
+
+def drain(transport=None):
+    """Run due jobs until none are left; returns how many were run."""
+    count = 0
+    while process_next_job(transport):
+        count += 1
+    return count
+
+
+def requeue_stale_jobs():
+    """Put back jobs a dead worker left in PRINTING: their lease ran out.
+    Clearing the claim keeps a late finish of that attempt from counting."""
+    cutoff = timezone.now() - timedelta(seconds=STALE_PRINTING_SECONDS)
+    return PrintJob.objects.filter(status=PrintJob.PRINTING, updated_at__lt=cutoff).update(
+        status=PrintJob.PENDING, next_attempt_at=timezone.now(), claim_token='',
+    )
+
+
+class SpoolerWorker(threading.Thread):
+    """Drains the queue, sleeping POLL_SECONDS (or until woken) when idle."""
+
+    def __init__(self, poll_seconds=None):
+        super().__init__(name='print-spooler', daemon=True)
+        self.poll_seconds = poll_seconds or spooler_setting('POLL_SECONDS', 2)
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        try:
+            requeue_stale_jobs()
+        except Exception:
+            logger.exception("Could not requeue stale print jobs")
+        while not self._stopping.is_set():
+            try:
+                worked = process_next_job()
+            except Exception:
+                logger.exception("Print spooler error")
+                worked = False
+            finally:
+                close_old_connections()
+            if not worked:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def wake_worker():
+    """Start the in-process worker if configured, and nudge it awake."""
+    global _worker
+    if spooler_setting('WORKER', 'thread') != 'thread':
+        return
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = SpoolerWorker()
+            _worker.start()
+    _worker.wake()
@@ -0,0 +1,166 @@
+"""
+ProfitAnalytics for a range of days in one pass.
+
+ProfitAnalytics.generate_daily_report() handles one day, so rebuilding a
+year took 365 runs of its queries. generate_range() reads the lines of
+every completed sale in the range with one streamed query, ordered by sale
+time and costed in SQL (pharmacy.sale_costs). It folds each day's totals,
+its top category and its top medicine as the lines go by. Days are written
+DAYS_PER_WRITE at a time, with bulk_update for days that already have a row
+and bulk_create for the rest, so memory stays flat however long the range.
+
+Every day of the range gets a row, including days without sales, as
+generate_daily_report() gives them. A day's sales total and count come from
+its sales that still have lines.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models.functions import TruncDate
+
+from .models import Medicine, ProfitAnalytics, SaleItem
+from .sale_costs import line_cost, line_profit
+
+# Days per bulk write
+DAYS_PER_WRITE = 100
+# Rows fetched per round trip of the stream
+STREAM_CHUNK = 2000
+
+FIELDS = (
+    'total_sales', 'total_cost', 'total_profit', 'profit_margin', 'number_of_sales', 'average_profit_per_sale',
+    'most_profitable_category', 'most_profitable_medicine_id',
+)
+
+CENT = Decimal('0.01')
+
+
+class DayTotals:
+    """Running totals of one day's sale lines."""
+
+    def __init__(self, day):
+        self.day = day
+        self.sales = 0
+        self.total_sales = Decimal(0)
+        self.total_cost = Decimal(0)
+        self.total_profit = Decimal(0)
+        self.categories = {}
+        self.medicines = {}
+        self._last_sale = None
+
+    def add(self, sale_id, total_amount, medicine_id, category, cost, profit):
+        # A sale's lines come one after the other
+        if sale_id != self._last_sale:
+            self._last_sale = sale_id
+            self.sales += 1
+            self.total_sales += Decimal(total_amount or 0)
+        self.total_cost += cost
+        self.total_profit += profit
+        self.categories[category] = self.categories.get(category, 0) + profit
+        self.medicines[medicine_id] = self.medicines.get(medicine_id, 0) + profit
+
+    @staticmethod
+    def _top(profits):
+        # Highest profit; the lowest key among ties, as generate_daily_report()
+        return min(profits.items(), key=lambda item: (-item[1], item[0]))[0] if profits else None
+
+    def values(self, category_names):
+        category = self._top(self.categories)
+        return {
+            'total_sales': self.total_sales.quantize(CENT),
+            'total_cost': self.total_cost.quantize(CENT),
+            'total_profit': self.total_profit.quantize(CENT),
+            'profit_margin': (self.total_profit / self.total_sales * 100).quantize(CENT) if self.total_sales > 0 else 0,
+            'number_of_sales': self.sales,
+            'average_profit_per_sale': (self.total_profit / self.sales).quantize(CENT) if self.sales else 0,
+            'most_profitable_category': category_names.get(category, category) if category else '',
+            'most_profitable_medicine_id': self._top(self.medicines),
+        }
+
+
+def stream_lines(start, end):
+    """(day, sale_id, total_amount, medicine_id, category, cost, profit) of
+    every line of the completed sales from start to end, in sale order."""
+    items = (
+        SaleItem.objects.filter(sale__is_completed=True, sale__created_at__date__range=(start, end))
+        .annotate(day=TruncDate('sale__created_at'), line_cost=line_cost(), line_profit=line_profit())
+        .order_by('sale__created_at', 'sale_id', 'id')
+        .values_list('day', 'sale_id', 'sale__total_amount', 'medicine_id', 'medicine__category',
+                     'line_cost', 'line_profit')
+    )
+    return items.iterator(chunk_size=STREAM_CHUNK)
+
+
+def _write(days, category_names):
+    """Save the DayTotals of consecutive days; returns (created, updated)."""
+    existing = {}
+    duplicates = []
+    for row in ProfitAnalytics.objects.filter(date__range=(days[0].day, days[-1].day)).order_by('date', 'id'):
+        if row.date in existing:
+            duplicates.append(row.pk)
+        else:
+            existing[row.date] = row
+    new = []
+    changed = []
+    for totals in days:
+        row = existing.get(totals.day)
+        if row is None:
+            row = ProfitAnalytics(date=totals.day)
+            new.append(row)
+        else:
+            changed.append(row)
+        for field, value in totals.values(category_names).items():
+            setattr(row, field, value)
+    with transaction.atomic():
+        if duplicates:
+            ProfitAnalytics.objects.filter(pk__in=duplicates).delete()
+        ProfitAnalytics.objects.bulk_create(new, batch_size=DAYS_PER_WRITE)
+        ProfitAnalytics.objects.bulk_update(changed, FIELDS, batch_size=DAYS_PER_WRITE)
+    return len(new), len(changed)
+
+
+def generate_range(start, end, progress=None):
+    """Generate or update the ProfitAnalytics of every day from start to end
+    (inclusive). progress(day) is called after each write. Returns
+    (created, updated)."""
+    category_names = dict(Medicine.CATEGORY_CHOICES)
+    created = updated = 0
+    pending = []
+    day = start
+
+    def flush():
+        nonlocal created, updated, pending
+        if pending:
+            new, changed = _write(pending, category_names)
+            created += new
+            updated += changed
+            if progress:
+                progress(pending[-1].day)
+            pending = []
+
+    def close_days_until(until):
+        # Days without sales before `until` still get their (empty) row
+        nonlocal day
+        while day < until:
+            pending.append(DayTotals(day))
+            day += timedelta(days=1)
+            if len(pending) >= DAYS_PER_WRITE:
+                flush()
+
+    current = None
+    for line_day, sale_id, total_amount, medicine_id, category, cost, profit in stream_lines(start, end):
+        if current is None or line_day != current.day:
+            if current is not None:
+                pending.append(current)
+                day = current.day + timedelta(days=1)
+                if len(pending) >= DAYS_PER_WRITE:
+                    flush()
+            close_days_until(line_day)
+            current = DayTotals(line_day)
+        current.add(sale_id, total_amount, medicine_id, category, cost, profit)
+    if current is not None:
+        pending.append(current)
+        day = current.day + timedelta(days=1)
+    close_days_until(end + timedelta(days=1))
+    flush()
+    return created, updated
@@ -0,0 +1,59 @@
+"""
+1-bit raster encoding for TSPL BITMAP commands.
+
+The printer's BITMAP data is one bit per dot, rows left to right, most
+significant bit first, each row padded to a whole byte. On this printer a
+0 bit prints (black) and a 1 bit is blank; pad bits must be blank, or the
+right edge of every row prints a black stripe.
+
+pack_bitmap() does the threshold and packing with Pillow's native
+convert()/tobytes() instead of visiting every pixel in Python (see
+scripts/benchmark_raster_packing.py). It has no Django dependency, so the
+standalone label scripts can import it too.
+"""
+from PIL import Image
+
+# _PAD_TABLES[n] sets the n low (pad) bits of a byte
+_PAD_TABLES = [bytes(value | ((1 << n) - 1) for value in range(256)) for n in range(8)]
+
+
+def _threshold_table(threshold):
+    # Darker than threshold prints; lighter stays blank
+    return [0 if value < threshold else 255 for value in range(256)]
+
+
+def pack_bitmap(image, threshold=128):
+    """Pack a PIL image into TSPL BITMAP bytes.
+
+    Pixels darker than threshold (in grayscale) print, the rest stay blank;
+    mode '1' images pack as drawn. Returns (bytes_per_row, height, data).
+    """
+    if image.mode == '1':
+        mono = image
+    else:
+        if image.mode != 'L':
+            image = image.convert('L')
+        if threshold == 128:
+            # Pillow's undithered conversion is exactly "< 128 is black"
+            mono = image.convert('1', dither=Image.Dither.NONE)
+        else:
+            mono = image.point(_threshold_table(threshold), '1')
+
+    width, height = mono.size
+    bytes_per_row = (width + 7) // 8
+    # Mode '1' packs white as 1 and black as 0: already the printer's polarity
+    data = mono.tobytes()
+    pad = bytes_per_row * 8 - width
+    if pad:
+        # Pillow pads rows with 0 (= printed); make the pad bits blank
+        data = bytearray(data)
+        last_bytes = slice(bytes_per_row - 1, None, bytes_per_row)
+        data[last_bytes] = data[last_bytes].translate(_PAD_TABLES[pad])
+        data = bytes(data)
+    return bytes_per_row, height, data
+
+
+def bitmap_command(image, x=0, y=0, mode=0, threshold=128):
+    """A complete 'BITMAP x,y,width,height,mode,<data>' command (no newline)."""
+    bytes_per_row, height, data = pack_bitmap(image, threshold)
+    return f"BITMAP {x},{y},{bytes_per_row},{height},{mode},".encode('ascii') + data
@@ -0,0 +1,102 @@
+"""
+Thermal receipt rendering.
+
+render_invoice_tspl() turns the completed-sale dict (the one pos_complete_sale
+keeps in request.session['completed_sale'] and invoice_print_old rebuilds for
+reprints) into the raw TSPL job for the receipt roll. It only needs that
+dict, so the print spooler can render in its worker instead of in the request.
+Fonts, shaping and the fixed header/footer are shared across receipts via
+pharmacy.render_context.
+"""
+from django.conf import settings
+
+from .raster import bitmap_command
+from .render_context import get_render_context
+
+
+def render_invoice_image(completed_sale):
+    """Draw the receipt as a grayscale ("L") image, one pixel per printer dot.
+
+    completed_sale carries 'id', 'created_at', 'items' (name, quantity,
+    unit_type, price, total) and the totals. The shop header and thank-you
+    footer come pre-drawn from the render context; only the rows between
+    them are drawn here.
+    """
+    context = get_render_context()
+    body_font = context.body_font
+    body_bold_font = context.body_bold_font
+    heading_font = context.heading_font
+
+    body = context.layout()
+    body.add(f"رقم الفاتورة: {completed_sale['id']}", body_font, "right")
+    body.add_space(4)
+    body.add(f"التاريخ: {completed_sale['created_at']}", body_font, "right")
+    if completed_sale.get('customer'):
+        body.add_space(4)
+        body.add(f"العميل: {completed_sale['customer']}", body_font, "right")
+    body.add_space(12)
+    body.add_rule()
+    body.add_space(14)
+
+    body.add_cols("الكمية", "السعر", "الإجمالي", body_bold_font)
+    body.add_rule()
+    body.add_space(10)
+
+    for item in completed_sale['items']:
+        body.add(item['name'][:28], body_bold_font, "right")
+        body.add_space(4)
+        body.add_cols(
+            f"{item['quantity']} {item['unit_type']}",
+            f"{item['price']:.2f}",
+            f"{item['total']:.2f}",
+            body_font,
+        )
+        body.add_space(14)
+
+    body.add_rule()
+    body.add_space(14)
+
+    body.add(f"الإجمالي: {completed_sale['original_total']:.2f} ج.م", body_font, "right")
+    if completed_sale.get('discount_amount'):
+        body.add_space(6)
+        body.add(f"الخصم: {completed_sale['discount_amount']:.2f} ج.م", body_font, "right")
+    body.add_space(8)
+    body.add(f"الصافي المطلوب: {completed_sale['total']:.2f} ج.م", heading_font, "right")
+    body.add_space(10)
+    body.add(f"المبلغ المدفوع: {completed_sale['cash_given']:.2f} ج.م", body_font, "right")
+    body.add_space(4)
+    body.add(f"الباقي: {completed_sale['change_return']:.2f} ج.م", body_font, "right")
+
+    return context.compose(body)
+
+
+def render_invoice_tspl(completed_sale):
+    """Render a sale invoice/receipt as a TSPL job for the continuous
+    (gap-less) roll in the same thermal printer used for barcode labels.
+
+    completed_sale carries 'id', 'created_at', 'items' (name, quantity,
+    unit_type, price, total) and the totals; returns the bytes to send.
+    """
+    image = render_invoice_image(completed_sale)
+    DPI = settings.PRINTER_SETTINGS['PRINTER_DPI']
+    MM_TO_INCH = 25.4
+    PAPER_WIDTH_MM = settings.PRINTER_SETTINGS.get('INVOICE_PAPER_WIDTH', 48)
+
+    # Print via a raw TSPL command stream instead of the Windows GDI print path.
+    # GDI printing goes through the driver's own saved page-size/sensor defaults
+    # (tuned for the die-cut barcode roll), so on the continuous invoice roll the
+    # printer kept hunting for a label gap that doesn't exist and fed a long
+    # stretch of paper before giving up. TSPL's "GAP 0 mm,0 mm" line tells the
+    # printer firmware directly, on every single job, "this stock has no gaps" —
+    # confirmed on the real printer to print cleanly with no extra feed.
+    height_mm = (image.height / DPI) * MM_TO_INCH
+    header = (
+        f"SIZE {PAPER_WIDTH_MM} mm, {height_mm:.1f} mm\r\n"
+        "GAP 0 mm, 0 mm\r\n"
+        "DENSITY 8\r\n"
+        "DIRECTION 0\r\n"
+        "REFERENCE 0,0\r\n"
+        "CLS\r\n"
+    ).encode("ascii")
+    footer = b"\r\nPRINT 1\r\n"
+    return header + bitmap_command(image) + footer
@@ -0,0 +1,215 @@
+"""
+Process-wide state for drawing receipts and labels.
+
+Every receipt and label used to open its TrueType fonts from disk, measure
+line heights and run arabic_reshaper/bidi over the same fixed strings
+("صيدلية الإسراء", the column headings, the thank-you footer) on each print.
+None of that changes between jobs, so it is done once per process here:
+
+* get_font() keeps each (weight, size) font open after the first load.
+* shaped() remembers the shaped form of recently drawn strings.
+* RenderContext holds the receipt fonts, their line heights and the receipt
+  header/footer drawn once as bitmaps, so a receipt only draws its
+  sale-specific middle section (see pharmacy.receipts).
+
+get_render_context() builds the context on first use and again only if the
+printer settings it was built from change.
+"""
+from functools import lru_cache
+import threading
+
+from django.conf import settings
+from PIL import Image, ImageDraw, ImageFont
+
+from .arabic_utils import shape_arabic
+
+MM_TO_INCH = 25.4
+
+FONT_PATHS = {
+    'regular': [
+        "C:\\Windows\\Fonts\\arial.ttf",
+        "C:\\Windows\\Fonts\\Tahoma.ttf",
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    ],
+    'bold': [
+        "C:\\Windows\\Fonts\\arialbd.ttf",
+        "C:\\Windows\\Fonts\\tahomabd.ttf",
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    ],
+}
+
+# Receipt layout (pixels at the printer's DPI)
+TITLE_SIZE = 26
+HEADING_SIZE = 20
+BODY_SIZE = 19
+LINE_GAP = 8
+TOP_MARGIN = 20
+BOTTOM_MARGIN = 10
+SIDE_MARGIN = 12
+
+
+@lru_cache(maxsize=None)
+def get_font(weight='regular', size=BODY_SIZE):
+    """The first available font of the given weight, loaded once per size."""
+    for path in FONT_PATHS[weight]:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            continue
+    return ImageFont.load_default()
+
+
+@lru_cache(maxsize=4096)
+def shaped(text):
+    """shape_arabic(str(text)), cached; safe no-op on plain numbers/ASCII."""
+    return shape_arabic(str(text))
+
+
+class ReceiptLayout:
+    """Collects receipt rows, then measures and draws them.
+
+    Rows are ("text", text, font, align), ("cols", (right, mid, left), font,
+    None), ("hr", None, None, thick) or ("space", px, None, None); text is
+    shaped when added.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        self.lines = []
+
+    def add(self, text, font, align="right"):
+        self.lines.append(("text", shaped(text), font, align))
+
+    def add_rule(self, thick=False):
+        self.lines.append(("hr", None, None, thick))
+
+    def add_space(self, px=6):
+        self.lines.append(("space", px, None, None))
+
+    def add_cols(self, right_text, mid_text, left_text, font):
+        self.lines.append(("cols", (shaped(right_text), shaped(mid_text), shaped(left_text)), font, None))
+
+    def height(self):
+        height_px = 0
+        for kind, text, font, align in self.lines:
+            if kind == "text" or kind == "cols":
+                height_px += self.context.line_height(font)
+            elif kind == "hr":
+                height_px += 10 if align else 6  # `align` slot doubles as `thick` for hr rows
+            elif kind == "space":
+                height_px += text
+        return height_px
+
+    def draw(self, draw, y):
+        """Draw the rows from y down; returns the y after the last row."""
+        width_px = self.context.width_px
+        for kind, text, font, align in self.lines:
+            if kind == "text":
+                if align == "center":
+                    draw.text((width_px // 2, y), text, font=font, fill=0, anchor="ma")
+                elif align == "right":
+                    draw.text((width_px - SIDE_MARGIN, y), text, font=font, fill=0, anchor="ra")
+                else:
+                    draw.text((SIDE_MARGIN, y), text, font=font, fill=0)
+                y += self.context.line_height(font)
+            elif kind == "cols":
+                right_text, mid_text, left_text = text
+                draw.text((width_px - SIDE_MARGIN, y), right_text, font=font, fill=0, anchor="ra")
+                draw.text((width_px // 2, y), mid_text, font=font, fill=0, anchor="ma")
+                draw.text((SIDE_MARGIN, y), left_text, font=font, fill=0, anchor="la")
+                y += self.context.line_height(font)
+            elif kind == "hr":
+                if align:
+                    draw.line([(SIDE_MARGIN, y + 2), (width_px - SIDE_MARGIN, y + 2)], fill=0, width=2)
+                    draw.line([(SIDE_MARGIN, y + 6), (width_px - SIDE_MARGIN, y + 6)], fill=0, width=1)
+                    y += 10
+                else:
+                    draw.line([(SIDE_MARGIN, y + 3), (width_px - SIDE_MARGIN, y + 3)], fill=0, width=1)
+                    y += 6
+            elif kind == "space":
+                y += text
+        return y
+
+    def render(self, top=0, bottom=0):
+        """The rows alone as an "L" image with top/bottom margins."""
+        image = Image.new("L", (self.context.width_px, top + self.height() + bottom), 255)
+        self.draw(ImageDraw.Draw(image), top)
+        return image
+
+
+class RenderContext:
+    """Fonts, line heights and fixed receipt blocks for one paper width."""
+
+    def __init__(self, dpi, paper_width_mm):
+        self.dpi = dpi
+        self.paper_width_mm = paper_width_mm
+        self.width_px = int(paper_width_mm / MM_TO_INCH * dpi)
+
+        self.title_font = get_font('bold', TITLE_SIZE)
+        self.heading_font = get_font('bold', HEADING_SIZE)
+        self.body_font = get_font('regular', BODY_SIZE)
+        self.body_bold_font = get_font('bold', BODY_SIZE)
+
+        self._line_heights = {}
+        for font in (self.title_font, self.heading_font, self.body_font, self.body_bold_font):
+            self.line_height(font)
+
+        self.header = self._render_header()
+        self.footer = self._render_footer()
+
+    def line_height(self, font):
+        if font not in self._line_heights:
+            bbox = font.getbbox("Aأيگ0")
+            self._line_heights[font] = (bbox[3] - bbox[1]) + LINE_GAP
+        return self._line_heights[font]
+
+    def layout(self):
+        return ReceiptLayout(self)
+
+    def _render_header(self):
+        header = self.layout()
+        header.add_space(16)
+        header.add("صيدلية الإسراء", self.title_font, "center")
+        header.add("فاتورة مبيعات", self.heading_font, "center")
+        header.add_space(12)
+        header.add_rule()
+        header.add_space(14)
+        return header.render(top=TOP_MARGIN)
+
+    def _render_footer(self):
+        footer = self.layout()
+        footer.add_space(14)
+        footer.add_rule(thick=True)
+        footer.add_space(20)
+        footer.add("شكراً لزيارتكم", self.heading_font, "center")
+        footer.add_space(4)
+        footer.add("نتمنى لكم دوام الصحة والعافية", self.body_font, "center")
+        footer.add_space(50)
+        return footer.render(bottom=BOTTOM_MARGIN)
+
+    def compose(self, body):
+        """Header + body (a ReceiptLayout) + footer as one "L" image."""
+        body_top = self.header.height
+        image = Image.new("L", (self.width_px, body_top + body.height() + self.footer.height), 255)
+        image.paste(self.header, (0, 0))
+        image.paste(self.footer, (0, image.height - self.footer.height))
+        body.draw(ImageDraw.Draw(image), body_top)
+        return image
+
+
+_context = None
+_context_lock = threading.Lock()
+
+
+def get_render_context():
+    """The process-wide RenderContext for the current printer settings."""
+    global _context
+    dpi = settings.PRINTER_SETTINGS['PRINTER_DPI']
+    paper_width_mm = settings.PRINTER_SETTINGS.get('INVOICE_PAPER_WIDTH', 48)
+    context = _context
+    if context is None or (context.dpi, context.paper_width_mm) != (dpi, paper_width_mm):
+        with _context_lock:
+            context = _context
+            if context is None or (context.dpi, context.paper_width_mm) != (dpi, paper_width_mm):
+                context = _context = RenderContext(dpi, paper_width_mm)
+    return context
@@ -0,0 +1,112 @@
+"""
+Cost of goods sold, recorded on each SaleItem.
+
+SaleItem.profit costed every line at the medicine's purchase_price of
+today, so each profit figure loaded the medicine of every line and changed
+whenever a price did. pos_complete_sale now records on each SaleItem the
+lot it was taken from and unit_cost, what one unit sold (a box or a strip)
+cost us: the lot's own cost when the delivery recorded one, otherwise the
+medicine's purchase price at the time. Lines sold before that are filled in
+from purchase history by `python manage.py backfill_sale_costs`.
+
+line_cost() and line_profit() are the same figures as SQL expressions over
+SaleItem, so totals are a SUM() in the database: profit_totals() for a set
+of lines, profit_by() per day, month, category or medicine, and
+sales_totals() for the profit page. A line without unit_cost falls back to
+today's purchase price, as SaleItem.profit does, with a
+Case(When(unit_type='STRIP', ...)) over purchase_price and strips_per_box.
+"""
+from decimal import Decimal
+
+from django.db.models import (
+    Case, Count, DateField, DecimalField, ExpressionWrapper, F, FloatField, OuterRef, Subquery, Sum, Value, When,
+)
+from django.db.models.functions import Cast, Coalesce, TruncDate, TruncMonth
+
+from .models import SaleItem
+
+# unit_cost is kept to four places, so strip costs stay exact to the piastre
+UNIT_COST_PLACES = Decimal('0.0001')
+MONEY = DecimalField(max_digits=14, decimal_places=4)
+
+
+def unit_cost(box_cost, unit_type, strips_per_box):
+    """Cost of one unit of unit_type, from the cost of a box."""
+    cost = Decimal(box_cost or 0)
+    if unit_type == 'STRIP':
+        cost = cost / (strips_per_box or 1)
+    return cost.quantize(UNIT_COST_PLACES)
+
+
+def lot_unit_cost(entry, unit_type):
+    """Cost of one unit sold from a StockEntry (with its medicine loaded)."""
+    box_cost = entry.unit_cost if entry.unit_cost is not None else entry.medicine.purchase_price
+    return unit_cost(box_cost, unit_type, entry.medicine.strips_per_box)
+
+
+def current_unit_cost():
+    """Today's purchase price of one unit sold, as SaleItem.profit computes it
+    for lines without unit_cost."""
+    return Case(
+        When(unit_type='STRIP', medicine__strips_per_box__gt=0,
+             # Cast, or SQLite divides a whole-pound price as an integer
+             then=Cast('medicine__purchase_price', FloatField()) / F('medicine__strips_per_box')),
+        default=F('medicine__purchase_price'),
+        output_field=MONEY,
+    )
+
+
+def line_revenue():
+    return ExpressionWrapper(F('price') * F('quantity'), output_field=MONEY)
+
+
+def line_cost():
+    return ExpressionWrapper(Coalesce(F('unit_cost'), current_unit_cost()) * F('quantity'), output_field=MONEY)
+
+
+def line_profit():
+    return ExpressionWrapper(line_revenue() - line_cost(), output_field=MONEY)
+
+
+def _total(expression):
+    return Coalesce(Sum(expression), Value(Decimal('0')), output_field=MONEY)
+
+
+def profit_totals(items):
+    """{'cost': ..., 'profit': ...} of a SaleItem queryset, in one query."""
+    return items.aggregate(cost=_total(line_cost()), profit=_total(line_profit()))
+
+
+# What profit_by() can group by
+GROUPS = {
+    'day': lambda: TruncDate('sale__created_at'),
+    'month': lambda: TruncMonth('sale__created_at', output_field=DateField()),
+    'category': lambda: F('medicine__category'),
+    'medicine': lambda: F('medicine_id'),
+}
+
+
+def profit_by(items, group):
+    """Rows of {'key', 'units', 'revenue', 'cost', 'profit'} of a SaleItem
+    queryset per day, month (first day of the month), category or medicine
+    id, in one GROUP BY query ordered by key. Days and months are local."""
+    return (
+        items.annotate(key=GROUPS[group]()).values('key')
+        .annotate(units=Sum('quantity'), revenue=_total(line_revenue()), cost=_total(line_cost()),
+                  profit=_total(line_profit()))
+        .order_by('key')
+    )
+
+
+def sales_totals(sales):
+    """{'revenue', 'profit', 'sales'} of a Sale queryset in one query: revenue
+    is what the sales took (total_amount), profit the sum of their lines'."""
+    sale_profit = (
+        SaleItem.objects.filter(sale=OuterRef('pk')).order_by().values('sale')
+        .annotate(profit=Sum(line_profit())).values('profit')
+    )
+    return sales.aggregate(
+        revenue=_total('total_amount'),
+        profit=_total(Subquery(sale_profit, output_field=MONEY)),
+        sales=Count('pk'),
+    )
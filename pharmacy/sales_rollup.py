@@ -0,0 +1,146 @@
+"""
+Daily sales rollup.
+
+The profit analytics page read ProfitAnalytics rows that
+generate_daily_analytics wrote once a night from every sale and item of the
+day, so it was always a day behind. DailySales keeps, per local day,
+medicine and unit type, the quantity sold, the revenue (price * quantity of
+the lines) and the cost of goods (pharmacy.sale_costs). pos_complete_sale
+adds its lines with items_sold() and return_product takes the returned line
+out with items_returned(), inside their transactions, as one
+
+    INSERT ... ON CONFLICT(day, medicine_id, unit_type)
+    DO UPDATE SET quantity = quantity + excluded.quantity, ...
+
+per batch, so reading any range costs the same whatever the sales volume.
+
+rebuild() regenerates a range of days from SaleItem with one grouped query,
+for history from before the rollup and after changing past lines
+(`python manage.py rebuild_sales_rollup --from ... --to ...`).
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import DailySales, SaleItem
+from .sale_costs import line_cost, line_revenue
+
+# Rows per INSERT (6 parameters each, under SQLite's 999-variable limit)
+BATCH_SIZE = 160
+# Rows per bulk_create when rebuilding
+REBUILD_BATCH = 500
+
+
+def line_delta(item):
+    """((day, medicine_id, unit_type), quantity, revenue, cost) of a SaleItem
+    (with its sale loaded)."""
+    quantity = item.quantity or 0
+    revenue = Decimal(item.price or 0) * quantity
+    if item.unit_cost is not None:
+        cost = Decimal(item.unit_cost) * quantity
+    else:
+        # Costed as SaleItem.profit costs it
+        cost = revenue - item.profit
+    day = timezone.localtime(item.sale.created_at).date()
+    return (day, item.medicine_id, item.unit_type), quantity, revenue, cost
+
+
+def upsert_sql(rows):
+    table = connection.ops.quote_name(DailySales._meta.db_table)
+    values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * rows)
+    return (
+        f"INSERT INTO {table} (day, medicine_id, unit_type, quantity, revenue, cost) "
+        f"VALUES {values} "
+        f"ON CONFLICT(day, medicine_id, unit_type) DO UPDATE SET "
+        f"quantity = {table}.quantity + excluded.quantity, "
+        f"revenue = {table}.revenue + excluded.revenue, "
+        f"cost = {table}.cost + excluded.cost"
+    )
+
+
+def apply_deltas(deltas, batch_size=BATCH_SIZE):
+    """Add {(day, medicine_id, unit_type): (quantity, revenue, cost)} to the
+    rollup, creating missing rows."""
+    rows = [key + tuple(delta) for key, delta in deltas.items() if any(delta)]
+    if not rows:
+        return
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            params = []
+            for day, medicine_id, unit_type, quantity, revenue, cost in batch:
+                params += [
+                    connection.ops.adapt_datefield_value(day),
+                    medicine_id,
+                    unit_type,
+                    quantity,
+                    connection.ops.adapt_decimalfield_value(revenue, 14, 2),
+                    connection.ops.adapt_decimalfield_value(cost, 14, 4),
+                ]
+            cursor.execute(upsert_sql(len(batch)), params)
+
+
+def _add_items(items, sign):
+    deltas = defaultdict(lambda: [0, Decimal(0), Decimal(0)])
+    for item in items:
+        key, quantity, revenue, cost = line_delta(item)
+        delta = deltas[key]
+        delta[0] += sign * quantity
+        delta[1] += sign * revenue
+        delta[2] += sign * cost
+    apply_deltas(deltas)
+
+
+def items_sold(items):
+    """Add the SaleItems of a completed sale to the rollup."""
+    _add_items(items, 1)
+
+
+def items_returned(items):
+    """Take returned SaleItems (not yet deleted) out of the rollup."""
+    _add_items(items, -1)
+
+
+def rebuild(start=None, end=None):
+    """Regenerate the rollup of the days from start to end (local dates, both
+    optional) from the completed sales' lines. Returns the rows written."""
+    days = DailySales.objects.all()
+    items = SaleItem.objects.filter(sale__is_completed=True)
+    if start is not None:
+        days = days.filter(day__gte=start)
+        items = items.filter(sale__created_at__date__gte=start)
+    if end is not None:
+        days = days.filter(day__lte=end)
+        items = items.filter(sale__created_at__date__lte=end)
+    groups = (
+        items.annotate(day=TruncDate('sale__created_at'))
+        .values('day', 'medicine_id', 'unit_type')
+        .annotate(units=Sum('quantity'), revenue=Sum(line_revenue()), cost=Sum(line_cost()))
+        .order_by()
+    )
+    written = 0
+    with transaction.atomic():
+        days.delete()
+        batch = []
+        for group in groups.iterator(chunk_size=2000):
+            batch.append(DailySales(
+                day=group['day'], medicine_id=group['medicine_id'], unit_type=group['unit_type'],
+                quantity=group['units'], revenue=group['revenue'], cost=group['cost'],
+            ))
+            if len(batch) >= REBUILD_BATCH:
+                written += len(DailySales.objects.bulk_create(batch))
+                batch = []
+        written += len(DailySales.objects.bulk_create(batch))
+    return written
+
+
+def profit_by_day(rows):
+    """[{'day', 'revenue', 'cost', 'profit'}] of a DailySales queryset, by day."""
+    return list(
+        rows.values('day').annotate(revenue=Sum('revenue'), cost=Sum('cost'))
+        .annotate(profit=F('revenue') - F('cost')).order_by('day')
+    )
@@ -1,7 +1,10 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile
+from .models import UserProfile, Medicine, StockEntry
+from .barcode_lookup import invalidate_medicines
+from .stock_counters import lot_changes
+from .stock_ledger import lots_changed
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -16,4 +19,22 @@ def create_user_profile(sender, instance, created, **kwargs):
 def save_user_profile(sender, instance, **kwargs):
     # Only update existing profile, don't create new one
     if hasattr(instance, 'userprofile'):
-        instance.userprofile.save()
\ No newline at end of file
+        instance.userprofile.save()
+
+@receiver(post_save, sender=Medicine)
+@receiver(post_delete, sender=Medicine)
+def invalidate_medicine_lookup(sender, instance, **kwargs):
+    invalidate_medicines([instance.pk])
+
+@receiver(post_save, sender=StockEntry)
+@receiver(post_delete, sender=StockEntry)
+def invalidate_stock_entry_lookup(sender, instance, **kwargs):
+    invalidate_medicines([instance.medicine_id])
+
+@receiver(post_delete, sender=StockEntry)
+def record_stock_entry_delete(sender, instance, origin=None, **kwargs):
+    # Queryset and cascade deletes come through here too (inside their
+    # transaction); lots going away with their Medicine take its history along
+    if isinstance(origin, Medicine) or getattr(origin, 'model', None) is Medicine:
+        return
+    lots_changed(lot_changes(instance, deleted=True))
@@ -0,0 +1,245 @@
+"""
+Denormalized stock counters on Medicine.
+
+Medicine.stock (sellable boxes), Medicine.strips_available and
+Medicine.nearest_expiry summarize the medicine's non-expired StockEntry
+lots. They used to be recomputed with a SUM over the lots after every
+change (Medicine.update_stock()) and strips_in_stock looped over the lots on
+every access. Now every lot write applies its difference to the counters in
+the same transaction:
+
+* StockEntry.save() and the post_delete receiver in pharmacy.signals call
+  apply_lot_changes() for single rows;
+* bulk writers (LotBook.save() at checkout, stock_intake.intake_lots() for
+  deliveries) pass all their lots at once, so a whole sale or delivery is
+  one UPDATE of the medicines involved (a few for a large import).
+
+A lot stops counting the day after it expires. Nothing writes on that day,
+so rollover_expired() (the nightly `python manage.py reconcile_stock
+--rollover`) recomputes the medicines whose nearest_expiry has passed, and
+`python manage.py reconcile_stock` compares every counter with a full
+recompute (--fix rewrites the ones that drifted).
+"""
+from collections import defaultdict, namedtuple
+
+from django.db.models import Case, F, IntegerField, Min, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .barcode_lookup import invalidate_medicines
+from .models import Medicine, StockEntry
+
+COUNTER_FIELDS = ('stock', 'strips_available', 'nearest_expiry')
+
+# (medicine_id, expiry_before, units_before, expiry_after, units_after);
+# units are the lot's physical (boxes, strips), expired or not
+LotChange = namedtuple('LotChange', 'medicine_id old_expiry old_units new_expiry new_units')
+
+NOTHING = (0, 0)
+
+# Medicines per counter UPDATE (bounds the IN lists)
+UPDATE_BATCH = 500
+
+
+def lot_units(quantity, strips_remaining, strips_per_box):
+    """(boxes, strips) held in a lot; strips fall back to quantity *
+    strips_per_box on old rows."""
+    quantity = quantity or 0
+    strips = strips_remaining if strips_remaining is not None else quantity * strips_per_box
+    return quantity, strips
+
+
+def counted_units(units, expiration_date, today):
+    """What a lot holding units adds to its medicine's counters: nothing
+    once expired."""
+    if expiration_date is None or expiration_date < today:
+        return NOTHING
+    return units
+
+
+def lot_changes(entry, deleted=False):
+    """The LotChanges for entry since it was loaded (or created/deleted).
+
+    StockEntry.from_db() keeps the loaded values in entry._counted_state.
+    """
+    state = getattr(entry, '_counted_state', None)
+    strips_per_box = None
+
+    def units(quantity, strips_remaining):
+        nonlocal strips_per_box
+        if strips_remaining is None and strips_per_box is None:
+            strips_per_box = entry.medicine.strips_per_box
+        return lot_units(quantity, strips_remaining, strips_per_box)
+
+    if deleted:
+        # The row as it was read before the delete
+        values = state or (entry.medicine_id, entry.quantity, entry.strips_remaining, entry.expiration_date)
+        medicine_id, quantity, strips, expiry = values
+        return [LotChange(medicine_id, expiry, units(quantity, strips), None, NOTHING)]
+
+    new_units = units(entry.quantity, entry.strips_remaining)
+    if state is None:
+        return [LotChange(entry.medicine_id, None, NOTHING, entry.expiration_date, new_units)]
+    medicine_id, quantity, strips, expiry = state
+    old_units = units(quantity, strips)
+    if medicine_id != entry.medicine_id:
+        return [
+            LotChange(medicine_id, expiry, old_units, None, NOTHING),
+            LotChange(entry.medicine_id, None, NOTHING, entry.expiration_date, new_units),
+        ]
+    return [LotChange(medicine_id, expiry, old_units, entry.expiration_date, new_units)]
+
+
+def remember_counted_state(entry):
+    entry._counted_state = (entry.medicine_id, entry.quantity, entry.strips_remaining, entry.expiration_date)
+
+
+def _counts(units):
+    return units[0] > 0 or units[1] > 0
+
+
+def nearest_expiry_subquery(today):
+    return Subquery(
+        StockEntry.objects.filter(medicine_id=OuterRef('pk'), expiration_date__gte=today)
+        .filter(Q(quantity__gt=0) | Q(strips_remaining__gt=0))
+        .order_by('expiration_date').values('expiration_date')[:1]
+    )
+
+
+def _grouped(pairs):
+    """{value: [medicine_id, ...]} from (medicine_id, value) pairs."""
+    groups = defaultdict(list)
+    for medicine_id, value in pairs:
+        groups[value].append(medicine_id)
+    return groups
+
+
+def apply_lot_changes(changes, today=None):
+    """Apply LotChanges to the Medicine counters.
+
+    One UPDATE (per UPDATE_BATCH medicines) adds the box/strip differences
+    and moves nearest_expiry earlier where a lot gained stock; a second one (only when needed)
+    re-reads nearest_expiry for medicines whose nearest lot was emptied or
+    moved. Call inside the transaction that wrote the lots.
+    """
+    today = today or timezone.now().date()
+    deltas = defaultdict(lambda: [0, 0])
+    earliest = {}
+    recheck = set()
+    for change in changes:
+        old_units = counted_units(change.old_units, change.old_expiry, today)
+        new_units = counted_units(change.new_units, change.new_expiry, today)
+        delta = deltas[change.medicine_id]
+        delta[0] += new_units[0] - old_units[0]
+        delta[1] += new_units[1] - old_units[1]
+        if _counts(new_units):
+            current = earliest.get(change.medicine_id)
+            if current is None or change.new_expiry < current:
+                earliest[change.medicine_id] = change.new_expiry
+        if _counts(old_units) and (change.old_expiry != change.new_expiry or not _counts(new_units)):
+            recheck.add(change.medicine_id)
+
+    deltas = {medicine_id: delta for medicine_id, delta in deltas.items() if delta != [0, 0]}
+    changed = sorted(set(deltas) | set(earliest))
+    for start in range(0, len(changed), UPDATE_BATCH):
+        batch = changed[start:start + UPDATE_BATCH]
+        updates = {}
+        # One WHEN per distinct value, not per medicine: a delivery's
+        # quantities and expiry dates repeat a lot
+        box_deltas = _grouped((medicine_id, deltas[medicine_id][0]) for medicine_id in batch if medicine_id in deltas)
+        strip_deltas = _grouped((medicine_id, deltas[medicine_id][1]) for medicine_id in batch if medicine_id in deltas)
+        expiries = _grouped((medicine_id, earliest[medicine_id]) for medicine_id in batch if medicine_id in earliest)
+        if box_deltas or strip_deltas:
+            updates['stock'] = F('stock') + Case(
+                *(When(pk__in=ids, then=Value(delta)) for delta, ids in box_deltas.items()),
+                default=Value(0), output_field=IntegerField(),
+            )
+            updates['strips_available'] = F('strips_available') + Case(
+                *(When(pk__in=ids, then=Value(delta)) for delta, ids in strip_deltas.items()),
+                default=Value(0), output_field=IntegerField(),
+            )
+        if expiries:
+            updates['nearest_expiry'] = Case(
+                *(When(Q(pk__in=ids) & (Q(nearest_expiry__isnull=True) | Q(nearest_expiry__gt=expiry)),
+                       then=Value(expiry))
+                  for expiry, ids in expiries.items()),
+                default=F('nearest_expiry'),
+            )
+        Medicine.objects.filter(pk__in=batch).update(**updates)
+    if recheck:
+        Medicine.objects.filter(pk__in=recheck).update(nearest_expiry=nearest_expiry_subquery(today))
+
+    touched = set(deltas) | set(earliest) | recheck
+    if touched:
+        invalidate_medicines(touched)
+    return touched
+
+
+def recomputed_counters(medicine_ids=None, today=None):
+    """{medicine_id: (boxes, strips, nearest_expiry)} from the lots, in one
+    grouped query (medicines without sellable lots are left out)."""
+    today = today or timezone.now().date()
+    lots = StockEntry.objects.filter(expiration_date__gte=today)
+    if medicine_ids is not None:
+        lots = lots.filter(medicine_id__in=medicine_ids)
+    rows = lots.values('medicine_id').annotate(
+        boxes=Coalesce(Sum('quantity'), 0),
+        strips=Coalesce(Sum(Coalesce('strips_remaining', F('quantity') * F('medicine__strips_per_box'))), 0),
+    )
+    nearest = dict(
+        lots.filter(Q(quantity__gt=0) | Q(strips_remaining__gt=0))
+        .values('medicine_id').annotate(first=Min('expiration_date')).values_list('medicine_id', 'first')
+    )
+    return {
+        row['medicine_id']: (row['boxes'], row['strips'], nearest.get(row['medicine_id']))
+        for row in rows
+    }
+
+
+def find_drift(medicine_ids=None, today=None):
+    """[(medicine, stored (stock, strips, nearest), recomputed)] for every
+    medicine whose counters disagree with its lots."""
+    expected = recomputed_counters(medicine_ids, today)
+    medicines = Medicine.objects.only('id', 'name', *COUNTER_FIELDS)
+    if medicine_ids is not None:
+        medicines = medicines.filter(pk__in=medicine_ids)
+    drift = []
+    for medicine in medicines.iterator(chunk_size=2000):
+        stored = (medicine.stock, medicine.strips_available, medicine.nearest_expiry)
+        wanted = expected.get(medicine.id, (0, 0, None))
+        if stored != wanted:
+            drift.append((medicine, stored, wanted))
+    return drift
+
+
+def rewrite_counters(drift):
+    """Store the recomputed values for the medicines find_drift() returned."""
+    wanted = {medicine.id: values for medicine, _, values in drift}
+    medicine_ids = sorted(wanted)
+    for start in range(0, len(medicine_ids), UPDATE_BATCH):
+        batch = medicine_ids[start:start + UPDATE_BATCH]
+        updates = {}
+        for position, field in enumerate(COUNTER_FIELDS):
+            groups = _grouped((medicine_id, wanted[medicine_id][position]) for medicine_id in batch)
+            updates[field] = Case(
+                *(When(pk__in=ids, then=Value(value)) for value, ids in groups.items()),
+                default=F(field), output_field=Medicine._meta.get_field(field),
+            )
+        Medicine.objects.filter(pk__in=batch).update(**updates)
+    if medicine_ids:
+        invalidate_medicines(medicine_ids)
+    return len(medicine_ids)
+
+
+def rollover_expired(today=None):
+    """Take lots that expired since the last run out of the counters.
+
+    Only medicines whose nearest_expiry is before today can have counted a
+    lot that has since expired, so only those are recomputed. Returns how
+    many medicines changed.
+    """
+    today = today or timezone.now().date()
+    stale = list(Medicine.objects.filter(nearest_expiry__lt=today).values_list('id', flat=True))
+    if not stale:
+        return 0
+    return rewrite_counters(find_drift(stale, today))
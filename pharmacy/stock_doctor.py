@@ -0,0 +1,218 @@
+"""
+Stock integrity checks and repairs (`python manage.py stock_doctor`).
+
+dedupe_stockentries, fix_negative_stock and cleanup_empty_stock each
+walked the lots one by one and saved or deleted them a row at a time.
+examine() finds every kind of damage with one aggregate query per check:
+
+* duplicates: more than one lot for the same medicine and expiry date;
+* negative: a lot with negative boxes or strips;
+* strips: a lot whose boxes disagree with its strips (strips are what sales
+  count down, so boxes are strips // strips_per_box);
+* empty: a lot holding nothing;
+* counters: Medicine stock counters that disagree with the lots
+  (pharmacy.stock_counters.find_drift()).
+
+repair() fixes them in that order with a handful of UPDATE and DELETE
+statements in one transaction. The lots it changed are read before and
+after, and the differences go through stock_ledger.lots_changed() like any
+other stock write, so the counters and the ledger stay exact.
+"""
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import Count, Exists, F, Min, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Medicine, SaleItem, StockEntry, StockMovement
+from .stock_counters import NOTHING, LotChange, find_drift, lot_units, rewrite_counters
+from .stock_ledger import lots_changed, movement_reason
+
+CHECKS = ('duplicates', 'negative', 'strips', 'empty', 'counters')
+
+# Ids (or keys) listed per check in the report
+SAMPLE_SIZE = 20
+# Medicines per IN (...) when reading lots back
+READ_BATCH = 500
+
+
+def duplicate_q():
+    """Lots that share their medicine and expiry date with another lot."""
+    return Q(Exists(
+        StockEntry.objects.filter(medicine_id=OuterRef('medicine_id'), expiration_date=OuterRef('expiration_date'))
+        .exclude(pk=OuterRef('pk'))
+    ))
+
+
+def surplus_duplicate_q():
+    """Duplicate lots other than the first (lowest id) of their group."""
+    return Q(Exists(
+        StockEntry.objects.filter(medicine_id=OuterRef('medicine_id'), expiration_date=OuterRef('expiration_date'),
+                                  pk__lt=OuterRef('pk'))
+    ))
+
+
+def negative_q():
+    return Q(quantity__lt=0) | Q(strips_remaining__lt=0)
+
+
+def strips_q():
+    return (
+        Q(strips_remaining__isnull=False, medicine__strips_per_box__gt=0)
+        & ~Q(quantity=F('strips_remaining') / F('medicine__strips_per_box'))
+    )
+
+
+def empty_q():
+    return Q(quantity__lte=0) & (Q(strips_remaining__isnull=True) | Q(strips_remaining__lte=0))
+
+
+def _found(queryset):
+    return {
+        'found': queryset.count(),
+        'sample': list(queryset.order_by('pk').values_list('pk', flat=True)[:SAMPLE_SIZE]),
+    }
+
+
+def examine(checks=CHECKS):
+    """{check: {'found': n, 'sample': [...]}} for the checks asked for."""
+    report = {}
+    lots = StockEntry.objects.all()
+    if 'duplicates' in checks:
+        groups = (
+            lots.values('medicine_id', 'expiration_date').annotate(rows=Count('id')).filter(rows__gt=1)
+            .order_by('medicine_id', 'expiration_date')
+        )
+        report['duplicates'] = {
+            'found': groups.aggregate(surplus=Coalesce(Sum(F('rows') - 1), 0))['surplus'],
+            'sample': [
+                [group['medicine_id'], str(group['expiration_date']), group['rows']]
+                for group in groups[:SAMPLE_SIZE]
+            ],
+        }
+    if 'negative' in checks:
+        report['negative'] = _found(lots.filter(negative_q()))
+    if 'strips' in checks:
+        report['strips'] = _found(lots.filter(strips_q()))
+    if 'empty' in checks:
+        report['empty'] = _found(lots.filter(empty_q()))
+    if 'counters' in checks:
+        drift = find_drift()
+        report['counters'] = {
+            'found': len(drift),
+            'sample': [
+                [medicine.id, list(map(str, stored)), list(map(str, wanted))]
+                for medicine, stored, wanted in drift[:SAMPLE_SIZE]
+            ],
+        }
+    return report
+
+
+def raw_delete(queryset):
+    """DELETE the queryset's rows in one statement, without loading them.
+
+    Only for lots whose holding is accounted for by the caller: the
+    post_delete receivers (ledger, counters) are not run. Sale items sold
+    from the lots are unlinked first, as SaleItem.lot's SET_NULL would.
+    """
+    SaleItem.objects.filter(lot__in=queryset.values('pk')).update(lot=None)
+    table = connection.ops.quote_name(StockEntry._meta.db_table)
+    sql, params = queryset.values('pk').query.sql_with_params()
+    with connection.cursor() as cursor:
+        # Wrapped, as MySQL refuses a subquery on the table it deletes from
+        cursor.execute(f'DELETE FROM {table} WHERE id IN (SELECT id FROM ({sql}) AS doomed)', params)
+        return cursor.rowcount
+
+
+def _holdings(lots):
+    """{(medicine_id, expiration_date): (boxes, strips)} summed over lots."""
+    held = defaultdict(lambda: [0, 0])
+    rows = lots.values_list('medicine_id', 'expiration_date', 'quantity', 'strips_remaining',
+                            'medicine__strips_per_box')
+    for medicine_id, expiry, quantity, strips, strips_per_box in rows.iterator(chunk_size=2000):
+        boxes, strips = lot_units(quantity, strips, strips_per_box)
+        total = held[medicine_id, expiry]
+        total[0] += boxes
+        total[1] += strips
+    return {key: tuple(total) for key, total in held.items()}
+
+
+def _holdings_of(keys):
+    """_holdings() of every lot with one of the (medicine_id, expiry) keys."""
+    medicine_ids = sorted({medicine_id for medicine_id, _ in keys})
+    held = {}
+    for start in range(0, len(medicine_ids), READ_BATCH):
+        lots = StockEntry.objects.filter(medicine_id__in=medicine_ids[start:start + READ_BATCH])
+        held.update((key, units) for key, units in _holdings(lots).items() if key in keys)
+    return held
+
+
+def repair(checks=CHECKS):
+    """Fix what examine() finds for the checks asked for, in one transaction.
+    Returns {check: rows (or medicines) fixed}."""
+    fixed = {}
+    with transaction.atomic(), movement_reason(StockMovement.EDIT, 'stock_doctor'):
+        damaged = Q(pk__in=[])
+        if 'duplicates' in checks:
+            damaged |= duplicate_q()
+        if 'negative' in checks:
+            damaged |= negative_q()
+        if 'strips' in checks:
+            damaged |= strips_q()
+        before = _holdings(StockEntry.objects.filter(damaged))
+
+        if 'duplicates' in checks:
+            # The first lot of each group takes the whole holding, the rest go
+            groups = (
+                StockEntry.objects.filter(duplicate_q()).values('medicine_id', 'expiration_date')
+                .annotate(
+                    keeper=Min('id'), boxes=Sum('quantity'),
+                    strips=Sum(Coalesce('strips_remaining', F('quantity') * F('medicine__strips_per_box'))),
+                )
+            )
+            keepers = [StockEntry(pk=group['keeper'], quantity=group['boxes'], strips_remaining=group['strips'])
+                       for group in groups]
+            StockEntry.objects.bulk_update(keepers, ['quantity', 'strips_remaining'], batch_size=500)
+            fixed['duplicates'] = raw_delete(StockEntry.objects.filter(surplus_duplicate_q()))
+        if 'negative' in checks:
+            fixed['negative'] = (
+                StockEntry.objects.filter(quantity__lt=0).update(quantity=0)
+                + StockEntry.objects.filter(strips_remaining__lt=0).update(strips_remaining=0)
+            )
+        if 'strips' in checks:
+            strips_per_box = Medicine.objects.filter(pk=OuterRef('medicine_id')).values('strips_per_box')
+            fixed['strips'] = StockEntry.objects.filter(strips_q()).update(
+                quantity=F('strips_remaining') / Subquery(strips_per_box),
+            )
+
+        after = _holdings_of(set(before))
+        changes = []
+        for (medicine_id, expiry), units in before.items():
+            now_held = after.get((medicine_id, expiry))
+            if now_held is None:
+                changes.append(LotChange(medicine_id, expiry, units, None, NOTHING))
+            elif now_held != units:
+                changes.append(LotChange(medicine_id, expiry, units, expiry, now_held))
+        lots_changed(changes)
+
+        if 'empty' in checks:
+            # Nothing is held, so there is nothing for the ledger or counters
+            fixed['empty'] = raw_delete(StockEntry.objects.filter(empty_q()))
+        if 'counters' in checks:
+            fixed['counters'] = rewrite_counters(find_drift())
+    return fixed
+
+
+def run(checks=CHECKS, fix=False):
+    """examine() and, with fix, repair(); the machine-readable report."""
+    checks = tuple(check for check in CHECKS if check in checks)
+    report = {
+        'checked_at': timezone.now().isoformat(),
+        'lots': StockEntry.objects.count(),
+        'checks': examine(checks),
+        'fixed': None,
+    }
+    if fix and any(result['found'] for result in report['checks'].values()):
+        report['fixed'] = repair(checks)
+    return report
@@ -0,0 +1,122 @@
+"""
+Bulk stock intake.
+
+Receiving stock used to be a get_or_create() per (medicine, expiry) lot
+followed by a second save() to add to an existing lot, two or three queries
+a line. intake_lots() takes all the lines at once and adds them with one
+
+    INSERT ... ON CONFLICT(medicine_id, expiration_date)
+    DO UPDATE SET quantity = quantity + excluded.quantity, ...
+
+per batch, relying on the unique_medicine_expiration constraint. The
+addition happens in SQL, so it is right whatever the lot held. Lines may
+carry the purchase cost per box; the lot keeps it in unit_cost, averaged
+over its deliveries by quantity.
+
+Because an intake only ever adds, the LotChanges for the Medicine counters
+and the stock ledger (pharmacy.stock_ledger.lots_changed) follow from the
+lines alone: each is an inflow of the added boxes and strips into its lot,
+and the counters of just the touched medicines move by that much. A
+500-line delivery is a couple of statements instead of 1000+ queries.
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Medicine, StockEntry
+from .stock_counters import NOTHING, LotChange
+from .stock_ledger import lots_changed
+
+# Rows per INSERT (6 parameters each, under SQLite's 999-variable limit)
+BATCH_SIZE = 160
+
+CENT = Decimal('0.01')
+
+IntakeLine = namedtuple('IntakeLine', 'medicine_id expiration_date boxes unit_cost', defaults=(None,))
+
+
+def merge_lines(lines):
+    """{(medicine_id, expiration_date): boxes} with repeated lots summed and
+    empty lines dropped, and {(medicine_id, expiration_date): unit_cost}
+    averaged over the lines that have a cost."""
+    merged = {}
+    costs = {}
+    for line in lines:
+        medicine_id, expiration_date, boxes, unit_cost = IntakeLine(*line)
+        boxes = int(boxes or 0)
+        if boxes <= 0:
+            continue
+        expiration_date = StockEntry._meta.get_field('expiration_date').to_python(expiration_date)
+        key = (int(medicine_id), expiration_date)
+        merged[key] = merged.get(key, 0) + boxes
+        if unit_cost is not None:
+            cost_boxes, total = costs.get(key, (0, Decimal(0)))
+            costs[key] = (cost_boxes + boxes, total + Decimal(unit_cost) * boxes)
+    return merged, {key: (total / cost_boxes).quantize(CENT) for key, (cost_boxes, total) in costs.items()}
+
+
+def upsert_sql(rows):
+    table = connection.ops.quote_name(StockEntry._meta.db_table)
+    medicine_table = connection.ops.quote_name(Medicine._meta.db_table)
+    values = ', '.join(['(%s, %s, %s, %s, %s, %s)'] * rows)
+    return (
+        f"INSERT INTO {table} (medicine_id, expiration_date, quantity, strips_remaining, unit_cost, created_at) "
+        f"VALUES {values} "
+        f"ON CONFLICT(medicine_id, expiration_date) DO UPDATE SET "
+        f"quantity = {table}.quantity + excluded.quantity, "
+        # Lots from before strips were tracked hold quantity * strips_per_box
+        f"strips_remaining = COALESCE({table}.strips_remaining, {table}.quantity * "
+        f"(SELECT strips_per_box FROM {medicine_table} WHERE id = excluded.medicine_id)) "
+        f"+ excluded.strips_remaining, "
+        # The right-hand sides all see the lot as it was before this update
+        f"unit_cost = CASE "
+        f"WHEN excluded.unit_cost IS NULL THEN {table}.unit_cost "
+        f"WHEN {table}.unit_cost IS NULL OR {table}.quantity <= 0 THEN excluded.unit_cost "
+        f"ELSE ROUND(({table}.unit_cost * {table}.quantity + excluded.unit_cost * excluded.quantity) "
+        f"/ ({table}.quantity + excluded.quantity), 2) END"
+    )
+
+
+def intake_lots(lines, batch_size=BATCH_SIZE):
+    """Add stock: lines is an iterable of (medicine_id, expiration_date,
+    boxes[, unit_cost]). Creates missing lots, adds to existing ones, and
+    updates the counters and ledger (tagged by the surrounding
+    movement_reason()).
+
+    Returns the merged {(medicine_id, expiration_date): boxes} added.
+    """
+    merged, costs = merge_lines(lines)
+    if not merged:
+        return merged
+    strips_per_box = dict(
+        Medicine.objects.filter(pk__in={medicine_id for medicine_id, _ in merged})
+        .values_list('id', 'strips_per_box')
+    )
+    now = timezone.now()
+    rows = []
+    changes = []
+    for (medicine_id, expiration_date), boxes in merged.items():
+        if medicine_id not in strips_per_box:
+            raise Medicine.DoesNotExist(f'No medicine with id {medicine_id}')
+        strips = boxes * strips_per_box[medicine_id]
+        rows.append((medicine_id, expiration_date, boxes, strips, costs.get((medicine_id, expiration_date)), now))
+        changes.append(LotChange(medicine_id, None, NOTHING, expiration_date, (boxes, strips)))
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            params = []
+            for medicine_id, expiration_date, boxes, strips, unit_cost, created_at in batch:
+                params += [
+                    medicine_id,
+                    connection.ops.adapt_datefield_value(expiration_date),
+                    boxes,
+                    strips,
+                    connection.ops.adapt_decimalfield_value(unit_cost, 10, 2),
+                    connection.ops.adapt_datetimefield_value(created_at),
+                ]
+            cursor.execute(upsert_sql(len(batch)), params)
+        lots_changed(changes)
+    return merged
@@ -0,0 +1,153 @@
+"""
+Append-only stock ledger and point-in-time inventory.
+
+StockEntry rows are overwritten in place (and sale returns delete the
+SaleItem), so they only ever say what is on the shelf now. Every lot change
+is therefore also written as a StockMovement: the same LotChanges that
+drive the Medicine counters (pharmacy.stock_counters) are recorded in bulk
+by record_movements(), tagged with the reason set by the surrounding
+movement_reason() block:
+
+    with movement_reason(StockMovement.PURCHASE, f"purchase:{purchase.id}"):
+        ...StockEntry writes...
+
+Changes outside any block are recorded as manual edits, or as expiry
+write-offs when an expired lot is deleted.
+
+take_checkpoint() (nightly: `python manage.py stock_checkpoint`) stores the
+holding of every lot, and inventory_at() answers "what did we hold at T" as
+the latest checkpoint before T plus the movements between the two, so the
+cost grows with the movements since that checkpoint, not with the history.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .models import StockCheckpoint, StockCheckpointLine, StockEntry, StockMovement
+from .stock_counters import apply_lot_changes, lot_units
+
+_reason = ContextVar('stock_movement_reason', default=None)
+
+
+@contextmanager
+def movement_reason(reason, reference=''):
+    """Tag the stock movements written inside the block."""
+    token = _reason.set((reason, str(reference)[:50]))
+    try:
+        yield
+    finally:
+        _reason.reset(token)
+
+
+def movement_rows(changes, today=None):
+    """StockMovement rows (unsaved) for LotChanges; a change that moves a lot
+    to another expiry is an outflow from one lot and an inflow to the other."""
+    today = today or timezone.now().date()
+    now = timezone.now()
+    reason, reference = _reason.get() or (None, '')
+    rows = []
+
+    def add(medicine_id, expiry, boxes, strips, deleting=False):
+        if not (boxes or strips):
+            return
+        row_reason = reason
+        if row_reason is None:
+            row_reason = StockMovement.WRITE_OFF if deleting and expiry < today else StockMovement.EDIT
+        rows.append(StockMovement(
+            medicine_id=medicine_id, expiration_date=expiry, boxes=boxes, strips=strips,
+            reason=row_reason, reference=reference, created_at=now,
+        ))
+
+    for change in changes:
+        if change.old_expiry == change.new_expiry:
+            add(change.medicine_id, change.new_expiry,
+                change.new_units[0] - change.old_units[0], change.new_units[1] - change.old_units[1])
+            continue
+        if change.old_expiry is not None:
+            add(change.medicine_id, change.old_expiry, -change.old_units[0], -change.old_units[1],
+                deleting=change.new_expiry is None)
+        if change.new_expiry is not None:
+            add(change.medicine_id, change.new_expiry, change.new_units[0], change.new_units[1])
+    return rows
+
+
+def record_movements(changes):
+    """Append the movements for LotChanges (one INSERT)."""
+    rows = movement_rows(changes)
+    if rows:
+        StockMovement.objects.bulk_create(rows)
+    return rows
+
+
+def lots_changed(changes):
+    """Update the Medicine counters and append the ledger rows for
+    LotChanges; every StockEntry writer ends up here."""
+    changes = list(changes)
+    apply_lot_changes(changes)
+    record_movements(changes)
+
+
+def take_checkpoint():
+    """Store what every lot holds right now; returns the StockCheckpoint."""
+    with transaction.atomic():
+        # Written first so SQLite holds the write lock while the lots are read
+        checkpoint = StockCheckpoint.objects.create(taken_at=timezone.now())
+        lines = []
+        lots = StockEntry.objects.values_list(
+            'medicine_id', 'expiration_date', 'quantity', 'strips_remaining', 'medicine__strips_per_box',
+        )
+        for medicine_id, expiry, quantity, strips, strips_per_box in lots.iterator(chunk_size=2000):
+            boxes, strips = lot_units(quantity, strips, strips_per_box)
+            if boxes or strips:
+                lines.append(StockCheckpointLine(
+                    checkpoint=checkpoint, medicine_id=medicine_id, expiration_date=expiry,
+                    boxes=boxes, strips=strips,
+                ))
+        StockCheckpointLine.objects.bulk_create(lines, batch_size=1000)
+    return checkpoint
+
+
+def inventory_at(when, medicine_ids=None):
+    """{(medicine_id, expiration_date): (boxes, strips)} held at when.
+
+    Raises ValueError for a moment before the first checkpoint (the ledger
+    does not reach further back).
+    """
+    checkpoint = StockCheckpoint.objects.filter(taken_at__lte=when).order_by('-taken_at').first()
+    if checkpoint is None:
+        raise ValueError(f'No stock checkpoint at or before {when}')
+
+    lines = checkpoint.lines.all()
+    movements = StockMovement.objects.filter(created_at__gt=checkpoint.taken_at, created_at__lte=when)
+    if medicine_ids is not None:
+        lines = lines.filter(medicine_id__in=medicine_ids)
+        movements = movements.filter(medicine_id__in=medicine_ids)
+
+    holding = defaultdict(lambda: [0, 0])
+    for medicine_id, expiry, boxes, strips in lines.values_list('medicine_id', 'expiration_date', 'boxes', 'strips'):
+        holding[medicine_id, expiry] = [boxes, strips]
+    replay = movements.values('medicine_id', 'expiration_date').annotate(
+        boxes=Sum('boxes'), strips=Sum('strips'),
+    ).values_list('medicine_id', 'expiration_date', 'boxes', 'strips')
+    for medicine_id, expiry, boxes, strips in replay:
+        lot = holding[medicine_id, expiry]
+        lot[0] += boxes
+        lot[1] += strips
+    return {lot: tuple(units) for lot, units in holding.items() if units != [0, 0]}
+
+
+def medicine_totals_at(when, medicine_ids=None, sellable_only=True):
+    """{medicine_id: (boxes, strips)} at when; with sellable_only, lots
+    already expired on that day are left out (as Medicine.stock does)."""
+    day = timezone.localtime(when).date() if timezone.is_aware(when) else when.date()
+    totals = defaultdict(lambda: [0, 0])
+    for (medicine_id, expiry), (boxes, strips) in inventory_at(when, medicine_ids).items():
+        if sellable_only and expiry < day:
+            continue
+        totals[medicine_id][0] += boxes
+        totals[medicine_id][1] += strips
+    return {medicine_id: tuple(units) for medicine_id, units in totals.items()}
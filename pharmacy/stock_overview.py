@@ -0,0 +1,94 @@
+"""
+Stock overview (the stock_view page).
+
+The page used to load every medicine with its lots and run two aggregate
+queries per medicine for the expired and near-expiry boxes. overview_page()
+instead reads one page of medicines with all their quantities in a single
+grouped query (conditional SUMs over the lots), filtered in SQL and
+paginated by keyset on (name, id), so a page costs the same however far
+down the list it is. Lots are only read for the card that is expanded
+(medicine_lots()). Nothing here writes.
+"""
+from collections import namedtuple
+from datetime import timedelta
+
+from django.core import signing
+from django.db.models import Count, F, IntegerField, Q, Sum
+from django.db.models.functions import Coalesce
+
+from .models import Medicine, StockEntry
+
+PAGE_SIZE = 30
+NEAR_EXPIRY_DAYS = 30
+
+CURSOR_SALT = 'pharmacy.stock_overview'
+
+OverviewPage = namedtuple('OverviewPage', 'rows next_cursor')
+
+
+def lot_quantity(lot_filter):
+    return Coalesce(Sum('stock_entries__quantity', filter=lot_filter), 0, output_field=IntegerField())
+
+
+def overview_queryset(today, category=None, low_stock=False, expiring=False):
+    """Medicines (as dicts) with their available, expired and near-expiry
+    boxes and lot count, in (name, id) order."""
+    near_expiry_end = today + timedelta(days=NEAR_EXPIRY_DAYS)
+    medicines = Medicine.objects.all()
+    if category:
+        medicines = medicines.filter(category=category)
+    medicines = medicines.values('id', 'name', 'category', 'barcode_number', 'reorder_level').annotate(
+        available_stock=lot_quantity(Q(stock_entries__expiration_date__gte=today)),
+        expired_stock=lot_quantity(Q(stock_entries__expiration_date__lt=today)),
+        near_expiry_stock=lot_quantity(Q(stock_entries__expiration_date__range=(today, near_expiry_end))),
+        lot_count=Count('stock_entries'),
+    )
+    if low_stock:
+        medicines = medicines.filter(available_stock__lte=F('reorder_level'))
+    if expiring:
+        medicines = medicines.filter(near_expiry_stock__gt=0)
+    return medicines.order_by('name', 'id')
+
+
+def encode_cursor(row):
+    return signing.dumps([row['name'], row['id']], salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor):
+    """(name, id) of the last row of the previous page, or None for a
+    missing or tampered cursor (which starts from the top)."""
+    if not cursor:
+        return None
+    try:
+        name, medicine_id = signing.loads(cursor, salt=CURSOR_SALT)
+        return str(name), int(medicine_id)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+
+
+def overview_page(today, cursor=None, page_size=PAGE_SIZE, **filters):
+    """One OverviewPage of overview_queryset(today, **filters) after cursor."""
+    medicines = overview_queryset(today, **filters)
+    after = decode_cursor(cursor)
+    if after is not None:
+        name, medicine_id = after
+        medicines = medicines.filter(Q(name__gt=name) | Q(name=name, id__gt=medicine_id))
+    rows = list(medicines[:page_size + 1])
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    return OverviewPage(rows[:page_size], next_cursor)
+
+
+def medicine_lots(medicine_id, today):
+    """The medicine's lots by expiry, each with its status for the page."""
+    near_expiry_end = today + timedelta(days=NEAR_EXPIRY_DAYS)
+    lots = StockEntry.objects.filter(medicine_id=medicine_id).order_by('expiration_date').values(
+        'id', 'expiration_date', 'quantity', 'strips_remaining',
+    )
+    for lot in lots:
+        if lot['expiration_date'] < today:
+            lot['status'] = 'expired'
+        elif lot['expiration_date'] <= near_expiry_end:
+            lot['status'] = 'near_expiry'
+        else:
+            lot['status'] = 'good'
+        yield lot
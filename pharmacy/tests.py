@@ -1,13 +1,43 @@
+from django.conf import settings
 from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from datetime import timedelta
+from decimal import Decimal
+import io
+import os
 
-from .models import Medicine, StockEntry, Sale, SaleItem
+from .models import (
+    Cart, CartLine, Customer, Medicine, PrintJob, ProfitAnalytics, Purchase, PurchaseItem, StockEntry, StockMovement,
+    Sale, SaleItem, Supplier,
+)
+from .barcode_lookup import BarcodeLookup, barcode_lookup
+from . import print_spooler
 
 User = get_user_model()
 
+# Labels as TSPL commands, which deployments opt into
+TSPL_LABELS = override_settings(PRINTER_SETTINGS=dict(settings.PRINTER_SETTINGS, LABEL_MODE='tspl'))
+
+
+def fill_cart(user, items):
+    """Replace user's POS cart with lines given as dicts (the shape the old
+    session cart used)."""
+    cart, _ = Cart.objects.get_or_create(user=user)
+    cart.lines.all().delete()
+    CartLine.objects.bulk_create([
+        CartLine(
+            cart=cart, medicine_id=item['medicine_id'], quantity=item['quantity'],
+            unit_type=item['unit_type'], expiration_date=item.get('expiration_date') or None,
+            original_price=item['original_price'], discounted_price=item['discounted_price'],
+        )
+        for item in items
+    ])
+    return cart
+
+
 class PosCompletionTransactionTests(TestCase):
     def setUp(self):
         self.user = User.objects.create_user('cashier', 'cashier@example.com', 'pass')
@@ -173,3 +203,1623 @@ class ExpiryReportBucketTests(TestCase):
         resp = client.get(reverse('pharmacy:expiry_report'))
         self.assertEqual(resp.status_code, 200)
         self.assertIn('Public Test', resp.content.decode())
+
+
+class PosBatchedAllocationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('till', 'till@example.com', 'pass')
+        self.client.force_login(self.user)
+        self.expiry = timezone.now().date() + timedelta(days=200)
+
+    def make_cart(self, lines):
+        cart = []
+        for i in range(lines):
+            m = Medicine.objects.create(
+                name=f'Batch Med {i}', description='d', price=10, purchase_price=5,
+                category='OTC', barcode_number=f'{600000000000 + i}', strips_per_box=4,
+            )
+            StockEntry.objects.create(medicine=m, quantity=5, strips_remaining=20, expiration_date=self.expiry)
+            m.update_stock()
+            cart.append({
+                'medicine_id': m.id, 'name': m.name, 'quantity': 2, 'unit_type': 'BOX',
+                'expiration_date': self.expiry.strftime('%Y-%m-%d'),
+                'original_price': 10.0, 'discounted_price': 10.0, 'total': 20.0,
+            })
+        return cart
+
+    def checkout(self, cart):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        fill_cart(self.user, cart)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(reverse('pharmacy:pos_complete_sale'), {
+                'payment_method': 'CASH', 'action': 'no_print',
+            })
+        return len(ctx.captured_queries)
+
+    def test_query_count_does_not_grow_with_cart_size(self):
+        small = self.checkout(self.make_cart(1))
+        SaleItem.objects.all().delete()
+        Sale.objects.all().delete()
+        Medicine.objects.all().delete()
+        large = self.checkout(self.make_cart(15))
+        self.assertEqual(small, large)
+        self.assertEqual(SaleItem.objects.count(), 15)
+        for m in Medicine.objects.all():
+            self.assertEqual(m.stock, 3)
+            self.assertEqual(m.stock_entries.get().strips_remaining, 12)
+
+    def test_two_lines_on_same_lot_share_the_decrement(self):
+        cart = self.make_cart(1)
+        cart.append(dict(cart[0], quantity=3, unit_type='STRIP', discounted_price=2.5, total=7.5))
+        self.checkout(cart)
+        entry = StockEntry.objects.get()
+        self.assertEqual(entry.strips_remaining, 20 - 8 - 3)
+        self.assertEqual(entry.quantity, 2)
+        self.assertEqual(Medicine.objects.get().stock, 2)
+
+    def test_dispensing_a_prescription_takes_stock_from_the_lots(self):
+        from django.contrib.messages.storage.fallback import FallbackStorage
+        from django.test import RequestFactory
+
+        from .models import Prescription, PrescriptionItem
+        from .views import dispense_prescription
+
+        self.make_cart(1)
+        medicine = Medicine.objects.get()
+        customer = Customer.objects.create(name='Patient', phone='0111')
+        today = timezone.now().date()
+        prescription = Prescription.objects.create(
+            customer=customer, doctor_name='Dr', prescription_date=today, expiry_date=today + timedelta(days=30),
+            created_by=self.user,
+        )
+        PrescriptionItem.objects.create(prescription=prescription, medicine=medicine, quantity=2,
+                                        dosage='1', duration='7 days')
+        # The view has no URL of its own
+        request = RequestFactory().post('/')
+        request.user = self.user
+        request.session = self.client.session
+        request._messages = FallbackStorage(request)
+        dispense_prescription(request, prescription.pk)
+
+        medicine.refresh_from_db()
+        self.assertEqual(medicine.stock, 3)
+        self.assertEqual(medicine.stock_entries.get().strips_remaining, 12)
+        item = SaleItem.objects.get()
+        self.assertEqual((item.lot_id, item.unit_cost), (medicine.stock_entries.get().id, Decimal('5')))
+        self.assertTrue(StockMovement.objects.filter(reference=f'sale:{item.sale_id}').exists())
+        prescription.refresh_from_db()
+        self.assertEqual(prescription.status, 'DISPENSED')
+
+
+class FefoLotSplittingTests(TestCase):
+    def setUp(self):
+        barcode_lookup.clear()
+        self.user = User.objects.create_user('fefo', 'fefo@example.com', 'pass')
+        self.client.force_login(self.user)
+        self.today = timezone.now().date()
+        self.medicine = Medicine.objects.create(
+            name='Split Med', description='d', price=12, purchase_price=6,
+            category='OTC', barcode_number='700000000001', strips_per_box=3,
+        )
+
+    def add_lot(self, days, boxes, strips=None):
+        return StockEntry.objects.create(
+            medicine=self.medicine, quantity=boxes,
+            strips_remaining=boxes * 3 if strips is None else strips,
+            expiration_date=self.today + timedelta(days=days),
+        )
+
+    def checkout(self, quantity, unit_type='BOX', expiration_date=''):
+        fill_cart(self.user, [{
+            'medicine_id': self.medicine.id, 'name': self.medicine.name,
+            'quantity': quantity, 'unit_type': unit_type, 'expiration_date': expiration_date,
+            'original_price': 12.0, 'discounted_price': 12.0, 'total': 12.0 * quantity,
+        }])
+        self.client.post(reverse('pharmacy:pos_complete_sale'), {'payment_method': 'CASH', 'action': 'no_print'})
+
+    def test_box_line_spans_two_batches_first_expired_first(self):
+        late = self.add_lot(300, 4)
+        early = self.add_lot(100, 3)
+        self.checkout(5)
+        items = list(SaleItem.objects.order_by('expiry_date').values_list('expiry_date', 'quantity'))
+        self.assertEqual(items, [(early.expiration_date, 3), (late.expiration_date, 2)])
+        early.refresh_from_db()
+        late.refresh_from_db()
+        self.assertEqual((early.quantity, early.strips_remaining), (0, 0))
+        self.assertEqual((late.quantity, late.strips_remaining), (2, 6))
+
+    def test_strip_line_uses_open_box_then_next_batch(self):
+        self.add_lot(100, 0, strips=2)
+        second = self.add_lot(200, 2)
+        self.checkout(4, unit_type='STRIP')
+        self.assertEqual(list(SaleItem.objects.order_by('expiry_date').values_list('quantity', flat=True)), [2, 2])
+        second.refresh_from_db()
+        self.assertEqual((second.quantity, second.strips_remaining), (1, 4))
+
+    def test_selected_batch_is_used_before_earlier_ones(self):
+        self.add_lot(100, 2)
+        chosen = self.add_lot(200, 2)
+        self.checkout(3, expiration_date=chosen.expiration_date.strftime('%Y-%m-%d'))
+        first = SaleItem.objects.order_by('id').first()
+        self.assertEqual((first.expiry_date, first.quantity), (chosen.expiration_date, 2))
+
+    def test_insufficient_total_stock_saves_nothing(self):
+        self.add_lot(100, 3)
+        self.add_lot(200, 1)
+        self.checkout(5)
+        self.assertEqual(Sale.objects.count(), 0)
+        self.assertEqual(sum(StockEntry.objects.values_list('quantity', flat=True)), 4)
+
+    def test_add_to_cart_accepts_quantity_spanning_batches(self):
+        self.add_lot(100, 3)
+        self.add_lot(200, 4)
+        self.medicine.update_stock()
+        self.client.post(reverse('pharmacy:pos_add_to_cart'), {'barcode': self.medicine.barcode_number, 'quantity': 5})
+        self.assertEqual(CartLine.objects.count(), 1)
+        self.client.post(reverse('pharmacy:pos_add_to_cart'), {'barcode': self.medicine.barcode_number, 'quantity': 3})
+        self.assertEqual(CartLine.objects.count(), 1)
+
+    def test_dozens_of_lots_keep_query_count_flat(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        for day in range(40):
+            self.add_lot(30 + day, 1)
+        Cart.objects.create(user=self.user)
+        with CaptureQueriesContext(connection) as ctx:
+            self.checkout(2)
+        few = len(ctx.captured_queries)
+        with CaptureQueriesContext(connection) as ctx:
+            self.checkout(30)
+        self.assertEqual(len(ctx.captured_queries), few)
+        self.assertEqual(SaleItem.objects.count(), 32)
+
+
+class BarcodeLookupCacheTests(TestCase):
+    def setUp(self):
+        barcode_lookup.clear()
+        self.medicine = Medicine.objects.create(
+            name='Cached Med', description='d', price=20, purchase_price=10,
+            category='OTC', barcode_number='800000000001', strips_per_box=2,
+        )
+
+    def test_second_lookup_is_served_from_memory(self):
+        cache = BarcodeLookup()
+        with self.assertNumQueries(1):
+            first = cache.get('800000000001')
+            second = cache.get('800000000001')
+        self.assertIs(first, second)
+        self.assertEqual(first.get_strip_price(), 10)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertIsNone(cache.get('does-not-exist'))
+
+    def test_medicine_and_stock_changes_invalidate_snapshot(self):
+        self.assertEqual(barcode_lookup.get('800000000001').price, 20)
+        self.medicine.price = 30
+        self.medicine.save()
+        self.assertEqual(barcode_lookup.get('800000000001').price, 30)
+
+        entry = StockEntry.objects.create(
+            medicine=self.medicine, quantity=4, expiration_date=timezone.now().date() + timedelta(days=90)
+        )
+        self.medicine.update_stock()
+        self.assertEqual(barcode_lookup.get('800000000001').stock, 4)
+        entry.delete()
+        self.medicine.update_stock()
+        self.assertEqual(barcode_lookup.get('800000000001').stock, 0)
+
+    def test_size_bound_evicts_least_recently_used(self):
+        cache = BarcodeLookup(maxsize=2)
+        for i in range(3):
+            Medicine.objects.create(
+                name=f'LRU {i}', description='d', price=1, purchase_price=1,
+                category='OTC', barcode_number=f'80000000010{i}',
+            )
+        cache.get('800000000100')
+        cache.get('800000000101')
+        cache.get('800000000100')
+        cache.get('800000000102')
+        self.assertEqual(cache.stats()['size'], 2)
+        with self.assertNumQueries(0):
+            cache.get('800000000100')
+        with self.assertNumQueries(1):
+            cache.get('800000000101')
+
+    def test_stats_endpoint_is_staff_only(self):
+        user = User.objects.create_user('mon', 'mon@example.com', 'pass')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(reverse('pharmacy:barcode_cache_stats')).status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.client.get(reverse('pharmacy:get_expiration_dates'), {'barcode': '800000000001'})
+        stats = self.client.get(reverse('pharmacy:barcode_cache_stats')).json()
+        self.assertGreaterEqual(stats['misses'], 1)
+
+
+class PosScanEndpointTests(TestCase):
+    def setUp(self):
+        barcode_lookup.clear()
+        self.user = User.objects.create_user('scan', 'scan@example.com', 'pass')
+        self.client.force_login(self.user)
+        self.today = timezone.now().date()
+        self.medicine = Medicine.objects.create(
+            name='Scan Med', description='d', price=30, purchase_price=20,
+            category='OTC', barcode_number='900000000001', strips_per_box=3, can_sell_strips=True,
+        )
+        self.lot = StockEntry.objects.create(
+            medicine=self.medicine, quantity=2, strips_remaining=6,
+            expiration_date=self.today + timedelta(days=120),
+        )
+        self.url = reverse('pharmacy:pos_scan')
+
+    def test_get_returns_prices_and_lots_without_touching_cart(self):
+        data = self.client.get(self.url, {'barcode': '900000000001'}).json()
+        self.assertTrue(data['success'])
+        self.assertEqual(data['prices']['box'], {'original': 30.0, 'discounted': 30.0})
+        self.assertEqual(data['prices']['strip']['original'], 10.0)
+        self.assertEqual(data['lots'], [{
+            'expiration_date': self.lot.expiration_date.strftime('%Y-%m-%d'), 'boxes': 2, 'strips': 6,
+        }])
+        self.assertNotIn('cart', data)
+        self.assertFalse(CartLine.objects.exists())
+
+    def test_post_adds_line_and_returns_cart_delta(self):
+        data = self.client.post(self.url, {'barcode': '900000000001', 'quantity': 1}).json()
+        self.assertEqual(data['cart']['count'], 1)
+        self.assertEqual(data['cart']['cart_total'], 30.0)
+        data = self.client.post(self.url, {'barcode': '900000000001', 'quantity': 1, 'unit_type': 'STRIP'}).json()
+        self.assertEqual(data['cart']['count'], 2)
+        self.assertEqual(data['cart']['line']['total'], 10.0)
+        self.assertEqual(data['cart']['cart_total'], 40.0)
+        self.assertEqual(CartLine.objects.filter(cart__user=self.user).count(), 2)
+
+    def test_customer_discount_matches_add_to_cart(self):
+        customer = Customer.objects.create(name='C', phone='0100', discount_percentage=50)
+        data = self.client.post(self.url, {
+            'barcode': '900000000001', 'quantity': 1, 'customer_id': customer.id,
+        }).json()
+        # 50% off would be 15, below cost + 10% (22)
+        self.assertAlmostEqual(data['prices']['box']['discounted'], 22.0)
+        self.client.post(reverse('pharmacy:pos_add_to_cart'), {
+            'barcode': '900000000001', 'quantity': 1, 'customer_id': customer.id,
+        })
+        first, second = CartLine.objects.all()
+        self.assertEqual(first.discounted_price, second.discounted_price)
+
+    def test_insufficient_stock_and_unknown_barcode(self):
+        response = self.client.post(self.url, {'barcode': '900000000001', 'quantity': 3})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error'], 'Insufficient stock')
+        response = self.client.post(self.url, {'barcode': '900000000001', 'quantity': 0})
+        self.assertEqual(response.json()['error'], 'Invalid quantity')
+        self.assertEqual(self.client.get(self.url, {'barcode': 'nope'}).status_code, 404)
+
+    def test_lines_already_in_the_cart_that_stock_no_longer_covers_block_new_ones(self):
+        self.client.post(self.url, {'barcode': '900000000001', 'quantity': 2})
+        # A box went out of stock after it was scanned
+        StockEntry.objects.filter(pk=self.lot.pk).update(quantity=1, strips_remaining=3)
+        response = self.client.post(self.url, {'barcode': '900000000001', 'quantity': 1, 'unit_type': 'STRIP'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['error'], 'Insufficient stock')
+        self.assertEqual(CartLine.objects.count(), 1)
+
+    def test_cached_scan_uses_few_queries(self):
+        self.client.get(self.url, {'barcode': '900000000001'})
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(self.url, {'barcode': '900000000001'})
+        # session + user + cart + the lot query + the cart's lines; the
+        # product comes from the cache
+        self.assertLessEqual(len(ctx.captured_queries), 5)
+
+    def test_unknown_customer_is_an_error_not_full_price(self):
+        response = self.client.get(self.url, {'barcode': '900000000001', 'customer_id': 999})
+        self.assertEqual((response.status_code, response.json()['error']), (404, 'Customer not found'))
+        response = self.client.post(self.url, {'barcode': '900000000001', 'customer_id': 'x'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(CartLine.objects.exists())
+
+    def test_lots_show_what_the_cart_leaves(self):
+        expiry = self.lot.expiration_date.strftime('%Y-%m-%d')
+        data = self.client.post(self.url, {'barcode': '900000000001', 'quantity': 1}).json()
+        self.assertEqual(data['lots'], [{'expiration_date': expiry, 'boxes': 1, 'strips': 3}])
+        data = self.client.get(self.url, {'barcode': '900000000001'}).json()
+        self.assertEqual(data['lots'], [{'expiration_date': expiry, 'boxes': 1, 'strips': 3}])
+        self.client.post(self.url, {'barcode': '900000000001', 'quantity': 1})
+        self.assertEqual(self.client.get(self.url, {'barcode': '900000000001'}).json()['lots'], [])
+
+
+class DatabaseCartTests(TestCase):
+    def setUp(self):
+        barcode_lookup.clear()
+        self.user = User.objects.create_user('cart', 'cart@example.com', 'pass')
+        self.client.force_login(self.user)
+        self.medicines = []
+        for i in range(3):
+            m = Medicine.objects.create(
+                name=f'Cart Med {i}', description='d', price=30, purchase_price=20,
+                category='OTC', barcode_number=f'{910000000000 + i}', strips_per_box=3, can_sell_strips=True,
+            )
+            StockEntry.objects.create(
+                medicine=m, quantity=5, strips_remaining=15,
+                expiration_date=timezone.now().date() + timedelta(days=90),
+            )
+            self.medicines.append(m)
+
+    def scan(self, medicine, **extra):
+        return self.client.post(reverse('pharmacy:pos_scan'), dict(barcode=medicine.barcode_number, quantity=1, **extra))
+
+    def test_cart_survives_a_new_session(self):
+        self.scan(self.medicines[0])
+        # A second tab / refresh after logging in again sees the same cart
+        other = self.client_class()
+        other.force_login(self.user)
+        response = other.get(reverse('pharmacy:pos'))
+        self.assertEqual([line.name for line in response.context['cart']], ['Cart Med 0'])
+
+    def test_prices_are_decimal_and_reprice_only_writes_changed_lines(self):
+        for m in self.medicines:
+            self.scan(m)
+        self.scan(self.medicines[0], unit_type='STRIP')
+        strip_line = CartLine.objects.get(unit_type='STRIP')
+        self.assertEqual(strip_line.discounted_price, Decimal('10.00'))
+
+        customer = Customer.objects.create(name='V', phone='0111', discount_percentage=10)
+        with self.assertNumQueries(7):
+            # session, user, cart, customer, cart update, lines + medicines, one bulk update
+            self.client.post(reverse('pharmacy:pos'), {'customer_id': customer.id})
+        self.assertEqual(CartLine.objects.get(id=strip_line.id).discounted_price, Decimal('9.00'))
+        self.assertEqual(Cart.objects.get(user=self.user).customer, customer)
+
+    def test_remove_deletes_only_that_line_and_checkout_clears_cart(self):
+        for m in self.medicines:
+            self.scan(m)
+        first = CartLine.objects.first()
+        self.client.post(reverse('pharmacy:pos_remove_item', args=[first.id]))
+        self.assertEqual(CartLine.objects.count(), 2)
+        self.client.post(reverse('pharmacy:pos_complete_sale'), {'payment_method': 'CASH', 'action': 'no_print'})
+        self.assertEqual(Sale.objects.get().total_amount, Decimal('60.00'))
+        self.assertFalse(CartLine.objects.exists())
+
+    def test_session_cart_from_before_upgrade_is_imported(self):
+        session = self.client.session
+        session['cart'] = [{
+            'medicine_id': self.medicines[1].id, 'name': 'Cart Med 1', 'quantity': 2, 'unit_type': 'BOX',
+            'expiration_date': '', 'original_price': 30.0, 'discounted_price': 30.0, 'total': 60.0,
+        }]
+        session.save()
+        response = self.client.get(reverse('pharmacy:pos'))
+        self.assertEqual(response.context['cart_total'], Decimal('60.00'))
+        self.assertNotIn('cart', self.client.session)
+
+
+class BrokenTransport:
+    def send(self, printer_name, title, payload):
+        raise OSError('printer offline')
+
+
+class PrintSpoolerTests(TestCase):
+    def setUp(self):
+        import tempfile
+        self.spool_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(PRINT_SPOOLER={
+            'TRANSPORT': 'file', 'FILE_DIR': self.spool_dir, 'WORKER': 'none',
+            'MAX_ATTEMPTS': 3, 'RETRY_BASE_SECONDS': 0, 'RETRY_MAX_SECONDS': 0, 'DEDUPE_SECONDS': 30,
+        })
+        self.settings_override.enable()
+        self.user = User.objects.create_user('printer', 'printer@example.com', 'pass')
+        self.client.force_login(self.user)
+        medicine = Medicine.objects.create(
+            name='Print Med', description='d', price=10, purchase_price=5,
+            category='OTC', barcode_number='920000000001',
+        )
+        StockEntry.objects.create(medicine=medicine, quantity=5,
+                                  expiration_date=timezone.now().date() + timedelta(days=90))
+        self.medicine = medicine
+
+    def tearDown(self):
+        import shutil
+        self.settings_override.disable()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def sell(self):
+        fill_cart(self.user, [{
+            'medicine_id': self.medicine.id, 'quantity': 1, 'unit_type': 'BOX',
+            'original_price': 10, 'discounted_price': 10,
+        }])
+        return self.client.post(reverse('pharmacy:pos_complete_sale'), {'payment_method': 'CASH', 'action': 'print'})
+
+    def test_checkout_only_enqueues_and_worker_prints(self):
+        import os
+        self.sell()
+        job = PrintJob.objects.get()
+        self.assertEqual((job.kind, job.status), (PrintJob.INVOICE, PrintJob.PENDING))
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+        self.assertEqual(print_spooler.drain(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, PrintJob.DONE)
+        [name] = os.listdir(self.spool_dir)
+        with open(os.path.join(self.spool_dir, name), 'rb') as f:
+            payload = f.read()
+        self.assertTrue(payload.startswith(b'SIZE 48 mm'))
+        self.assertTrue(payload.endswith(b'PRINT 1\r\n'))
+        status = self.client.get(reverse('pharmacy:print_job_status', args=[job.id])).json()
+        self.assertEqual(status['status'], 'DONE')
+
+    def test_failed_jobs_retry_then_give_up(self):
+        job, _ = print_spooler.enqueue_print_job(PrintJob.RAW, payload=b'PRINT 1\r\n', title='raw')
+        broken = BrokenTransport()
+        with self.assertLogs('pharmacy.print_spooler', 'WARNING'):
+            self.assertTrue(print_spooler.process_next_job(broken))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.last_error), (PrintJob.PENDING, 1, 'printer offline'))
+        with self.assertLogs('pharmacy.print_spooler', 'WARNING'):
+            print_spooler.drain(broken)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (PrintJob.FAILED, 3))
+        self.assertEqual(print_spooler.retry_delay(1), 0)
+
+    def test_only_jobs_whose_lease_ran_out_are_requeued(self):
+        job, _ = print_spooler.enqueue_print_job(PrintJob.RAW, payload=b'PRINT 1\r\n', title='raw')
+        stale = timezone.now() - timedelta(seconds=print_spooler.STALE_PRINTING_SECONDS + 1)
+        test = self
+
+        class HungTransport:
+            def send(self, printer_name, title, payload):
+                # A live worker keeps its lease...
+                PrintJob.objects.filter(pk=job.pk).update(updated_at=stale)
+                print_spooler.JobLease(claim).renew()
+                test.assertEqual(print_spooler.requeue_stale_jobs(), 0)
+                # ...and once it lapses the job goes back to the queue
+                PrintJob.objects.filter(pk=job.pk).update(updated_at=stale)
+                test.assertEqual(print_spooler.requeue_stale_jobs(), 1)
+
+        claim = print_spooler.claim_next_job()
+        with self.assertLogs('pharmacy.print_spooler', 'WARNING'):
+            self.assertTrue(print_spooler.run_job(claim, HungTransport()))
+        # The late finish of the requeued attempt does not mark the job done
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.claim_token), (PrintJob.PENDING, ''))
+
+        self.assertEqual(print_spooler.drain(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (PrintJob.DONE, 2))
+
+    @override_settings(PRINT_SPOOLER={'RETRY_BASE_SECONDS': 2, 'RETRY_MAX_SECONDS': 60})
+    def test_backoff_doubles_up_to_the_cap(self):
+        self.assertEqual([print_spooler.retry_delay(n) for n in (1, 2, 3, 6, 7)], [2, 4, 8, 60, 60])
+
+    def test_repeated_reprint_is_deduplicated(self):
+        self.sell()
+        sale = Sale.objects.get()
+        PrintJob.objects.all().delete()
+        url = reverse('pharmacy:invoice_print_old', args=[sale.id])
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(PrintJob.objects.count(), 1)
+        print_spooler.drain()
+        self.client.get(url)
+        self.assertEqual(PrintJob.objects.count(), 1)
+
+    def test_tcp_transport_sends_raw_bytes(self):
+        import socket
+        import threading
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        received = []
+
+        def accept():
+            conn, _ = server.accept()
+            with conn:
+                while chunk := conn.recv(4096):
+                    received.append(chunk)
+
+        thread = threading.Thread(target=accept)
+        thread.start()
+        print_spooler.TcpTransport('127.0.0.1', server.getsockname()[1]).send('p', 't', b'CLS\r\nPRINT 1\r\n')
+        thread.join(5)
+        server.close()
+        self.assertEqual(b''.join(received), b'CLS\r\nPRINT 1\r\n')
+
+    @TSPL_LABELS
+    def test_label_print_queues_one_tspl_job_for_all_copies(self):
+        response = self.client.get(reverse('pharmacy:barcode_print'), {
+            'barcode': '920000000001', 'thermal_print': '1', 'copies': '4',
+        })
+        self.assertEqual(response.status_code, 200)
+        job = PrintJob.objects.get()
+        self.assertEqual(job.kind, PrintJob.RAW)
+        payload = bytes(job.payload)
+        self.assertIn(b'BARCODE ', payload)
+        self.assertIn(b'"128"', payload)
+        self.assertIn(b'"920000000001"', payload)
+        self.assertTrue(payload.endswith(b'PRINT 1,4\r\n'))
+        self.assertLess(len(payload), 2000)
+
+    @TSPL_LABELS
+    def test_received_purchase_prints_all_labels_as_one_job(self):
+        other = Medicine.objects.create(
+            name='Other Med', description='d', price=7, purchase_price=3,
+            category='OTC', barcode_number='920000000002',
+        )
+        supplier = Supplier.objects.create(name='S', contact_person='c', phone='1', email='s@example.com', address='a')
+        purchase = Purchase.objects.create(supplier=supplier, invoice_number='PO-1', created_by=self.user)
+        expiry = timezone.now().date() + timedelta(days=400)
+        PurchaseItem.objects.create(purchase=purchase, medicine=self.medicine, quantity=150, price=5, expiry_date=expiry)
+        PurchaseItem.objects.create(purchase=purchase, medicine=other, quantity=50, price=3, expiry_date=expiry)
+
+        self.client.post(reverse('pharmacy:receive_purchase', args=[purchase.pk]), {'print_labels': '1'})
+        job = PrintJob.objects.get()
+        payload = bytes(job.payload)
+        self.assertEqual(payload.count(b'SIZE '), 1)
+        self.assertEqual(payload.count(b'CLS\r\n'), 2)
+        self.assertIn(b'PRINT 1,150\r\n', payload)
+        self.assertIn(b'PRINT 1,50\r\n', payload)
+
+    @TSPL_LABELS
+    def test_stock_intake_labels_merge_rows_with_the_same_expiry_month(self):
+        from .labels import render_labels_tspl
+        payload, count = render_labels_tspl([
+            (self.medicine, timezone.datetime(2027, 3, 1).date(), 2),
+            (self.medicine, timezone.datetime(2027, 3, 20).date(), 3),
+            (self.medicine, timezone.datetime(2027, 4, 1).date(), 1),
+            (self.medicine, timezone.datetime(2027, 5, 1).date(), 0),
+        ])
+        self.assertEqual(count, 6)
+        self.assertEqual(payload.count(b'CLS\r\n'), 2)
+        self.assertIn(b'"03/27"', payload)
+        self.assertIn(b'PRINT 1,5\r\n', payload)
+
+        response = self.client.post(reverse('pharmacy:update_stock', args=['920000000001']), {
+            'quantity[]': ['2', '1'], 'expiration_date[]': ['2031-03-01', '2031-04-01'],
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn('auto_print', response['Location'])
+        self.assertEqual(PrintJob.objects.get().kind, PrintJob.RAW)
+
+    @TSPL_LABELS
+    def test_non_ascii_barcode_falls_back_to_image_labels(self):
+        from .labels import label_commands, tspl_barcode_ok
+
+        self.assertFalse(tspl_barcode_ok('٩٢٠٠٠١'))
+        with self.assertRaises(ValueError):
+            label_commands('Legacy', '٩٢٠٠٠١', 5)
+        legacy = Medicine.objects.create(
+            name='Legacy', description='d', price=5, purchase_price=3, category='OTC', barcode_number='٩٢٠٠٠١',
+        )
+        response = self.client.post(reverse('pharmacy:update_stock', args=[legacy.barcode_number]), {
+            'quantity[]': ['2'], 'expiration_date[]': ['2031-03-01'],
+        })
+        self.assertIn('auto_print=1', response['Location'])
+        self.assertFalse(PrintJob.objects.exists())
+
+    def test_labels_are_images_unless_tspl_is_chosen(self):
+        from .labels import tspl_mode
+
+        self.assertFalse(tspl_mode())
+        response = self.client.post(reverse('pharmacy:update_stock', args=[self.medicine.barcode_number]), {
+            'quantity[]': ['2'], 'expiration_date[]': ['2031-03-01'],
+        })
+        self.assertIn('auto_print=1', response['Location'])
+        self.assertFalse(PrintJob.objects.exists())
+
+
+class RasterPackingTests(TestCase):
+    def test_black_prints_as_zero_and_row_padding_stays_blank(self):
+        from PIL import Image
+        from .raster import pack_bitmap
+
+        image = Image.new('L', (10, 2), 255)
+        image.putpixel((0, 0), 0)
+        image.putpixel((9, 0), 127)   # darker than 128: printed
+        image.putpixel((1, 1), 128)   # not darker: blank
+        self.assertEqual(pack_bitmap(image), (2, 2, bytes([0b01111111, 0b10111111, 0xFF, 0xFF])))
+        self.assertEqual(pack_bitmap(image, threshold=200)[2][2:], bytes([0b10111111, 0xFF]))
+        self.assertEqual(pack_bitmap(image.convert('1', dither=Image.Dither.NONE)), pack_bitmap(image))
+
+
+class ReceiptRenderContextTests(TestCase):
+    def sale(self, **extra):
+        return {
+            'id': 7, 'created_at': '2025-01-01 10:00', 'customer': 'عميل',
+            'items': [{'name': 'Panadol', 'quantity': 2, 'unit_type': 'علبة', 'price': 10.0, 'total': 20.0}],
+            'original_total': 20.0, 'discount_amount': 0, 'total': 20.0,
+            'cash_given': 50.0, 'change_return': 30.0, **extra,
+        }
+
+    def test_fonts_and_blocks_are_built_once_per_process(self):
+        from .render_context import get_font, get_render_context
+
+        context = get_render_context()
+        self.assertIs(get_render_context(), context)
+        self.assertIs(get_font('bold', 26), context.title_font)
+        with override_settings(PRINTER_SETTINGS={'PRINTER_DPI': 203, 'INVOICE_PAPER_WIDTH': 72}):
+            wide = get_render_context()
+            self.assertIsNot(wide, context)
+            self.assertEqual(wide.header.width, wide.width_px)
+            self.assertIs(wide.body_font, context.body_font)
+
+    def test_composed_receipt_matches_drawing_every_row(self):
+        from .receipts import render_invoice_image
+        from .render_context import BOTTOM_MARGIN, TOP_MARGIN, get_render_context
+
+        context = get_render_context()
+        image = render_invoice_image(self.sale())
+
+        whole = context.layout()
+        whole.add_space(16)
+        whole.add("صيدلية الإسراء", context.title_font, "center")
+        whole.add("فاتورة مبيعات", context.heading_font, "center")
+        whole.add_space(12)
+        whole.add_rule()
+        whole.add_space(14)
+        whole.add("رقم الفاتورة: 7", context.body_font)
+        whole.add_space(4)
+        whole.add("التاريخ: 2025-01-01 10:00", context.body_font)
+        whole.add_space(4)
+        whole.add("العميل: عميل", context.body_font)
+        whole.add_space(12)
+        whole.add_rule()
+        whole.add_space(14)
+        whole.add_cols("الكمية", "السعر", "الإجمالي", context.body_bold_font)
+        whole.add_rule()
+        whole.add_space(10)
+        whole.add("Panadol", context.body_bold_font)
+        whole.add_space(4)
+        whole.add_cols("2 علبة", "10.00", "20.00", context.body_font)
+        whole.add_space(14)
+        whole.add_rule()
+        whole.add_space(14)
+        whole.add("الإجمالي: 20.00 ج.م", context.body_font)
+        whole.add_space(8)
+        whole.add("الصافي المطلوب: 20.00 ج.م", context.heading_font)
+        whole.add_space(10)
+        whole.add("المبلغ المدفوع: 50.00 ج.م", context.body_font)
+        whole.add_space(4)
+        whole.add("الباقي: 30.00 ج.م", context.body_font)
+        whole.add_space(14)
+        whole.add_rule(thick=True)
+        whole.add_space(20)
+        whole.add("شكراً لزيارتكم", context.heading_font, "center")
+        whole.add_space(4)
+        whole.add("نتمنى لكم دوام الصحة والعافية", context.body_font, "center")
+        whole.add_space(50)
+        expected = whole.render(top=TOP_MARGIN, bottom=BOTTOM_MARGIN)
+
+        self.assertEqual(image.size, expected.size)
+        self.assertEqual(image.tobytes(), expected.tobytes())
+        # The discount row only lengthens the middle section
+        longer = render_invoice_image(self.sale(discount_amount=5.0))
+        self.assertGreater(longer.height, image.height)
+        self.assertEqual(longer.crop((0, 0, longer.width, context.header.height)).tobytes(), context.header.tobytes())
+
+
+class LabelTsplTests(TestCase):
+    GOLDEN = os.path.join(os.path.dirname(__file__), 'testdata', 'label_40x25.prn')
+
+    def render(self):
+        from .labels import render_label_tspl
+        return render_label_tspl('بانادول اكسترا 500 مجم', '6221234567890', '45.50', '03/27', copies=3)
+
+    @override_settings(PRINTER_SETTINGS={'PRINTER_PATH': 'test', 'PRINTER_DPI': 203, 'LABEL_WIDTH': 40, 'LABEL_HEIGHT': 25})
+    def test_label_matches_golden_prn(self):
+        from .render_context import get_font
+        if not getattr(get_font('regular', 24), 'path', '').endswith('DejaVuSans.ttf'):
+            self.skipTest('golden label was rendered with DejaVu Sans')
+        # Regenerate after an intended layout change with:
+        #   python manage.py shell -c "from pharmacy.tests import LabelTsplTests as t; open(t.GOLDEN, 'wb').write(t().render())"
+        with open(self.GOLDEN, 'rb') as f:
+            self.assertEqual(self.render(), f.read())
+
+    def test_long_names_are_cropped_to_the_label(self):
+        from .labels import render_label_tspl
+        payload = render_label_tspl('دواء ' * 30, '123', '9.99')
+        widths = [int(line.split(b',')[2]) for line in payload.split(b'\r\n') if line.startswith(b'BITMAP')]
+        self.assertTrue(all(width * 8 <= 319 for width in widths))
+        self.assertIn(b'"MM/YY"', payload)
+        self.assertTrue(payload.endswith(b'PRINT 1,1\r\n'))
+
+
+class StockCounterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('counter', 'counter@example.com', 'pass')
+        self.client.force_login(self.user)
+        self.today = timezone.now().date()
+        self.medicine = Medicine.objects.create(
+            name='Counter Med', description='d', price=12, purchase_price=6,
+            category='OTC', barcode_number='930000000001', strips_per_box=3,
+        )
+
+    def counters(self):
+        m = Medicine.objects.get(pk=self.medicine.pk)
+        return m.stock, m.strips_available, m.nearest_expiry
+
+    def assertNoDrift(self):
+        from .stock_counters import find_drift
+        self.assertEqual(find_drift(), [])
+
+    def test_lot_writes_adjust_counters_by_delta(self):
+        late = StockEntry.objects.create(medicine=self.medicine, quantity=4, strips_remaining=12,
+                                         expiration_date=self.today + timedelta(days=300))
+        early = StockEntry.objects.create(medicine=self.medicine, quantity=2, strips_remaining=None,
+                                          expiration_date=self.today + timedelta(days=100))
+        self.assertEqual(self.counters(), (6, 18, early.expiration_date))
+
+        early.quantity = 1
+        early.save()
+        self.assertEqual(self.counters(), (5, 15, early.expiration_date))
+        early.delete()
+        self.assertEqual(self.counters(), (4, 12, late.expiration_date))
+        StockEntry.objects.filter(pk=late.pk).delete()
+        self.assertEqual(self.counters(), (0, 0, None))
+        self.assertNoDrift()
+
+    def test_checkout_and_stale_medicine_save_keep_counters_right(self):
+        lot = StockEntry.objects.create(medicine=self.medicine, quantity=3, strips_remaining=9,
+                                        expiration_date=self.today + timedelta(days=60))
+        StockEntry.objects.create(medicine=self.medicine, quantity=2, strips_remaining=6,
+                                  expiration_date=self.today + timedelta(days=90))
+        stale = Medicine.objects.get(pk=self.medicine.pk)
+        fill_cart(self.user, [{
+            'medicine_id': self.medicine.id, 'quantity': 4, 'unit_type': 'BOX',
+            'original_price': 12, 'discounted_price': 12,
+        }])
+        self.client.post(reverse('pharmacy:pos_complete_sale'), {'payment_method': 'CASH', 'action': 'no_print'})
+        self.assertEqual(self.counters()[:2], (1, 3))
+        self.assertEqual(self.counters()[2], self.today + timedelta(days=90))
+
+        stale.name = 'Renamed'
+        stale.save()
+        self.assertEqual(self.counters()[:2], (1, 3))
+        lot.refresh_from_db()
+        self.assertEqual(lot.quantity, 0)
+        self.assertNoDrift()
+
+        medicine = Medicine.objects.get(pk=self.medicine.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(medicine.strips_in_stock, 3)
+
+    def test_rollover_and_reconcile_command(self):
+        from django.core.management import call_command
+        from django.core.management.base import CommandError
+        from .stock_counters import rollover_expired
+
+        StockEntry.objects.create(medicine=self.medicine, quantity=2, strips_remaining=6,
+                                  expiration_date=self.today + timedelta(days=5))
+        StockEntry.objects.create(medicine=self.medicine, quantity=1, strips_remaining=3,
+                                  expiration_date=self.today + timedelta(days=30))
+        self.assertEqual(rollover_expired(self.today + timedelta(days=5)), 0)
+        self.assertEqual(rollover_expired(self.today + timedelta(days=6)), 1)
+        self.assertEqual(self.counters(), (1, 3, self.today + timedelta(days=30)))
+
+        Medicine.objects.filter(pk=self.medicine.pk).update(stock=99)
+        with self.assertRaises(CommandError):
+            call_command('reconcile_stock', stdout=io.StringIO())
+        call_command('reconcile_stock', '--fix', stdout=io.StringIO())
+        self.assertEqual(self.counters(), (3, 9, self.today + timedelta(days=5)))
+
+
+class StockLedgerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('ledger', 'ledger@example.com', 'pass')
+        self.client.force_login(self.user)
+        self.today = timezone.now().date()
+        self.medicine = Medicine.objects.create(
+            name='Ledger Med', description='d', price=10, purchase_price=5,
+            category='OTC', barcode_number='940000000001', strips_per_box=2,
+        )
+
+    def movements(self):
+        return list(StockMovement.objects.filter(medicine=self.medicine)
+                    .values_list('reason', 'boxes', 'strips', 'reference'))
+
+    def test_movements_are_recorded_with_their_reason(self):
+        from .stock_ledger import movement_reason
+
+        expiry = self.today + timedelta(days=200)
+        with movement_reason(StockMovement.INTAKE):
+            lot = StockEntry.objects.create(medicine=self.medicine, quantity=5, strips_remaining=10,
+                                            expiration_date=expiry)
+        fill_cart(self.user, [{
+            'medicine_id': self.medicine.id, 'quantity': 2, 'unit_type': 'BOX',
+            'original_price': 10, 'discounted_price': 10,
+        }])
+        self.client.post(reverse('pharmacy:pos_complete_sale'), {'payment_method': 'CASH', 'action': 'no_print'})
+        sale = Sale.objects.latest('id')
+        lot.refresh_from_db()
+        lot.quantity = 4
+        lot.strips_remaining = 8
+        lot.save()
+
+        self.assertEqual(self.movements(), [
+            (StockMovement.INTAKE, 5, 10, ''),
+            (StockMovement.SALE, -2, -4, f'sale:{sale.id}'),
+            (StockMovement.EDIT, 1, 2, ''),
+        ])
+
+        # An expired lot thrown away is a write-off
+        old = StockEntry.objects.create(medicine=self.medicine, quantity=1, strips_remaining=2,
+                                        expiration_date=self.today - timedelta(days=3))
+        old.delete()
+        self.assertEqual(self.movements()[-1], (StockMovement.WRITE_OFF, -1, -2, ''))
+
+    def test_inventory_at_replays_movements_since_checkpoint(self):
+        from .stock_ledger import inventory_at, medicine_totals_at, take_checkpoint
+
+        expiry = self.today + timedelta(days=90)
+        lot = StockEntry.objects.create(medicine=self.medicine, quantity=3, strips_remaining=6,
+                                        expiration_date=expiry)
+        with self.assertRaises(ValueError):
+            inventory_at(timezone.now() - timedelta(days=1))
+        take_checkpoint()
+        before = timezone.now()
+        lot.quantity, lot.strips_remaining = 1, 2
+        lot.save()
+        StockEntry.objects.create(medicine=self.medicine, quantity=2, strips_remaining=4,
+                                  expiration_date=self.today + timedelta(days=30))
+
+        self.assertEqual(inventory_at(before), {(self.medicine.id, expiry): (3, 6)})
+        self.assertEqual(medicine_totals_at(timezone.now()), {self.medicine.id: (3, 6)})
+
+        call_command('stock_checkpoint', stdout=io.StringIO())
+        self.assertEqual(medicine_totals_at(timezone.now()), {self.medicine.id: (3, 6)})
+
+    def test_string_expiry_and_medicine_delete(self):
+        lot = StockEntry(medicine=self.medicine, quantity=1, strips_remaining=2,
+                         expiration_date=(self.today + timedelta(days=10)).isoformat())
+        lot.save()
+        self.assertEqual(lot.expiration_date, self.today + timedelta(days=10))
+        self.medicine.delete()
+        self.assertFalse(StockEntry.objects.exists())
+        self.assertFalse(StockMovement.objects.exists())
+
+
+@override_settings(REPORTS_BASIC_AUTH_PASS='')
+class InventoryValuationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('valuer', 'valuer@example.com', 'pass')
+        self.client.force_login(self.user)
+        self.today = timezone.now().date()
+        self.medicine = Medicine.objects.create(
+            name='Valued Med', description='d', price=Decimal('30.00'), purchase_price=Decimal('18.00'),
+            category='OTC', barcode_number='950000000001', strips_per_box=3,
+        )
+        # 2 full boxes + 2 loose strips sellable, and an expired lot that counts for nothing
+        StockEntry.objects.create(medicine=self.medicine, quantity=2, strips_remaining=8,
+                                  expiration_date=self.today + timedelta(days=120))
+        StockEntry.objects.create(medicine=self.medicine, quantity=5, strips_remaining=15,
+                                  expiration_date=self.today - timedelta(days=1))
+        Medicine.objects.create(
+            name='Empty Med', description='d', price=5, purchase_price=2,
+            category='SUP', barcode_number='950000000002', strips_per_box=1,
+        )
+
+    def test_values_boxes_and_loose_strips_in_one_query(self):
+        from .inventory_valuation import inventory_totals, valued_medicines
+
+        with self.assertNumQueries(1):
+            rows = list(valued_medicines())
+        self.assertEqual([(r.name, r.boxes, r.strips) for r in rows], [('Empty Med', 0, 0), ('Valued Med', 2, 2)])
+        valued = rows[1]
+        self.assertEqual(valued.selling, Decimal('80.00'))  # 2 x 30 + 2 x 10
+        self.assertEqual(valued.cost, Decimal('48.00'))     # 2 x 18 + 2 x 6
+        self.assertEqual(valued.category_display, 'Over The Counter')
+
+        totals = inventory_totals()
+        self.assertEqual((totals.count, totals.selling, totals.cost, totals.profit),
+                         (1, Decimal('80.00'), Decimal('48.00'), Decimal('32.00')))
+
+    def test_reports_and_commands_share_the_valuation(self):
+        response = self.client.get(reverse('reports:inventory_summary'))
+        self.assertEqual((response.context['total_selling'], response.context['total_purchase']),
+                         ('80.00', '48.00'))
+        # /reports/ itself resolves to pharmacy's report_dashboard, so call the view
+        from django.test import RequestFactory
+        from reports import views as report_views
+        response = report_views.reports_dashboard(RequestFactory().get('/reports/'))
+        self.assertContains(response, '48.00')
+        self.assertContains(response, 'Valued Med')
+        self.assertNotContains(response, 'Empty Med')
+        response = self.client.get(reverse('pharmacy:inventory_report'))
+        self.assertEqual(response.context['total_purchase_cost'], Decimal('48.00'))
+        self.assertEqual(response.context['total_value'], Decimal('60.00'))
+
+        out = io.StringIO()
+        call_command('current_inventory_value', stdout=out)
+        self.assertIn('Products currently in stock: 1', out.getvalue())
+        self.assertIn('Total potential cost value:    48.00', out.getvalue())
+
+
+class StockOverviewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('overview', 'overview@example.com', 'pass')
+        self.client.force_login(self.user)
+        self.today = timezone.now().date()
+        self.medicines = []
+        for i, (category, reorder_level) in enumerate([('OTC', 10), ('SUP', 1), ('OTC', 1), ('PRE', 1), ('OTC', 1)]):
+            medicine = Medicine.objects.create(
+                name=f'Overview {i}', description='d', price=10, purchase_price=5, category=category,
+                barcode_number=f'96000000000{i}', strips_per_box=1, reorder_level=reorder_level,
+            )
+            StockEntry.objects.create(medicine=medicine, quantity=3, expiration_date=self.today + timedelta(days=200))
+            self.medicines.append(medicine)
+        StockEntry.objects.create(medicine=self.medicines[1], quantity=2, expiration_date=self.today + timedelta(days=10))
+        StockEntry.objects.create(medicine=self.medicines[1], quantity=4, expiration_date=self.today - timedelta(days=10))
+
+    def test_page_is_one_read_only_query(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('pharmacy:stock_view'))
+        self.assertEqual(response.status_code, 200)
+        page_queries = [q['sql'] for q in queries.captured_queries if 'pharmacy_stockentry' in q['sql']]
+        self.assertEqual(len(page_queries), 1)
+        self.assertFalse([q for q in queries.captured_queries if not q['sql'].lstrip().upper().startswith('SELECT')])
+
+        row = next(r for r in response.context['stock_data'] if r['id'] == self.medicines[1].id)
+        self.assertEqual((row['available_stock'], row['expired_stock'], row['near_expiry_stock'], row['lot_count']),
+                         (5, 4, 2, 3))
+
+    def test_filters_and_keyset_pages(self):
+        from .stock_overview import overview_page
+
+        response = self.client.get(reverse('pharmacy:stock_view'), {'category': 'OTC', 'low_stock': '1'})
+        self.assertEqual([r['name'] for r in response.context['stock_data']], ['Overview 0'])
+        response = self.client.get(reverse('pharmacy:stock_view'), {'expiring': '1'})
+        self.assertEqual([r['name'] for r in response.context['stock_data']], ['Overview 1'])
+
+        names, cursor = [], None
+        while True:
+            page = overview_page(self.today, cursor, page_size=2)
+            names += [r['name'] for r in page.rows]
+            if page.next_cursor is None:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(names, [f'Overview {i}' for i in range(5)])
+        # A tampered cursor starts over
+        self.assertEqual(overview_page(self.today, cursor + 'x', page_size=2).rows[0]['name'], 'Overview 0')
+
+    def test_lots_load_per_card(self):
+        response = self.client.get(reverse('pharmacy:stock_view_lots', args=[self.medicines[1].id]))
+        self.assertEqual([lot['status'] for lot in response.context['lots']], ['expired', 'near_expiry', 'good'])
+        self.assertContains(response, 'Near Expiry')
+
+
+@override_settings(REPORTS_BASIC_AUTH_PASS='')
+class InventorySnapshotTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('snapshot', 'snapshot@example.com', 'pass')
+        self.client.force_login(self.user)
+        self.today = timezone.localdate()
+        self.medicine = Medicine.objects.create(
+            name='Snapshot Med', description='d', price=Decimal('20.00'), purchase_price=Decimal('12.00'),
+            category='OTC', barcode_number='970000000001', strips_per_box=2,
+        )
+
+    def days_ago(self, days):
+        return timezone.now() - timedelta(days=days)
+
+    def test_nightly_snapshot_and_history_page(self):
+        from .models import InventorySnapshot
+
+        StockEntry.objects.create(medicine=self.medicine, quantity=3, strips_remaining=7,
+                                  expiration_date=self.today + timedelta(days=100))
+        call_command('inventory_snapshot', stdout=io.StringIO())
+        snapshot = InventorySnapshot.objects.get(date=self.today)
+        self.assertEqual((snapshot.medicines_in_stock, snapshot.boxes, snapshot.strips), (1, 3, 1))
+        self.assertEqual((snapshot.cost_value, snapshot.selling_value), (Decimal('42.00'), Decimal('70.00')))
+        self.assertEqual(list(snapshot.lines.values_list('medicine_id', 'boxes', 'strips')),
+                         [(self.medicine.id, 3, 1)])
+
+        with self.assertNumQueries(4):  # session, user, profile (base template), snapshots
+            response = self.client.get(reverse('reports:inventory_history'))
+        self.assertEqual([row['selling_value'] for row in response.context['history']], [Decimal('70.00')])
+        response = self.client.get(reverse('reports:inventory_history'), {'medicine': self.medicine.id})
+        self.assertEqual([row['boxes'] for row in response.context['history']], [3])
+
+    def test_backfill_replays_ledger_and_undoes_older_sales(self):
+        from .inventory_snapshots import backfill_snapshots
+        from .models import InventorySnapshot, StockCheckpoint, StockMovement
+
+        # The ledger starts 5 days ago with nothing on the shelf; 3 boxes came in 3 days ago
+        StockCheckpoint.objects.update(taken_at=self.days_ago(5))
+        expiry = self.today + timedelta(days=100)
+        StockEntry.objects.create(medicine=self.medicine, quantity=3, strips_remaining=6, expiration_date=expiry)
+        StockMovement.objects.update(created_at=self.days_ago(3))
+        # ...and a box was sold 7 days ago, before the ledger existed
+        sale = Sale.objects.create(user=self.user, total_amount=20, is_completed=True)
+        SaleItem.objects.create(sale=sale, medicine=self.medicine, quantity=1, price=20,
+                                expiry_date=expiry, unit_type='BOX')
+        Sale.objects.filter(pk=sale.pk).update(created_at=self.days_ago(7))
+
+        self.assertEqual(backfill_snapshots(self.today - timedelta(days=8)), 8)
+        boxes = dict(InventorySnapshot.objects.values_list('date', 'boxes'))
+        self.assertEqual([boxes[self.today - timedelta(days=d)] for d in range(8, 0, -1)],
+                         [1, 0, 0, 0, 0, 3, 3, 3])
+        self.assertFalse(InventorySnapshot.objects.filter(backfilled=False).exists())
+        # Days that exist are kept unless overwritten
+        self.assertEqual(backfill_snapshots(self.today - timedelta(days=8)), 0)
+
+
+class StockIntakeTests(TestCase):
+    def setUp(self):
+        self.today = timezone.now().date()
+        self.medicines = [
+            Medicine.objects.create(
+                name=f'Intake {i}', description='d', price=10, purchase_price=5, category='OTC',
+                barcode_number=f'98000000000{i}', strips_per_box=2 + i,
+            )
+            for i in range(3)
+        ]
+
+    def test_upsert_adds_to_lots_and_feeds_counters_and_ledger(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .stock_counters import find_drift
+        from .stock_intake import intake_lots
+        from .stock_ledger import movement_reason
+
+        first, second, third = self.medicines
+        expiry = self.today + timedelta(days=90)
+        StockEntry.objects.create(medicine=first, quantity=2, strips_remaining=3, expiration_date=expiry)
+        # A lot from before strips were tracked
+        StockEntry.objects.create(medicine=second, quantity=1, strips_remaining=None, expiration_date=expiry)
+        StockMovement.objects.all().delete()
+
+        lines = [(first.id, expiry, 1), (second.id, expiry.isoformat(), 2), (first.id, expiry, 1),
+                 (third.id, self.today + timedelta(days=30), 4), (third.id, expiry, 0)]
+        lines += [(third.id, self.today + timedelta(days=100 + i), 1) for i in range(450)]
+        with CaptureQueriesContext(connection) as queries, movement_reason(StockMovement.INTAKE, 'test'):
+            merged = intake_lots(lines)
+        self.assertEqual(len(merged), 453)
+        writes = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "pharmacy_stockentry"')]
+        self.assertEqual(len(writes), 3)  # 453 lots in batches of 200
+        self.assertLess(len(queries.captured_queries), 15)
+
+        lots = {(e.medicine_id, e.expiration_date): (e.quantity, e.strips_remaining) for e in StockEntry.objects.all()}
+        self.assertEqual(lots[first.id, expiry], (4, 7))
+        self.assertEqual(lots[second.id, expiry], (3, 9))
+        self.assertEqual(lots[third.id, self.today + timedelta(days=30)], (4, 16))
+        self.assertNotIn((third.id, expiry), lots)
+
+        self.assertEqual(find_drift(), [])
+        self.assertEqual(Medicine.objects.get(pk=third.pk).stock, 454)
+        self.assertEqual(
+            list(StockMovement.objects.filter(medicine=first).values_list('reason', 'boxes', 'strips', 'reference')),
+            [(StockMovement.INTAKE, 2, 4, 'test')],
+        )
+
+    def test_receiving_a_purchase_costs_its_lots_in_constant_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        user = User.objects.create_user(username='receiver', password='pw')
+        self.client.force_login(user)
+        supplier = Supplier.objects.create(name='S', contact_person='c', phone='1', email='s@example.com', address='a')
+        first = self.medicines[0]
+        expiry = self.today + timedelta(days=90)
+        StockEntry.objects.create(medicine=first, quantity=2, strips_remaining=4, expiration_date=expiry, unit_cost=4)
+
+        def purchase(number, lines):
+            order = Purchase.objects.create(supplier=supplier, invoice_number=number, created_by=user)
+            PurchaseItem.objects.bulk_create([
+                PurchaseItem(purchase=order, medicine=medicine, quantity=quantity, price=price, expiry_date=day)
+                for medicine, day, quantity, price in lines
+            ])
+            with CaptureQueriesContext(connection) as queries:
+                self.client.post(reverse('pharmacy:receive_purchase', args=[order.pk]))
+            return order, len(queries.captured_queries)
+
+        small, small_queries = purchase('PO-S', [(first, expiry, 2, 6)])
+        large, large_queries = purchase('PO-L', [
+            (medicine, self.today + timedelta(days=30 + i), 1, 2) for i in range(40) for medicine in self.medicines
+        ])
+        self.assertEqual(small_queries, large_queries)
+        self.assertEqual(StockEntry.objects.get(medicine=first, expiration_date=expiry).unit_cost, Decimal('5.00'))
+        self.assertEqual(StockEntry.objects.filter(unit_cost=2).count(), 120)
+        self.assertEqual(Purchase.objects.get(pk=large.pk).status, 'RECEIVED')
+
+        # A second receive (double submit) adds nothing
+        stock = Medicine.objects.get(pk=first.pk).stock
+        self.client.post(reverse('pharmacy:receive_purchase', args=[small.pk]))
+        self.assertEqual(Medicine.objects.get(pk=first.pk).stock, stock)
+
+
+
+class ImportProductsTests(TestCase):
+    def setUp(self):
+        import tempfile
+        from openpyxl import Workbook
+
+        self.today = timezone.now().date()
+        self.expiry = self.today + timedelta(days=200)
+        self.existing = Medicine.objects.create(
+            name='Old name', description='d', price=10, purchase_price=5, category='OTC',
+            barcode_number='970000000001', strips_per_box=2,
+        )
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(['الباركود', 'اسم الصنف', 'الكمية', 'سعر الشراء', 'سعر البيع',
+                      'تاريخ انتهاء الصلاحيه', 'إجمالي سعر البيع'])
+        sheet.append([970000000001, 'New name', 3, 6, 12, self.expiry.strftime('%d/%m/%Y'), 36])
+        sheet.append(['970000000002', 'Imported A', 5, 2.5, 4, self.expiry, 20])
+        sheet.append([970000000002.0, 'Imported A', 1, 2.5, 4, self.expiry, 4])
+        sheet.append(['970000000003', 'Imported B', 0, 1, 2, None, 0])
+        sheet.append(['not a barcode', 'Broken', 1, 1, 1, None, 1])
+        sheet.append(['970000000004', '', 1, 1, 1, None, 1])
+        handle, self.path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(handle)
+        workbook.save(self.path)
+        self.addCleanup(os.remove, self.path)
+
+    def test_import_in_chunks_upserts_medicines_and_adds_stock(self):
+        from .stock_counters import find_drift
+
+        out = io.StringIO()
+        call_command('import_products', self.path, '--chunk-size', '2', stdout=out)
+        self.assertIn('2 new, 1 updated', out.getvalue())
+        self.assertIn('2 row(s) skipped', out.getvalue())
+
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.name, self.existing.price, self.existing.strip_price),
+                         ('New name', Decimal('12.00'), Decimal('6.00')))
+        self.assertEqual(self.existing.stock, 3)
+        imported = Medicine.objects.get(barcode_number='970000000002')
+        self.assertEqual((imported.name, imported.purchase_price, imported.stock), ('Imported A', Decimal('2.50'), 6))
+        self.assertTrue(Medicine.objects.filter(barcode_number='970000000003', stock=0).exists())
+        self.assertFalse(Medicine.objects.filter(name='Broken').exists())
+        self.assertEqual(
+            set(StockEntry.objects.values_list('medicine__barcode_number', 'expiration_date', 'quantity')),
+            {('970000000001', self.expiry, 3), ('970000000002', self.expiry, 6)},
+        )
+        self.assertEqual(set(StockMovement.objects.values_list('reason', 'reference')),
+                         {(StockMovement.INTAKE, 'import')})
+        self.assertEqual(find_drift(), [])
+
+    def test_dry_run_saves_nothing(self):
+        out = io.StringIO()
+        call_command('import_products', self.path, '--dry-run', stdout=out)
+        self.assertIn('Dry run, nothing saved', out.getvalue())
+        self.assertIn('2 new, 1 updated', out.getvalue())
+        self.assertEqual(Medicine.objects.count(), 1)
+        self.assertEqual(Medicine.objects.get().name, 'Old name')
+        self.assertFalse(StockEntry.objects.exists())
+        self.assertFalse(StockMovement.objects.exists())
+
+
+class BarcodeImageTests(TestCase):
+    def setUp(self):
+        import shutil
+        import tempfile
+        from .barcodes import barcode_images
+
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        barcode_images.clear()
+        self.addCleanup(barcode_images.clear)
+        self.media_root = media_root
+        self.user = get_user_model().objects.create_user(username='barcodes', password='pw')
+        self.client.force_login(self.user)
+
+    def test_numbers_are_allocated_without_drawing_images(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .barcodes import new_barcode_numbers
+
+        medicine = Medicine.objects.create(name='No barcode', description='d', price=10, purchase_price=5,
+                                           category='OTC', barcode_number='')
+        self.assertEqual(len(medicine.barcode_number), 12)
+        self.assertFalse(medicine.barcode)
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, 'barcodes')))
+
+        with CaptureQueriesContext(connection) as queries:
+            numbers = new_barcode_numbers(1000)
+        self.assertEqual(len(set(numbers)), 1000)
+        self.assertNotIn(medicine.barcode_number, numbers)
+        self.assertLessEqual(len(queries.captured_queries), 5)
+
+    def test_image_is_drawn_once_and_served_with_etag(self):
+        from .barcodes import barcode_images
+
+        Medicine.objects.create(name='Drawn', description='d', price=10, purchase_price=5, category='OTC',
+                                barcode_number='622000000001')
+        url = reverse('pharmacy:barcode_image', args=['622000000001'])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertTrue(response.content.startswith(b'\x89PNG'))
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, 'barcodes', 'ean13', '6220000000013.png')))
+
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        # Later requests come from memory, or the stored file after a restart
+        barcode_images.clear()
+        self.assertEqual(self.client.get(url).content, response.content)
+
+        self.assertEqual(self.client.get(reverse('pharmacy:barcode_image', args=['12ab'])).status_code, 404)
+
+    def test_only_medicine_numbers_are_drawn_once_per_full_code(self):
+        Medicine.objects.create(name='Drawn', description='d', price=10, purchase_price=5, category='OTC',
+                                barcode_number='1234567890128')
+        short, wrong_check = (self.client.get(reverse('pharmacy:barcode_image', args=[number]))
+                              for number in ('123456789012', '1234567890123'))
+        self.assertEqual((short.status_code, wrong_check.status_code), (200, 200))
+        self.assertEqual(short['ETag'], wrong_check['ETag'])
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'barcodes', 'ean13')), ['1234567890128.png'])
+
+        self.assertEqual(self.client.get(reverse('pharmacy:barcode_image', args=['622999999999'])).status_code, 404)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'barcodes', 'ean13')), ['1234567890128.png'])
+
+
+class StockDoctorTests(TestCase):
+    def setUp(self):
+        self.today = timezone.now().date()
+        self.medicine = Medicine.objects.create(
+            name='Doctor', description='d', price=10, purchase_price=5, category='OTC',
+            barcode_number='960000000001', strips_per_box=10,
+        )
+
+    def lot(self, days, quantity, strips):
+        entry = StockEntry.objects.create(medicine=self.medicine, quantity=1, strips_remaining=10,
+                                          expiration_date=self.today + timedelta(days=days))
+        # Damage written behind the counters' back, as old code paths did
+        StockEntry.objects.filter(pk=entry.pk).update(quantity=quantity, strips_remaining=strips)
+        return entry
+
+    def test_finds_and_repairs_damage_in_one_pass(self):
+        import json
+        import tempfile
+        from django.core.management.base import CommandError
+        from .stock_counters import find_drift
+        from .stock_doctor import examine
+
+        negative = self.lot(30, -2, 5)
+        mismatched = self.lot(60, 5, 23)
+        empty = self.lot(90, 0, 0)
+        healthy = self.lot(120, 3, 30)
+
+        with self.assertRaises(CommandError):
+            call_command('stock_doctor', stdout=io.StringIO())
+        found = examine()
+        self.assertEqual(found['negative']['sample'], [negative.pk])
+        self.assertEqual(found['strips']['sample'], [negative.pk, mismatched.pk])
+        self.assertEqual(found['empty']['sample'], [empty.pk])
+        self.assertEqual(found['counters']['found'], 1)
+
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as report_file:
+            call_command('stock_doctor', '--fix', '--report', report_file.name, stdout=io.StringIO())
+            report = json.load(report_file)
+        self.assertEqual(report['fixed']['empty'], 1)
+        self.assertEqual(report['fixed']['strips'], 1)  # clamping already fixed the negative lot
+
+        lots = {e.pk: (e.quantity, e.strips_remaining) for e in StockEntry.objects.all()}
+        self.assertEqual(lots, {negative.pk: (0, 5), mismatched.pk: (2, 23), healthy.pk: (3, 30)})
+        self.assertTrue(all(result['found'] == 0 for result in examine().values()))
+        self.assertEqual(find_drift(), [])
+        self.assertEqual(
+            list(StockMovement.objects.filter(reference='stock_doctor', expiration_date=mismatched.expiration_date)
+                 .values_list('boxes', 'strips')),
+            [(-3, 0)],
+        )
+
+    def test_cleans_up_a_sold_out_lot(self):
+        from django.db import connection
+
+        user = User.objects.create_user(username='doctor', password='pw')
+        lot = StockEntry.objects.create(medicine=self.medicine, quantity=1, strips_remaining=10,
+                                        expiration_date=self.today + timedelta(days=30))
+        self.medicine.update_stock()
+        self.client.force_login(user)
+        fill_cart(user, [{
+            'medicine_id': self.medicine.id, 'name': self.medicine.name, 'quantity': 1, 'unit_type': 'BOX',
+            'expiration_date': lot.expiration_date.strftime('%Y-%m-%d'),
+            'original_price': 10.0, 'discounted_price': 10.0, 'total': 10.0,
+        }])
+        self.client.post(reverse('pharmacy:pos_complete_sale'), {'payment_method': 'CASH', 'action': 'no_print'})
+        self.assertEqual(SaleItem.objects.get().lot, lot)
+
+        call_command('stock_doctor', '--fix', stdout=io.StringIO())
+        # SQLite defers the foreign key check to the commit
+        connection.check_constraints()
+
+        self.assertFalse(StockEntry.objects.exists())
+        self.assertIsNone(SaleItem.objects.get().lot)
+
+
+class HistoricalCostTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='historian', password='pw')
+        self.medicine = Medicine.objects.create(
+            name='Costed', description='d', price=20, purchase_price=14, category='OTC',
+            barcode_number='950000000001', strips_per_box=4,
+        )
+        self.never_bought = Medicine.objects.create(
+            name='Never bought', description='d', price=9, purchase_price=6, category='OTC',
+            barcode_number='950000000002',
+        )
+        self.supplier = Supplier.objects.create(name='S', contact_person='c', phone='1', email='s@example.com',
+                                                address='a')
+        self.now = timezone.now()
+
+    def purchase(self, days_ago, price):
+        purchase = Purchase.objects.create(supplier=self.supplier, invoice_number=f'H-{days_ago}',
+                                           created_by=self.user)
+        Purchase.objects.filter(pk=purchase.pk).update(date=self.now - timedelta(days=days_ago))
+        PurchaseItem.objects.create(purchase=purchase, medicine=self.medicine, quantity=10, price=price,
+                                    expiry_date=self.now.date() + timedelta(days=300))
+
+    def sale(self, days_ago, medicine, unit_type, quantity, price):
+        sale = Sale.objects.create(user=self.user, total_amount=price * quantity, is_completed=True)
+        Sale.objects.filter(pk=sale.pk).update(created_at=self.now - timedelta(days=days_ago))
+        SaleItem.objects.create(sale=sale, medicine=medicine, quantity=quantity, price=price,
+                                expiry_date=self.now.date() + timedelta(days=300), unit_type=unit_type)
+
+    def test_lines_are_costed_as_of_their_sale_day_in_two_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .historical_cost import sale_lines
+
+        self.purchase(30, 10)
+        self.purchase(10, 12)
+        self.sale(40, self.medicine, 'BOX', 1, 20)      # before any purchase: current price
+        self.sale(20, self.medicine, 'STRIP', 2, 6)     # first purchase, per strip
+        self.sale(10, self.medicine, 'BOX', 3, 20)      # purchased the same day
+        self.sale(5, self.never_bought, 'BOX', 1, 9)
+
+        with CaptureQueriesContext(connection) as queries:
+            lines = list(sale_lines())
+        self.assertEqual(len(queries.captured_queries), 2)
+        self.assertEqual([line.unit_cost for line in lines],
+                         [Decimal('14'), Decimal('2.5'), Decimal('12'), Decimal('6')])
+        self.assertEqual([line.profit for line in lines],
+                         [Decimal('6'), Decimal('7'), Decimal('24'), Decimal('3')])
+        self.assertEqual(lines[1].current_profit, Decimal('5'))
+
+        window = list(sale_lines(start=self.now.date() - timedelta(days=25), end=self.now.date() - timedelta(days=8)))
+        self.assertEqual([line.unit_type for line in window], ['STRIP', 'BOX'])
+
+        out = io.StringIO()
+        call_command('sales_summary_historical', stdout=out)
+        self.assertIn('Total profit using historical purchase prices: 40.00', out.getvalue())
+        out = io.StringIO()
+        call_command('sales_profit_by_medicine', stdout=out)
+        self.assertIn('sold=92.00 profit=37.00 items=3', out.getvalue())
+        out = io.StringIO()
+        call_command('price_anomalies', '--min-margin', '0.5', stdout=out)
+        self.assertIn('reasons=low_margin', out.getvalue())
+
+
+class SaleCostTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='coster', password='pw')
+        self.client.force_login(self.user)
+        self.expiry = timezone.now().date() + timedelta(days=200)
+        self.medicine = Medicine.objects.create(
+            name='Snapshot', description='d', price=20, purchase_price=10, category='OTC',
+            barcode_number='960000000001', strips_per_box=3,
+        )
+
+    def test_checkout_records_lot_cost_and_profit_ignores_later_price_changes(self):
+        lot = StockEntry.objects.create(medicine=self.medicine, quantity=5, strips_remaining=15,
+                                        expiration_date=self.expiry, unit_cost=Decimal('12'))
+        self.medicine.update_stock()
+        fill_cart(self.user, [
+            {'medicine_id': self.medicine.id, 'quantity': 2, 'unit_type': 'BOX',
+             'original_price': 20, 'discounted_price': 20},
+            {'medicine_id': self.medicine.id, 'quantity': 2, 'unit_type': 'STRIP',
+             'original_price': 7, 'discounted_price': 7},
+        ])
+        self.client.post(reverse('pharmacy:pos_complete_sale'), {'payment_method': 'CASH', 'action': 'no_print'})
+
+        items = SaleItem.objects.order_by('id')
+        self.assertEqual([(item.lot_id, item.unit_cost) for item in items],
+                         [(lot.id, Decimal('12')), (lot.id, Decimal('4'))])
+        Medicine.objects.filter(pk=self.medicine.pk).update(purchase_price=50)
+        sale = Sale.objects.get()
+        self.assertEqual(sale.total_profit, Decimal('22'))
+        self.assertEqual(sale.get_profit_by_category(), {'Over The Counter': Decimal('22')})
+
+        from .utils_profit import get_total_profit
+        self.assertEqual(get_total_profit(), Decimal('22'))
+        analytics = ProfitAnalytics.generate_daily_report(timezone.now().date())
+        self.assertEqual((analytics.total_cost, analytics.total_profit), (Decimal('32'), Decimal('22')))
+        self.assertEqual(analytics.most_profitable_medicine_id, self.medicine.id)
+
+    def test_backfill_costs_old_lines_from_purchase_history(self):
+        supplier = Supplier.objects.create(name='S', contact_person='c', phone='1', email='s@example.com',
+                                           address='a')
+        purchase = Purchase.objects.create(supplier=supplier, invoice_number='B-1', created_by=self.user)
+        Purchase.objects.filter(pk=purchase.pk).update(date=timezone.now() - timedelta(days=5))
+        PurchaseItem.objects.create(purchase=purchase, medicine=self.medicine, quantity=10, price=9,
+                                    expiry_date=self.expiry)
+        lot = StockEntry.objects.create(medicine=self.medicine, quantity=1, strips_remaining=3,
+                                        expiration_date=self.expiry)
+        sale = Sale.objects.create(user=self.user, total_amount=27, is_completed=True)
+        for unit_type, quantity, price in (('BOX', 1, 20), ('STRIP', 1, 7)):
+            SaleItem.objects.create(sale=sale, medicine=self.medicine, quantity=quantity, price=price,
+                                    expiry_date=self.expiry, unit_type=unit_type)
+        # Today's price until costed
+        self.assertEqual(sale.total_profit.quantize(Decimal('0.01')), Decimal('13.67'))
+
+        out = io.StringIO()
+        call_command('backfill_sale_costs', '--chunk-size', '1', stdout=out)
+        self.assertIn('Costed 2 sale item(s), 2 linked to their lot', out.getvalue())
+        self.assertEqual(list(SaleItem.objects.order_by('id').values_list('unit_cost', 'lot_id')),
+                         [(Decimal('9'), lot.id), (Decimal('3'), lot.id)])
+        self.assertEqual(sale.total_profit, Decimal('15'))
+        out = io.StringIO()
+        call_command('backfill_sale_costs', stdout=out)
+        self.assertIn('already has its cost', out.getvalue())
+
+    def test_sql_profit_matches_the_python_property_to_the_piastre(self):
+        from .sale_costs import profit_by, profit_totals, sales_totals
+
+        medicines = [self.medicine] + [
+            Medicine.objects.create(name=f'Odd {spb}', description='d', price=13, purchase_price=price,
+                                    category=category, barcode_number=f'96000000001{spb}', strips_per_box=spb)
+            for spb, price, category in ((7, Decimal('10.55'), 'RX'), (9, Decimal('13'), 'OTC'))
+        ]
+        now = timezone.now()
+        for day in range(3):
+            sale = Sale.objects.create(user=self.user, total_amount=100, is_completed=True)
+            Sale.objects.filter(pk=sale.pk).update(created_at=now - timedelta(days=day * 40))
+            for i, medicine in enumerate(medicines):
+                for unit_type in ('BOX', 'STRIP'):
+                    SaleItem.objects.create(
+                        sale=sale, medicine=medicine, quantity=1 + (day + i) % 4, unit_type=unit_type,
+                        price=Decimal('3.35') if unit_type == 'STRIP' else Decimal('19.99'), expiry_date=self.expiry,
+                        unit_cost=Decimal('1.4286') if (day, i) == (1, 1) else None,
+                    )
+        items = list(SaleItem.objects.select_related('medicine'))
+        cent = Decimal('0.01')
+
+        def python_profit(lines):
+            return sum(item.profit for item in lines).quantize(cent)
+
+        with self.assertNumQueries(1):
+            totals = sales_totals(Sale.objects.filter(is_completed=True))
+        self.assertEqual(totals['profit'].quantize(cent), python_profit(items))
+        self.assertEqual((totals['revenue'], totals['sales']), (Decimal('300'), 3))
+        self.assertEqual(profit_totals(SaleItem.objects.all())['profit'].quantize(cent), python_profit(items))
+        for row in profit_by(SaleItem.objects.all(), 'medicine'):
+            self.assertEqual(row['profit'].quantize(cent),
+                             python_profit(item for item in items if item.medicine_id == row['key']))
+        for group in ('day', 'month', 'category'):
+            rows = list(profit_by(SaleItem.objects.all(), group))
+            self.assertEqual(sum(row['profit'] for row in rows).quantize(cent), python_profit(items))
+        self.assertEqual(len(profit_by(SaleItem.objects.all(), 'day')), 3)
+        self.assertEqual([row['key'] for row in profit_by(SaleItem.objects.all(), 'category')], ['OTC', 'RX'])
+
+        response = self.client.get(reverse('pharmacy:profit_report'))
+        self.assertContains(response, f'{python_profit(items):.2f}')
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='roller', password='pw')
+        self.user.userprofile.role = 'ADMIN'
+        self.user.userprofile.save()
+        self.client.force_login(self.user)
+        self.expiry = timezone.now().date() + timedelta(days=200)
+        self.medicine = Medicine.objects.create(
+            name='Rolled', description='d', price=20, purchase_price=12, category='OTC',
+            barcode_number='970000000001', strips_per_box=4,
+        )
+        StockEntry.objects.create(medicine=self.medicine, quantity=10, strips_remaining=40,
+                                  expiration_date=self.expiry)
+        self.medicine.update_stock()
+
+    def rollup(self):
+        from .models import DailySales
+        return list(DailySales.objects.order_by('unit_type').values_list('unit_type', 'quantity', 'revenue', 'cost'))
+
+    def test_checkout_and_return_keep_the_rollup_current(self):
+        from .sales_rollup import rebuild
+
+        fill_cart(self.user, [
+            {'medicine_id': self.medicine.id, 'quantity': 2, 'unit_type': 'BOX',
+             'original_price': 20, 'discounted_price': 20},
+            {'medicine_id': self.medicine.id, 'quantity': 3, 'unit_type': 'STRIP',
+             'original_price': 6, 'discounted_price': 6},
+        ])
+        self.client.post(reverse('pharmacy:pos_complete_sale'), {'payment_method': 'CASH', 'action': 'no_print'})
+        self.assertEqual(self.rollup(), [('BOX', 2, Decimal('40'), Decimal('24')),
+                                         ('STRIP', 3, Decimal('18'), Decimal('9'))])
+
+        response = self.client.get(reverse('pharmacy:profit_analytics'))
+        self.assertEqual(response.context['summary']['total_profit'], Decimal('25'))
+        self.assertEqual(response.context['summary']['total_transactions'], 1)
+        self.assertEqual(response.context['category_profits'], {'Over The Counter': Decimal('25')})
+        self.assertEqual(response.context['top_medicines'][0].total_profit, Decimal('25'))
+
+        self.client.post(reverse('pharmacy:return_product'), {'barcode': '970000000001', 'unit_type': 'STRIP'})
+        self.assertEqual(self.rollup(), [('BOX', 2, Decimal('40'), Decimal('24')),
+                                         ('STRIP', 0, Decimal('0'), Decimal('0'))])
+
+        before = self.rollup()[:1]
+        self.assertEqual(rebuild(), 1)
+        self.assertEqual(self.rollup(), before)
+
+        out = io.StringIO()
+        call_command('rebuild_sales_rollup', '--from', str(self.expiry), stdout=out)
+        self.assertIn('Rebuilt 0 daily sales row(s)', out.getvalue())
+        self.assertEqual(self.rollup(), before)
+
+    def test_profit_page_totals_match_the_profit_report_after_a_discount(self):
+        fill_cart(self.user, [{'medicine_id': self.medicine.id, 'quantity': 2, 'unit_type': 'BOX',
+                               'original_price': 20, 'discounted_price': 20}])
+        self.client.post(reverse('pharmacy:pos_complete_sale'), {
+            'payment_method': 'CASH', 'action': 'no_print', 'discount_percentage': '10',
+        })
+        self.assertEqual(Sale.objects.get().total_amount, Decimal('36'))
+
+        summary = self.client.get(reverse('pharmacy:profit_analytics')).context['summary']
+        report = self.client.get(reverse('pharmacy:profit_report')).context
+        self.assertEqual(summary['total_sales'], Decimal('36'))
+        self.assertEqual((summary['total_sales'], summary['total_profit']),
+                         (report['total_revenue'], report['total_profit']))
+
+
+class ProfitAnalyticsRangeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='analyst', password='pw')
+        self.today = timezone.localdate()
+        self.medicines = [
+            Medicine.objects.create(name=f'Ranged {i}', description='d', price=20, purchase_price=11 + i,
+                                    category=category, barcode_number=f'98000000000{i}', strips_per_box=3)
+            for i, category in enumerate(('OTC', 'RX', 'OTC'))
+        ]
+
+    def sale(self, days_ago, lines):
+        sale = Sale.objects.create(user=self.user, total_amount=sum(q * p for _, _, q, p in lines), is_completed=True)
+        Sale.objects.filter(pk=sale.pk).update(created_at=timezone.now() - timedelta(days=days_ago))
+        for medicine, unit_type, quantity, price in lines:
+            SaleItem.objects.create(sale=sale, medicine=medicine, quantity=quantity, price=price,
+                                    expiry_date=self.today + timedelta(days=90), unit_type=unit_type)
+
+    def rows(self):
+        return list(ProfitAnalytics.objects.order_by('date').values_list(
+            'date', 'total_sales', 'total_cost', 'total_profit', 'profit_margin', 'number_of_sales',
+            'average_profit_per_sale', 'most_profitable_category', 'most_profitable_medicine_id',
+        ))
+
+    def test_range_in_one_pass_matches_the_daily_report(self):
+        a, b, c = self.medicines
+        self.sale(5, [(a, 'BOX', 2, 20), (b, 'STRIP', 4, 7)])
+        self.sale(5, [(c, 'BOX', 1, 25)])
+        self.sale(3, [(b, 'BOX', 1, 30), (a, 'STRIP', 2, 8)])
+        self.sale(1, [(c, 'STRIP', 5, 9)])
+        start, end = self.today - timedelta(days=6), self.today - timedelta(days=1)
+        day = start
+        while day <= end:
+            ProfitAnalytics.generate_daily_report(day)
+            day += timedelta(days=1)
+        daily = self.rows()
+        # Stale figures, and a second row for a day as auto_now_add could leave
+        ProfitAnalytics.objects.update(total_sales=0, most_profitable_category='')
+        ProfitAnalytics.objects.create(date=start + timedelta(days=1), total_sales=998)
+
+        out = io.StringIO()
+        call_command('generate_profit_analytics', '--from', str(start), '--to', str(end), stdout=out)
+        self.assertIn('0 created, 6 updated', out.getvalue())
+        self.assertEqual(self.rows(), daily)
+        self.assertEqual(len(daily), 6)
+        busiest = [row for row in daily if row[0] == self.today - timedelta(days=5)][0]
+        self.assertEqual(busiest[1:], (Decimal('93.00'), Decimal('51.00'), Decimal('42.00'), Decimal('45.16'), 2,
+                                       Decimal('21.00'), 'Over The Counter', a.id))
+
+        ProfitAnalytics.objects.all().delete()
+        from .profit_analytics import generate_range
+        # The stream, the existing rows, and one INSERT in its savepoint
+        with self.assertNumQueries(5):
+            self.assertEqual(generate_range(start, end), (6, 0))
+        self.assertEqual(self.rows(), daily)
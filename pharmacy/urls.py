@@ -28,8 +28,11 @@ urlpatterns = [
     path('stock/check/<str:barcode>/', views.check_barcode, name='check_barcode_with_param'),
     path('stock/update/<str:barcode>/', views.update_stock, name='update_stock'),
     path('stock/entry/<int:entry_id>/delete/', views.delete_stock_entry, name='delete_stock_entry'),
+    path('stock/barcode-cache/stats/', views.barcode_cache_stats, name='barcode_cache_stats'),
+    path('barcode/<str:number>.png', views.barcode_image, name='barcode_image'),
     path('pos/', views.pos_view, name='pos'),
     path('pos/add/', views.pos_add_to_cart, name='pos_add_to_cart'),
+    path('pos/api/scan/', views.pos_scan, name='pos_scan'),
     path('pos/remove/<int:item_id>/', views.pos_remove_item, name='pos_remove_item'),
     path('pos/complete/', views.pos_complete_sale, name='pos_complete_sale'),
     path('pos/get_expiration_dates/', views.get_expiration_dates, name='get_expiration_dates'),
@@ -38,6 +41,7 @@ urlpatterns = [
     path('dashboard/', views.dashboard, name='dashboard'),
     path('stock/management/', views.StockManagementView.as_view(), name='stock_management'),
     path('stock/view/', views.stock_view, name='stock_view'),
+    path('stock/view/<int:pk>/lots/', views.stock_view_lots, name='stock_view_lots'),
     path('suppliers/', views.SupplierListView.as_view(), name='supplier_list'),
     path('supplier/add/', views.SupplierCreateView.as_view(), name='supplier_add'),
     path('supplier/<int:pk>/', views.SupplierDetailView.as_view(), name='supplier_detail'),
@@ -69,6 +73,7 @@ urlpatterns = [
     path('barcode/print/', views.barcode_print, name='barcode_print'),
     path('invoice/print/', views.invoice_print, name='invoice_print'),
     path('invoice/<int:sale_id>/print/', views.invoice_print_old, name='invoice_print_old'),
+    path('print-jobs/<int:job_id>/', views.print_job_status, name='print_job_status'),
     path('analytics/profit/', views.ProfitAnalyticsView.as_view(), name='profit_analytics'),
     path('products/search/', views.product_search, name='product_search'),
     path('stock/entry/<int:entry_id>/edit/', views.edit_stock_entry, name='edit_stock_entry'),
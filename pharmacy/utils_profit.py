@@ -1,14 +1,10 @@
 from django.db.models import Sum
 from pharmacy.models import Sale, SaleItem
+from pharmacy.sale_costs import profit_totals
 
 def get_total_profit():
     # Sum profits only from completed sales, to match get_total_revenue()
-    total_profit = sum(
-        item.profit for item in SaleItem.objects
-        .filter(sale__is_completed=True)
-        .select_related('medicine', 'sale')
-    )
-    return total_profit
+    return profit_totals(SaleItem.objects.filter(sale__is_completed=True))['profit']
 
 def get_total_revenue():
     # Sum all completed sales
@@ -10,52 +10,57 @@ def return_product(request):
             context['error'] = 'Barcode is required.'
             return render(request, 'pharmacy/return_product.html', context)
         # Find the most recent sale item with this barcode and unit_type
-        try:
-            medicine = Medicine.objects.get(barcode_number=barcode)
-        except Medicine.DoesNotExist:
+        product = lookup_barcode(barcode)
+        if product is None:
             context['error'] = 'No medicine found with this barcode.'
             return render(request, 'pharmacy/return_product.html', context)
 
-        sale_item = SaleItem.objects.filter(medicine=medicine, sale__is_completed=True, unit_type=unit_type).order_by('-sale__created_at').first()
+        sale_item = SaleItem.objects.select_related('medicine', 'sale').filter(
+            medicine_id=product.id, sale__is_completed=True, unit_type=unit_type
+        ).order_by('-sale__created_at').first()
         if not sale_item:
             context['error'] = 'No completed sale found for this product and unit type.'
             return render(request, 'pharmacy/return_product.html', context)
+        medicine = sale_item.medicine
 
-        # Add back to stock (StockEntry)
-        stock_entry, created = StockEntry.objects.get_or_create(
-            medicine=medicine,
-            expiration_date=sale_item.expiry_date,
-            defaults={'quantity': 0}
-        )
-        if sale_item.unit_type == 'STRIP':
-            # Add strips back to strips_remaining
-            if stock_entry.strips_remaining is None:
-                stock_entry.strips_remaining = stock_entry.quantity * medicine.strips_per_box
-            stock_entry.strips_remaining += sale_item.quantity
-            # Update box quantity based on strips
-            stock_entry.quantity = stock_entry.strips_remaining // medicine.strips_per_box
-        else:
-            # Add boxes back
-            stock_entry.quantity += sale_item.quantity
-            # Also update strips_remaining
-            if stock_entry.strips_remaining is None:
-                stock_entry.strips_remaining = stock_entry.quantity * medicine.strips_per_box
-            stock_entry.strips_remaining += sale_item.quantity * medicine.strips_per_box
-        stock_entry.save()
-        medicine.update_stock()
-
-        # Save reference to parent sale before deleting item
-        parent_sale = sale_item.sale
-        # Remove the sale item (or mark as returned)
-        sale_item.delete()
-
-        # Recalculate sale total, and if no items left, set as not completed and zero amount
-        if parent_sale.items.exists():
-            parent_sale.calculate_total()
-        else:
-            parent_sale.total_amount = 0
-            parent_sale.is_completed = False
-            parent_sale.save()
+        with transaction.atomic():
+            # Add back to stock (StockEntry)
+            with movement_reason(StockMovement.RETURN, f"sale:{sale_item.sale_id}"):
+                stock_entry, created = StockEntry.objects.get_or_create(
+                    medicine=medicine,
+                    expiration_date=sale_item.expiry_date,
+                    defaults={'quantity': 0}
+                )
+                if sale_item.unit_type == 'STRIP':
+                    # Add strips back to strips_remaining
+                    if stock_entry.strips_remaining is None:
+                        stock_entry.strips_remaining = stock_entry.quantity * medicine.strips_per_box
+                    stock_entry.strips_remaining += sale_item.quantity
+                    # Update box quantity based on strips
+                    stock_entry.quantity = stock_entry.strips_remaining // medicine.strips_per_box
+                else:
+                    # Add boxes back
+                    stock_entry.quantity += sale_item.quantity
+                    # Also update strips_remaining
+                    if stock_entry.strips_remaining is None:
+                        stock_entry.strips_remaining = stock_entry.quantity * medicine.strips_per_box
+                    stock_entry.strips_remaining += sale_item.quantity * medicine.strips_per_box
+                stock_entry.save()
+            medicine.update_stock()
+
+            # Save reference to parent sale before deleting item
+            parent_sale = sale_item.sale
+            items_returned([sale_item])
+            # Remove the sale item (or mark as returned)
+            sale_item.delete()
+
+            # Recalculate sale total, and if no items left, set as not completed and zero amount
+            if parent_sale.items.exists():
+                parent_sale.calculate_total()
+            else:
+                parent_sale.total_amount = 0
+                parent_sale.is_completed = False
+                parent_sale.save()
 
         context['success'] = f"Product '{medicine.name}' returned successfully. Stock and sales updated."
     return render(request, 'pharmacy/return_product.html', context)
@@ -80,9 +85,10 @@ from django.db.models import F, Sum, Count, Avg, Max, Q, Case, When, DecimalFiel
 from django.db.models.functions import ExtractMonth, TruncDate, TruncMonth
 from django.utils import timezone
 from django.db import transaction
-from django.http import JsonResponse, HttpResponse
-from django.views.decorators.http import require_POST, require_http_methods
-from .models import Medicine, StockEntry, Sale, SaleItem, Supplier, Purchase, Customer, Prescription, SearchHistory, ProfitAnalytics
+from django.http import JsonResponse, HttpResponse, Http404
+from django.views.decorators.http import etag, require_POST, require_http_methods
+from django.utils.cache import patch_cache_control
+from .models import Medicine, StockEntry, Sale, SaleItem, Supplier, Purchase, Customer, Prescription, SearchHistory, ProfitAnalytics, PrintJob, StockMovement, DailySales, CartLine
 from .forms import (
     MedicineForm, SupplierForm, PurchaseForm, PurchaseItemForm, 
     CustomerForm, CustomerSearchForm, PrescriptionForm, PrescriptionItemFormSet,
@@ -90,6 +96,20 @@ from .forms import (
 )
 from django.contrib.auth.forms import UserCreationForm
 from .mixins import RoleRequiredMixin
+from .barcode_lookup import barcode_lookup, lookup_barcode
+from .barcodes import barcode_png, image_etag
+from .cart import (
+    add_to_cart, cart_lines, cart_summary, cart_totals, clear_cart, get_cart,
+    line_data, lot_summary, lots_left, remove_line, reprice_cart, unit_prices,
+)
+from .inventory_valuation import InventoryTotals, valued_medicines
+from .labels import enqueue_labels, medicine_label_tspl, tspl_barcode_ok, tspl_mode
+from .stock_intake import intake_lots
+from .stock_ledger import movement_reason
+from .stock_overview import NEAR_EXPIRY_DAYS, medicine_lots, overview_page
+from .stock_allocation import LotBook, allocate_sale_items
+from .sales_rollup import items_returned, items_sold, profit_by_day
+from .sale_costs import sales_totals
 import csv
 from datetime import datetime, timedelta
 from django.core.exceptions import ValidationError
@@ -97,33 +117,6 @@ from decimal import Decimal
 import statistics
 
 
-def select_stock_entry_for_expiration(medicine, exp_date, unit_type='BOX', needed_qty=1):
-    """
-    Return a StockEntry for given medicine+expiration that has available stock.
-    Prefers entries with has_stock (quantity>0 or strips_remaining>0) and
-    returns the first entry that can fulfill needed_qty for the requested unit.
-    """
-    entries = StockEntry.objects.filter(
-        medicine=medicine,
-        expiration_date=exp_date
-    ).annotate(
-        has_stock=Case(
-            When(Q(quantity__gt=0) | Q(strips_remaining__gt=0), then=Value(1)),
-            default=Value(0),
-            output_field=IntegerField()
-        )
-    ).order_by('-has_stock', '-created_at')
-
-    for entry in entries:
-        if unit_type == 'STRIP':
-            available = entry.strips_remaining if entry.strips_remaining is not None else entry.quantity * medicine.strips_per_box
-            if available >= needed_qty:
-                return entry
-        else:
-            if entry.quantity >= needed_qty:
-                return entry
-    return None
-
 # List all medicines
 class MedicineListView(ListView):
     model = Medicine
@@ -198,126 +191,50 @@ class SignUpView(CreateView):
 def stock_management(request):
     return render(request, 'pharmacy/stock_management.html')
 
-@require_POST
-@login_required
-def update_stock(request):
-    from django.db.models import Sum, F
-
-    # Add debug prints
-    print("Received POST request")
-    print("POST data:", request.POST)
-    
-    try:
-        barcode = request.POST.get('barcode')
-        quantity = int(request.POST.get('quantity', 1))
-        expiration_date = request.POST.get('expiration_date')
-        
-        print(f"Processing: barcode={barcode}, quantity={quantity}, expiration_date={expiration_date}")
-        
-        if not barcode:
-            return JsonResponse({
-                'success': False,
-                'error': 'Barcode is required'
-            }, status=400)
-
-        try:
-            medicine = Medicine.objects.get(barcode_number=barcode)
-            print(f"Found medicine: {medicine.name}")
-            
-            # Create or merge stock entry for same medicine+expiration_date
-            stock_entry, created = StockEntry.objects.get_or_create(
-                medicine=medicine,
-                expiration_date=expiration_date,
-                defaults={'quantity': quantity, 'strips_remaining': quantity * medicine.strips_per_box}
-            )
-            if not created:
-                # Merge into existing entry: increment quantity and strips_remaining
-                stock_entry.quantity = (stock_entry.quantity or 0) + quantity
-                if stock_entry.strips_remaining is None:
-                    stock_entry.strips_remaining = stock_entry.quantity * medicine.strips_per_box
-                else:
-                    stock_entry.strips_remaining = (stock_entry.strips_remaining or 0) + (quantity * medicine.strips_per_box)
-                stock_entry.save()
-                print(f"Merged into existing stock entry: {stock_entry}")
-            else:
-                print(f"Created stock entry: {stock_entry}")
-            
-            # Update stock based on non-expired entries
-            new_stock = medicine.update_stock()
-            print(f"Updated stock to: {new_stock}")
-            
-            return JsonResponse({
-                'success': True,
-                'medicine': {
-                    'name': medicine.name,
-                    'new_stock': medicine.stock,
-                    'price': str(medicine.price),
-                    'expiration_date': expiration_date
-                }
-            })
-        except Medicine.DoesNotExist:
-            print(f"Medicine not found for barcode: {barcode}")
-            return JsonResponse({
-                'success': False,
-                'error': 'Medicine not found',
-                'redirect_url': reverse('pharmacy:medicine_add') + f'?barcode={barcode}'
-            }, status=404)
-            
-    except Exception as e:
-        print(f"Error occurred: {str(e)}")
-        return JsonResponse({
-            'success': False,
-            'error': str(e)
-        }, status=500)
-
 @login_required
 def stock_view(request):
+    """Stock overview, one page at a time (see pharmacy.stock_overview);
+    filters: ?category=, ?low_stock=1, ?expiring=1, paged by ?cursor=."""
     today = timezone.now().date()
-    
-    # Get all medicines with their stock entries
-    medicines = Medicine.objects.prefetch_related(
-        'stock_entries'
-    ).all()
-    
-    # Prepare stock data
-    stock_data = []
-    for medicine in medicines:
-        # Get all stock entries for this medicine
-        stock_entries = medicine.stock_entries.all()
-        
-        # Ensure stock is up to date
-        medicine.update_stock()
-        
-        # Calculate expired and near-expiry stock
-        expired_stock = stock_entries.filter(
-            expiration_date__lt=today
-        ).aggregate(
-            total=Sum('quantity')
-        )['total'] or 0
-        
-        near_expiry_stock = stock_entries.filter(
-            expiration_date__range=[today, today + timezone.timedelta(days=30)]
-        ).aggregate(
-            total=Sum('quantity')
-        )['total'] or 0
-        
-        stock_data.append({
-            'medicine': medicine,
-            'total_stock': medicine.stock,
-            'expired_stock': expired_stock,
-            'near_expiry_stock': near_expiry_stock,
-            'stock_entries': stock_entries,
-        })
-    
+    category = request.GET.get('category', '')
+    if category not in dict(Medicine.CATEGORY_CHOICES):
+        category = ''
+    filters = {
+        'category': category,
+        'low_stock': request.GET.get('low_stock') == '1',
+        'expiring': request.GET.get('expiring') == '1',
+    }
+    page = overview_page(today, request.GET.get('cursor'), **filters)
+
+    # Filters for the next-page link, without the cursor
+    query = request.GET.copy()
+    query.pop('cursor', None)
+
     context = {
-        'stock_data': stock_data,
+        'stock_data': page.rows,
+        'next_cursor': page.next_cursor,
+        'is_first_page': not request.GET.get('cursor'),
+        'filter_query': query.urlencode(),
+        'filters': filters,
+        'categories': Medicine.CATEGORY_CHOICES,
+        'near_expiry_days': NEAR_EXPIRY_DAYS,
         'today': today,
     }
     return render(request, 'pharmacy/stock_view.html', context)
 
 @login_required
+def stock_view_lots(request, pk):
+    """The lots of one stock overview card, loaded when it is expanded."""
+    lots = list(medicine_lots(pk, timezone.now().date()))
+    return render(request, 'pharmacy/includes/stock_lots.html', {'lots': lots})
+
+@login_required
+@movement_reason(StockMovement.INTAKE)
 def update_existing_stock(request, barcode):
-    medicine = get_object_or_404(Medicine, barcode_number=barcode)
+    product = lookup_barcode(barcode)
+    if product is None:
+        raise Http404('No medicine found with this barcode.')
+    medicine = Medicine.objects.get(pk=product.id)
     today = timezone.now().date()
     
     if request.method == 'POST':
@@ -333,19 +250,8 @@ def update_existing_stock(request, barcode):
                     messages.error(request, 'Expiration date must be in the future')
                     return redirect('pharmacy:update_existing_stock', barcode=barcode)
                 
-                # Create or merge stock entry for this medicine+expiration
-                stock_entry, created = StockEntry.objects.get_or_create(
-                    medicine=medicine,
-                    expiration_date=exp_date,
-                    defaults={'quantity': quantity, 'strips_remaining': quantity * medicine.strips_per_box}
-                )
-                if not created:
-                    stock_entry.quantity = (stock_entry.quantity or 0) + quantity
-                    if stock_entry.strips_remaining is None:
-                        stock_entry.strips_remaining = stock_entry.quantity * medicine.strips_per_box
-                    else:
-                        stock_entry.strips_remaining = (stock_entry.strips_remaining or 0) + (quantity * medicine.strips_per_box)
-                    stock_entry.save()
+                # Create or merge the lot for this medicine+expiration
+                intake_lots([(medicine.id, exp_date, quantity)])
                 
                 # Update stock based on non-expired entries
                 new_stock = medicine.update_stock()
@@ -374,7 +280,7 @@ def check_barcode(request, barcode=None):
         return redirect('pharmacy:stock_scan')
         
     try:
-        medicine = Medicine.objects.filter(barcode_number=barcode).first()
+        medicine = lookup_barcode(barcode)
         
         if medicine:
             # Medicine exists - redirect to update stock
@@ -392,11 +298,15 @@ def stock_scan(request):
     return render(request, 'pharmacy/stock_scan.html')
 
 @login_required
+@movement_reason(StockMovement.INTAKE)
 def update_stock(request, barcode):
-    medicine = get_object_or_404(Medicine, barcode_number=barcode)
+    product = lookup_barcode(barcode)
+    if product is None:
+        raise Http404('No medicine found with this barcode.')
     today = timezone.now().date()
     
     if request.method == 'POST':
+        medicine = Medicine.objects.get(pk=product.id)
         quantities = request.POST.getlist('quantity[]')
         expiration_dates = request.POST.getlist('expiration_date[]')
         
@@ -406,6 +316,7 @@ def update_stock(request, barcode):
 
         if quantities and expiration_dates and len(quantities) == len(expiration_dates):
             total_added = 0
+            added = []  # (medicine, expiry, quantity) for the labels
             
             # Validate and create stock entries
             for quantity, expiration_date in zip(quantities, expiration_dates):
@@ -420,22 +331,14 @@ def update_stock(request, barcode):
 
                     # Only create/merge stock entries when quantity > 0
                     if quantity > 0:
-                        stock_entry, created = StockEntry.objects.get_or_create(
-                            medicine=medicine,
-                            expiration_date=exp_date,
-                            defaults={'quantity': quantity, 'strips_remaining': quantity * medicine.strips_per_box}
-                        )
-                        if not created:
-                            stock_entry.quantity = (stock_entry.quantity or 0) + quantity
-                            if stock_entry.strips_remaining is None:
-                                stock_entry.strips_remaining = stock_entry.quantity * medicine.strips_per_box
-                            else:
-                                stock_entry.strips_remaining = (stock_entry.strips_remaining or 0) + (quantity * medicine.strips_per_box)
-                        stock_entry.save()
                         total_added += quantity
+                        added.append((medicine, exp_date, quantity))
                 except (ValueError, TypeError):
                     messages.error(request, 'Invalid quantity or expiration date format')
                     return redirect('pharmacy:update_stock', barcode=barcode)
+
+            # All rows validated: create/merge their lots together
+            intake_lots((medicine.id, exp_date, quantity) for medicine, exp_date, quantity in added)
             
             # Update stock based on non-expired entries
             new_stock = medicine.update_stock()
@@ -444,6 +347,12 @@ def update_stock(request, barcode):
                 request, 
                 f'Added {total_added} units to {medicine.name} with different expiration dates. New total: {new_stock}'
             )
+            if tspl_mode() and tspl_barcode_ok(medicine.barcode_number):
+                # One queued job with a label per unit, each row's own expiry
+                _, label_count = enqueue_labels(added, title=f"Labels {medicine.barcode_number}")
+                if label_count:
+                    messages.info(request, f'تم إرسال {label_count} ملصق للطباعة')
+                return redirect('pharmacy:update_stock', barcode=barcode)
             return redirect(
                 reverse('pharmacy:update_stock', kwargs={'barcode': barcode})
                 + f'?auto_print=1&copies={total_added}'
@@ -452,9 +361,9 @@ def update_stock(request, barcode):
             messages.error(request, 'Please provide valid quantities and expiration dates for all entries')
     
     context = {
-        'medicine': medicine,
-        'stock_entries': medicine.stock_entries.all().order_by('-created_at'),
-        'total_stock': medicine.stock,
+        'medicine': product,
+        'stock_entries': StockEntry.objects.filter(medicine_id=product.id).order_by('-created_at'),
+        'total_stock': product.stock,
         'today': today,
     }
     return render(request, 'pharmacy/update_stock.html', context)
@@ -462,77 +371,31 @@ def update_stock(request, barcode):
 @login_required
 def pos_view(request):
     """View for the Point of Sale (POS) system"""
+    cart = get_cart(request)
     if request.method == 'POST':
         if request.POST.get('action') == 'cancel':
             # Clear the cart and customer
-            request.session['cart'] = []
-            request.session['selected_customer_id'] = None
-            request.session.modified = True
+            clear_cart(cart)
             messages.success(request, 'Sale cancelled successfully')
             return redirect('pharmacy:pos')
         elif request.POST.get('customer_id') is not None:
-            # AJAX customer selection
+            # AJAX customer selection: re-price the cart lines for the new
+            # customer (or back to list prices when cleared)
             customer_id = request.POST.get('customer_id')
             if customer_id:
-                try:
-                    # Validate customer exists
-                    customer = Customer.objects.get(id=customer_id)
-                    request.session['selected_customer_id'] = customer_id
-                    
-                    # Update cart prices with new customer
-                    cart = request.session.get('cart', [])
-                    updated_cart = []
-                    for item in cart:
-                        medicine = Medicine.objects.get(id=item['medicine_id'])
-                        original_price = medicine.get_strip_price() if item['unit_type'] == 'STRIP' else medicine.price
-                        
-                        # Calculate discounted price based on customer type
-                        if customer.customer_type == 'FAMILY':
-                            # Calculate minimum profitable price
-                            discounted_price = medicine.purchase_price * Decimal('1.10')  # Cost + 10%
-                            if item['unit_type'] == 'STRIP':
-                                discounted_price = discounted_price / medicine.strips_per_box
-                        else:
-                            discount = customer.discount_percentage / 100
-                            discounted_price = original_price * (1 - discount)
-                            # Ensure price doesn't go below cost + 10%
-                            min_price = medicine.purchase_price * Decimal('1.10')
-                            if item['unit_type'] == 'STRIP':
-                                min_price = min_price / medicine.strips_per_box
-                            if discounted_price < min_price:
-                                discounted_price = min_price
-                        
-                        item['original_price'] = float(original_price)
-                        item['discounted_price'] = float(discounted_price)
-                        item['total'] = float(discounted_price * item['quantity'])
-                        updated_cart.append(item)
-                    
-                    request.session['cart'] = updated_cart
-                    request.session.modified = True
-                    
-                except Customer.DoesNotExist:
-                    pass
+                customer = Customer.objects.filter(id=customer_id).first()
+                if customer is not None:
+                    reprice_cart(cart, customer)
             else:
-                # Clear customer selection
-                request.session['selected_customer_id'] = None
-                request.session.modified = True
+                reprice_cart(cart, None)
             return JsonResponse({'status': 'ok'})
     
-    # Get cart from session
-    cart = request.session.get('cart', [])
+    lines = cart_lines(cart)
     
     # Calculate totals
-    original_total = sum(float(item['original_price'] * item['quantity']) for item in cart)
-    cart_total = sum(float(item['total']) for item in cart)
+    original_total, cart_total = cart_totals(lines)
     
-    # Get customer from session
-    customer_id = request.session.get('selected_customer_id')
-    customer = None
-    if customer_id:
-        try:
-            customer = Customer.objects.get(id=customer_id)
-        except Customer.DoesNotExist:
-            request.session['selected_customer_id'] = None
+    customer = Customer.objects.filter(id=cart.customer_id).first() if cart.customer_id else None
             
     # Expiry alert (default 90 days) - show only to staff to minimize noise
     expiry_alert_days = getattr(settings, 'EXPIRY_ALERT_DAYS', 90)
@@ -560,7 +423,8 @@ def pos_view(request):
             })
 
     context = {
-        'cart': cart,
+        'cart': lines,
+        'print_job_id': request.session.pop('print_job_id', None),
         'original_total': original_total,
         'cart_total': cart_total,
         'selected_customer': customer,
@@ -574,12 +438,8 @@ def pos_view(request):
 @login_required
 def pos_remove_item(request, item_id):
     if request.method == 'POST':
-        cart = request.session.get('cart', [])
         try:
-            if 0 <= item_id < len(cart):
-                cart.pop(item_id)
-                request.session['cart'] = cart
-                request.session.modified = True
+            if remove_line(get_cart(request), item_id):
                 messages.success(request, 'Item removed from cart')
             else:
                 messages.error(request, 'Invalid item')
@@ -592,8 +452,10 @@ def pos_remove_item(request, item_id):
 def pos_complete_sale(request):
     """Complete the sale and clear the cart"""
     try:
-        cart = request.session.get('cart', [])
-        if not cart:
+        cart = get_cart(request)
+        # Lines with their medicines in one query
+        lines = cart_lines(cart)
+        if not lines:
             messages.error(request, 'Cart is empty')
             return redirect('pharmacy:pos')
 
@@ -609,7 +471,7 @@ def pos_complete_sale(request):
         except Exception:
             discount_percentage = 0
 
-        subtotal = sum(float(item['total']) for item in cart)
+        subtotal = float(cart_totals(lines)[1])
         discount_amount = subtotal * (discount_percentage / 100)
         total_amount = subtotal - discount_amount
 
@@ -622,8 +484,6 @@ def pos_complete_sale(request):
         if change_return < 0:
             change_return = 0.0
 
-        from .models import StockEntry as _StockEntry
-
         with transaction.atomic():
             # Create sale record
             sale = Sale.objects.create(
@@ -636,61 +496,11 @@ def pos_complete_sale(request):
                 is_completed=True
             )
 
-            # Create sale items and update stock
-            completed_items = []
-            for item in cart:
-                medicine = Medicine.objects.get(id=item['medicine_id'])
-                exp_date = item.get('expiration_date')
-                if not exp_date:
-                    raise ValidationError(f'Expiration date missing for {medicine.name} in cart.')
-                # Parse date string if needed
-                if isinstance(exp_date, str):
-                    try:
-                        exp_date_obj = timezone.datetime.strptime(exp_date, '%Y-%m-%d').date()
-                    except Exception:
-                        exp_date_obj = timezone.datetime.strptime(exp_date, '%d/%m/%Y').date()
-                else:
-                    exp_date_obj = exp_date
-
-                # Use row-level lock to avoid race conditions when decrementing stock
-                # and keep the whole sale creation process atomic.
-                candidate = select_stock_entry_for_expiration(medicine, exp_date_obj, item['unit_type'], item['quantity'])
-                if not candidate:
-                    raise ValidationError(f'No stock entry with available quantity found for {medicine.name} with expiration {exp_date}')
-
-                # Reload the candidate with select_for_update to lock the row
-                stock_entry = _StockEntry.objects.select_for_update().get(id=candidate.id)
-
-                if item['unit_type'] == 'STRIP':
-                    if stock_entry.strips_remaining is None:
-                        stock_entry.strips_remaining = stock_entry.quantity * medicine.strips_per_box
-                    if item['quantity'] > stock_entry.strips_remaining:
-                        raise ValidationError(f'Not enough strips for {medicine.name} (exp {exp_date})')
-                    stock_entry.strips_remaining -= item['quantity']
-                    stock_entry.quantity = stock_entry.strips_remaining // medicine.strips_per_box
-                else:
-                    if item['quantity'] > stock_entry.quantity:
-                        raise ValidationError(f'Not enough boxes for {medicine.name} (exp {exp_date})')
-                    stock_entry.quantity -= item['quantity']
-                    if stock_entry.strips_remaining is None:
-                        stock_entry.strips_remaining = stock_entry.quantity * medicine.strips_per_box
-                    stock_entry.strips_remaining -= item['quantity'] * medicine.strips_per_box
-
-                # Save locked row; model save() will clamp negatives if any
-                stock_entry.save()
-
-                # Recalculate medicine stock within the same transaction to keep consistency
-                medicine.update_stock()
-
-                sale_item = SaleItem.objects.create(
-                    sale=sale,
-                    medicine=medicine,
-                    quantity=item['quantity'],
-                    unit_type=item['unit_type'],
-                    price=item['discounted_price'],
-                    expiry_date=stock_entry.expiration_date
-                )
-                completed_items.append(sale_item)
+            # Create sale items and decrement stock for the whole cart in a
+            # fixed number of queries (see pharmacy.stock_allocation).
+            completed_items = allocate_sale_items(sale, lines)
+            items_sold(completed_items)
+            clear_cart(cart)
 
         # Add loyalty points if customer exists
         points_added = 0
@@ -701,10 +511,6 @@ def pos_complete_sale(request):
                 f'Added {points_added} points to {customer.name}\'s account!'
             )
 
-        # Clear the cart
-        request.session['cart'] = []
-        request.session.modified = True
-        
         # Add receipt data to session for printing
         request.session['completed_sale'] = {
             'id': sale.id,
@@ -736,17 +542,20 @@ def pos_complete_sale(request):
         
         messages.success(request, f'Sale completed successfully. Sale ID: {sale.id}')
 
-        # Print the invoice straight to the thermal printer (same device as the
+        # Queue the invoice for the thermal printer (same device as the
         # barcode labels, loaded with the continuous receipt roll instead of the
-        # die-cut label roll). A printer failure must not undo the sale, which is
-        # already committed to the database at this point. Skipped entirely when
+        # die-cut label roll). The print spooler renders and sends it in the
+        # background, so the cashier gets the next screen right away and a
+        # printer failure can never undo the sale. Skipped entirely when
         # the cashier picks "Complete Sale (No Print)" — e.g. the label roll is
         # still loaded, or the printer isn't connected right now.
         if request.POST.get('action') != 'no_print':
             try:
-                print_invoice_thermal(sale, request.session['completed_sale']['items'], request.session['completed_sale'])
+                job, _ = enqueue_print_job(
+                    PrintJob.INVOICE, data=request.session['completed_sale'], title=f"Invoice {sale.id}")
+                request.session['print_job_id'] = job.id
             except Exception as e:
-                logger.error(f"Failed to print invoice for sale {sale.id}: {e}", exc_info=True)
+                logger.error(f"Failed to queue invoice for sale {sale.id}: {e}", exc_info=True)
                 messages.warning(request, 'تم حفظ البيع لكن حدث خطأ أثناء طباعة الفاتورة تلقائياً')
 
     except ValidationError as e:
@@ -828,9 +637,9 @@ def dashboard(request):
         quantity__gt=0
     ).select_related('medicine')
     
-    # Most sold medicines
+    # Most sold medicines, from the daily sales rollup
     top_medicines = Medicine.objects.annotate(
-        total_sold=Sum('saleitem__quantity')
+        total_sold=Sum('daily_sales__quantity')
     ).filter(total_sold__gt=0).order_by('-total_sold')[:5]
     
     context = {
@@ -884,6 +693,12 @@ class PurchaseListView(LoginRequiredMixin, RoleRequiredMixin, ListView):
     context_object_name = 'purchases'
     allowed_roles = ['ADMIN', 'STOCK_MANAGER']
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # Receiving with labels batches them as TSPL, so only in that mode
+        context['tspl_labels'] = tspl_mode()
+        return context
+
 @login_required
 def purchase_create(request):
     if request.method == 'POST':
@@ -925,35 +740,32 @@ def receive_purchase(request, pk):
     purchase = get_object_or_404(Purchase, pk=pk)
     if request.method == 'POST':
         try:
-            with transaction.atomic():
-                # Update stock for each item
-                for item in purchase.items.all():
-                    stock_entry, created = StockEntry.objects.get_or_create(
-                        medicine=item.medicine,
-                        expiration_date=item.expiry_date,
-                        defaults={'quantity': item.quantity, 'strips_remaining': item.quantity * item.medicine.strips_per_box}
+            with transaction.atomic(), movement_reason(StockMovement.PURCHASE, f"purchase:{purchase.id}"):
+                # Mark purchase as received; the conditional UPDATE lets only
+                # one request receive it, so stock is never added twice
+                if not Purchase.objects.filter(pk=purchase.pk).exclude(status='RECEIVED').update(status='RECEIVED'):
+                    messages.warning(request, 'Purchase order was already received')
+                    return redirect('pharmacy:purchase_detail', pk=pk)
+                items = list(purchase.items.select_related('medicine'))
+
+                # Add every item to its lot in one upsert, with its cost
+                intake_lots((item.medicine_id, item.expiry_date, item.quantity, item.price) for item in items)
+
+                if request.POST.get('print_labels') and tspl_mode():
+                    # Labels for the whole delivery as one print job (sent once this commits)
+                    _, label_count = enqueue_labels(
+                        [(item.medicine, item.expiry_date, item.quantity) for item in items
+                         if tspl_barcode_ok(item.medicine.barcode_number)],
+                        title=f"Labels PO {purchase.invoice_number}",
                     )
-                    if not created:
-                        stock_entry.quantity = (stock_entry.quantity or 0) + item.quantity
-                        if stock_entry.strips_remaining is None:
-                            stock_entry.strips_remaining = stock_entry.quantity * item.medicine.strips_per_box
-                        else:
-                            stock_entry.strips_remaining = (stock_entry.strips_remaining or 0) + (item.quantity * item.medicine.strips_per_box)
-                        stock_entry.save()
-                    
-                    # Update medicine stock
-                    total_stock = StockEntry.objects.filter(
-                        medicine=item.medicine
-                    ).aggregate(
-                        total=Sum('quantity')
-                    )['total'] or 0
-                    
-                    item.medicine.stock = total_stock
-                    item.medicine.save()
-                
-                # Mark purchase as received
-                purchase.status = 'RECEIVED'
-                purchase.save()
+                    if label_count:
+                        messages.info(request, f'تم إرسال {label_count} ملصق للطباعة')
+                    skipped = sorted({item.medicine.name for item in items
+                                      if not tspl_barcode_ok(item.medicine.barcode_number)})
+                    if skipped:
+                        messages.warning(
+                            request, f'Labels not printed (barcode cannot be encoded): {", ".join(skipped)}'
+                        )
                 
                 messages.success(request, 'Purchase order received successfully')
                 return redirect('pharmacy:purchase_list')
@@ -1074,54 +886,26 @@ def sales_report(request):
 @login_required
 def inventory_report(request):
     medicines = Medicine.objects.all()
-    
-    # Calculate inventory value using Decimal (selling value)
-    total_value = sum(Decimal(str(medicine.stock)) * (medicine.price or Decimal('0')) for medicine in medicines)
-    
-    # Calculate total purchase cost and prepare inventory rows
-    total_purchase_cost = Decimal('0')
-    inventory_rows = []
-    for m in medicines:
-        try:
-            box_qty = int(m.calculate_available_stock() or 0)
-        except Exception:
-            box_qty = int(m.stock or 0)
-        # Compute strips not already counted as full boxes
-        try:
-            total_strips = int(m.strips_in_stock or 0)
-        except Exception:
-            total_strips = box_qty * (m.strips_per_box or 1) if box_qty else 0
-        strips_per_box = m.strips_per_box or 1
-        strip_qty = total_strips - (box_qty * strips_per_box)
-        if strip_qty < 0:
-            strip_qty = 0
-
-        unit_price = Decimal(m.price or 0)
-        unit_purchase = Decimal(m.purchase_price or 0)
-        strips_per_box = m.strips_per_box or 1
-        strip_purchase = (unit_purchase / Decimal(strips_per_box)) if strips_per_box else Decimal('0')
-
-        try:
-            strip_price = Decimal(m.get_strip_price() or unit_price)
-        except Exception:
-            strip_price = unit_price
-
-        total_value_item = (unit_price * Decimal(box_qty)) + (strip_price * Decimal(strip_qty))
-        total_purchase_item = (unit_purchase * Decimal(box_qty)) + (strip_purchase * Decimal(strip_qty))
-        total_purchase_cost += total_purchase_item
 
+    # Selling value (boxes), purchase cost and the inventory rows in one pass
+    totals = InventoryTotals()
+    inventory_rows = []
+    for m in valued_medicines(medicines):
+        totals.add(m)
         inventory_rows.append({
             'id': m.id,
             'barcode': m.barcode_number,
             'name': m.name,
-            'category': m.get_category_display,
-            'stock': box_qty,
-            'unit_price': f"{unit_price:.2f}",
-            'unit_purchase': f"{unit_purchase:.2f}",
-            'total_value': f"{total_value_item:.2f}",
-            'total_purchase': f"{total_purchase_item:.2f}",
+            'category': m.category_display,
+            'stock': m.boxes,
+            'unit_price': f"{m.box_price:.2f}",
+            'unit_purchase': f"{m.box_purchase:.2f}",
+            'total_value': f"{m.selling:.2f}",
+            'total_purchase': f"{m.cost:.2f}",
             'reorder_level': m.reorder_level,
         })
+    total_value = totals.selling_box
+    total_purchase_cost = totals.cost
     
     # Low stock items
     low_stock = medicines.filter(stock__lte=F('reorder_level'))
@@ -1286,38 +1070,18 @@ def export_inventory_report(request):
         'Unit Price', 'Total Value', 'Unit Purchase Price', 'Total Purchase Cost', 'Status'
     ])
     
-    # Get all medicines
-    medicines = Medicine.objects.all()
-    
-    # Write data
-    for medicine in medicines:
-        # Determine quantities (boxes and strips)
-        try:
-            box_qty = int(medicine.calculate_available_stock() or 0)
-        except Exception:
-            box_qty = int(medicine.stock or 0)
-        try:
-            strip_qty = int(medicine.strips_in_stock or 0)
-        except Exception:
-            strip_qty = box_qty * (medicine.strips_per_box or 1) if box_qty else 0
-
-        unit_purchase = Decimal(medicine.purchase_price or 0)
-        strips_per_box = medicine.strips_per_box or 1
-        strip_purchase = (unit_purchase / Decimal(strips_per_box)) if strips_per_box else Decimal('0')
-
-        total_purchase = (unit_purchase * Decimal(box_qty)) + (strip_purchase * Decimal(strip_qty))
-
-        status = 'Out of Stock' if (box_qty == 0 and strip_qty == 0) else (
-            'Low Stock' if box_qty <= 10 else 'In Stock'
+    for m in valued_medicines(Medicine.objects.all()):
+        status = 'Out of Stock' if not m.in_stock else (
+            'Low Stock' if m.boxes <= 10 else 'In Stock'
         )
         writer.writerow([
-            medicine.name,
-            medicine.get_category_display(),
-            box_qty,
-            medicine.price,
-            (Decimal(medicine.price or 0) * Decimal(box_qty)),
-            f"{unit_purchase:.2f}",
-            f"{total_purchase:.2f}",
+            m.name,
+            m.category_display,
+            m.boxes,
+            m.box_price,
+            m.selling_box,
+            f"{m.box_purchase:.2f}",
+            f"{m.cost:.2f}",
             status
         ])
     
@@ -1626,25 +1390,14 @@ def dispense_prescription(request, pk):
                     customer=prescription.customer
                 )
                 
-                # Add prescription items to sale
-                for item in prescription.items.all():
-                    if item.medicine.stock < item.quantity:
-                        raise ValidationError(f'Insufficient stock for {item.medicine.name}')
-                    
-                    SaleItem.objects.create(
-                        sale=sale,
-                        medicine=item.medicine,
-                        quantity=item.quantity,
-                        price=item.medicine.price,
-                        expiry_date=StockEntry.objects.filter(
-                            medicine=item.medicine,
-                            quantity__gt=0
-                        ).order_by('expiration_date').first().expiration_date
-                    )
-                    
-                    # Update stock
-                    item.medicine.stock -= item.quantity
-                    item.medicine.save()
+                # Take the items from the lots first-expired-first-out, as
+                # checkout does (lots, counters, ledger and item costs)
+                lines = [
+                    CartLine(medicine=item.medicine, quantity=item.quantity, unit_type='BOX',
+                             discounted_price=item.medicine.price)
+                    for item in prescription.items.select_related('medicine')
+                ]
+                allocate_sale_items(sale, lines)
                 
                 # Update prescription status
                 prescription.status = 'DISPENSED'
@@ -1656,7 +1409,7 @@ def dispense_prescription(request, pk):
                 return redirect('pharmacy:sale_detail', sale_id=sale.id)
                 
         except ValidationError as e:
-            messages.error(request, str(e))
+            messages.error(request, e.messages[0])
         except Exception as e:
             messages.error(request, f'Error dispensing prescription: {str(e)}')
     
@@ -1773,97 +1526,22 @@ def pos_add_to_cart(request):
             customer_id = request.POST.get('customer_id')
             expiration_date = request.POST.get('expiration_date')
 
-            medicine = Medicine.objects.get(barcode_number=barcode)
-            customer = Customer.objects.get(id=customer_id) if customer_id else None
-
-            # Check if can sell strips
-            if unit_type == 'STRIP' and not medicine.can_sell_strips:
-                messages.error(request, f'Cannot sell {medicine.name} by strip')
-                return redirect('pharmacy:pos')
-
-            # Calculate box quantity for stock check
-            if unit_type == 'STRIP':
-                box_quantity = quantity / medicine.strips_per_box
-            else:
-                box_quantity = quantity
-
-            # Only check for sufficient stock, do not deduct here
-            if unit_type == 'STRIP':
-                total_strips = 0
-                for entry in medicine.stock_entries.filter(expiration_date__gte=timezone.now().date()):
-                    if entry.strips_remaining is not None:
-                        total_strips += entry.strips_remaining
-                    else:
-                        total_strips += entry.quantity * medicine.strips_per_box
-                if quantity > total_strips:
-                    messages.error(request, 'Insufficient stock')
-                    return redirect('pharmacy:pos')
-            else:
-                if medicine.stock < box_quantity:
-                    messages.error(request, 'Insufficient stock')
-                    return redirect('pharmacy:pos')
-
-            # If expiration_date is provided, check that the StockEntry has enough, but do not deduct
-            if expiration_date:
-                # parse expiration_date if sent as string
-                try:
-                    exp_date_obj = timezone.datetime.strptime(expiration_date, '%Y-%m-%d').date()
-                except Exception:
-                    try:
-                        exp_date_obj = timezone.datetime.strptime(expiration_date, '%d/%m/%Y').date()
-                    except Exception:
-                        messages.error(request, 'Invalid expiration date format')
-                        return redirect('pharmacy:pos')
-
-                stock_entry = select_stock_entry_for_expiration(medicine, exp_date_obj, unit_type, quantity)
-                if not stock_entry:
-                    messages.error(request, 'Selected expiration date does not have enough stock')
-                    return redirect('pharmacy:pos')
-
-            # Calculate original unit price
-            original_price = medicine.get_strip_price() if unit_type == 'STRIP' else medicine.price
-
-            # Calculate minimum profitable price (cost + 10%)
-            min_profitable_price = medicine.purchase_price * Decimal('1.10')
-            if unit_type == 'STRIP':
-                min_profitable_price = min_profitable_price / medicine.strips_per_box
-
-            # Calculate discounted price if customer exists
-            if customer:
-                if customer.customer_type == 'FAMILY':
-                    # For family type, always use minimum profitable price
-                    discounted_price = min_profitable_price
-                else:
-                    # For regular customers with discount percentage
-                    discount = customer.discount_percentage / 100
-                    discounted_price = original_price * (1 - discount)
-                    # Ensure price doesn't go below minimum profitable price
-                    if discounted_price < min_profitable_price:
-                        discounted_price = min_profitable_price
+            medicine = lookup_barcode(barcode)
+            if medicine is None:
+                raise Medicine.DoesNotExist
+            cart = get_cart(request)
+            if customer_id:
+                customer = Customer.objects.get(id=customer_id)
             else:
-                discounted_price = original_price
-
-            # Calculate totals
-            original_total = float(original_price * quantity)
-            discounted_total = float(discounted_price * quantity)
-
-            # Add to cart
-            cart = request.session.get('cart', [])
-            cart.append({
-                'medicine_id': medicine.id,
-                'name': medicine.name,
-                'quantity': quantity,
-                'unit_type': unit_type,
-                'expiration_date': expiration_date,
-                'original_price': float(original_price),
-                'discounted_price': float(discounted_price),
-                'total': discounted_total
-            })
-            request.session['cart'] = cart
-            request.session.modified = True
+                customer = cart.customer
 
+            # Stock is only checked here, not deducted; the line may span
+            # several expiration batches (FEFO, starting at the selected one).
+            add_to_cart(cart, medicine, quantity, unit_type, expiration_date, customer)
             messages.success(request, f'Added {quantity} {unit_type} of {medicine.name} to cart')
 
+        except ValidationError as e:
+            messages.error(request, e.messages[0])
         except Medicine.DoesNotExist:
             messages.error(request, 'Product not found')
         except Customer.DoesNotExist:
@@ -1873,6 +1551,77 @@ def pos_add_to_cart(request):
 
     return redirect('pharmacy:pos')
 
+@login_required
+@require_http_methods(['GET', 'POST'])
+def pos_scan(request):
+    """One-call scan endpoint for the POS page.
+
+    GET returns the product, its box/strip prices for the selected customer
+    and the sellable lots. POST does the same and also adds the line to the
+    cart (same rules as pos_add_to_cart), returning the new line and totals
+    so the page can update in place instead of reloading.
+    """
+    params = request.POST if request.method == 'POST' else request.GET
+    medicine = lookup_barcode(params.get('barcode'))
+    if medicine is None:
+        return JsonResponse({'success': False, 'error': 'Product not found'}, status=404)
+
+    cart = get_cart(request)
+    if params.get('customer_id'):
+        try:
+            customer = Customer.objects.get(id=int(params['customer_id']))
+        except ValueError:
+            return JsonResponse({'success': False, 'error': 'Invalid customer'}, status=400)
+        except Customer.DoesNotExist:
+            return JsonResponse({'success': False, 'error': 'Customer not found'}, status=404)
+    else:
+        customer = cart.customer
+
+    book = LotBook.load([medicine.id])
+    box_price, box_discounted = unit_prices(medicine, 'BOX', customer)
+    prices = {'box': {'original': float(box_price), 'discounted': float(box_discounted)}}
+    if medicine.can_sell_strips:
+        strip_price, strip_discounted = unit_prices(medicine, 'STRIP', customer)
+        prices['strip'] = {'original': float(strip_price), 'discounted': float(strip_discounted)}
+    data = {
+        'success': True,
+        'medicine': {
+            'id': medicine.id,
+            'name': medicine.name,
+            'barcode': medicine.barcode_number,
+            'strips_per_box': medicine.strips_per_box,
+            'can_sell_strips': medicine.can_sell_strips,
+        },
+        'prices': prices,
+    }
+
+    # The lots show what is left once the cart's lines (and, on POST, the
+    # new one) are taken from them, as checkout will take them
+    if request.method == 'POST':
+        try:
+            quantity = int(params.get('quantity', 1))
+        except ValueError:
+            data.update(success=False, error='Invalid quantity', lots=lots_left(book, cart, medicine))
+            return JsonResponse(data, status=400)
+        try:
+            line = add_to_cart(
+                cart, medicine, quantity,
+                unit_type=params.get('unit_type', 'BOX'),
+                expiration_date=params.get('expiration_date'),
+                customer=customer,
+                book=book,
+            )
+        except ValidationError as e:
+            # The book may hold part of the failed reservation
+            data.update(success=False, error=e.messages[0],
+                        lots=lots_left(LotBook.load([medicine.id]), cart, medicine))
+            return JsonResponse(data, status=409)
+        data['lots'] = lot_summary(book, medicine.id)
+        data['cart'] = {'line': line_data(line, medicine.name), **cart_summary(cart)}
+    else:
+        data['lots'] = lots_left(book, cart, medicine)
+    return JsonResponse(data)
+
 
 class ProfitAnalyticsView(LoginRequiredMixin, RoleRequiredMixin, TemplateView):
     template_name = 'pharmacy/profit_analytics.html'
@@ -1892,32 +1641,47 @@ class ProfitAnalyticsView(LoginRequiredMixin, RoleRequiredMixin, TemplateView):
         else:
             start_date = end_date - timedelta(days=30)
         
-        # Get analytics data for date range
-        analytics = ProfitAnalytics.objects.filter(
-            date__range=[start_date, end_date]
-        ).order_by('date')
-        
+        # Read from the daily sales rollup (pharmacy.sales_rollup), which
+        # checkout and returns keep current, so today is included
+        rows = DailySales.objects.filter(day__range=[start_date, end_date])
+        days = profit_by_day(rows)
+        analytics = [
+            {'date': day['day'], 'total_sales': day['revenue'], 'total_profit': day['profit']} for day in days
+        ]
+        # The totals are what the sales took, after their discounts, as on
+        # the profit report (pharmacy.sale_costs.sales_totals)
+        totals = sales_totals(Sale.objects.filter(
+            is_completed=True, created_at__date__range=[start_date, end_date]
+        ))
+        total_sales = totals['revenue']
+        total_profit = totals['profit']
+        transactions = totals['sales']
+
         # Calculate summary metrics
         summary = {
-            'total_sales': sum(a.total_sales for a in analytics),
-            'total_profit': sum(a.total_profit for a in analytics),
-            'average_margin': statistics.mean([a.profit_margin for a in analytics]) if analytics else 0,
-            'total_transactions': sum(a.number_of_sales for a in analytics),
-            'avg_profit_per_sale': statistics.mean([a.average_profit_per_sale for a in analytics]) if analytics else 0
+            'total_sales': total_sales,
+            'total_profit': total_profit,
+            'average_margin': statistics.mean(
+                [day['profit'] / day['revenue'] * 100 for day in days if day['revenue']]
+            ) if any(day['revenue'] for day in days) else 0,
+            'total_transactions': transactions,
+            'avg_profit_per_sale': total_profit / transactions if transactions else 0
         }
-        
+
         # Get category performance
-        category_profits = {}
-        for analytic in analytics:
-            if analytic.most_profitable_category:
-                category_profits[analytic.most_profitable_category] = \
-                    category_profits.get(analytic.most_profitable_category, 0) + analytic.total_profit
-        
+        category_names = dict(Medicine.CATEGORY_CHOICES)
+        category_profits = {
+            category_names.get(row['medicine__category'], row['medicine__category']): row['profit']
+            for row in rows.values('medicine__category').annotate(
+                profit=Sum('revenue') - Sum('cost')
+            ).order_by('-profit')
+        }
+
         # Get top performing medicines
         top_medicines = Medicine.objects.filter(
-            top_profit_days__date__range=[start_date, end_date]
+            daily_sales__day__range=[start_date, end_date]
         ).annotate(
-            total_profit=Sum('top_profit_days__total_profit')
+            total_profit=Sum('daily_sales__revenue') - Sum('daily_sales__cost')
         ).order_by('-total_profit')[:10]
         
         context.update({
@@ -1930,244 +1694,26 @@ class ProfitAnalyticsView(LoginRequiredMixin, RoleRequiredMixin, TemplateView):
         })
         return context
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw
 import barcode as pybarcode
 from barcode.writer import ImageWriter
 import io
-try:
-    import arabic_reshaper
-    from bidi.algorithm import get_display
-    def shape_arabic(text):
-        reshaped = arabic_reshaper.reshape(text)
-        return get_display(reshaped)
-except ImportError:
-    def shape_arabic(text):
-        return text
+from .render_context import get_font, shaped
+from .receipts import render_invoice_tspl
+from .print_spooler import enqueue_print_job, get_transport
 
 
 def print_invoice_thermal(sale, completed_items, extra, printer_name=None):
-    """Print a sale invoice/receipt directly to the same thermal printer used for
-    barcode labels, using the continuous (gap-less) roll instead of the die-cut
-    label roll. Mirrors the GDI drawing approach used by barcode_print() so both
-    features go through the same printer without needing a browser print dialog.
+    """Print a sale invoice/receipt directly to the thermal printer, blocking
+    until the printer has the job. Checkout and reprints go through the print
+    spooler instead (enqueue_print_job); this stays for callers that need the
+    print to have happened before they continue.
 
     Returns True on success, raises on failure (caller decides how to report it).
     """
-    import win32print
-
     printer_name = printer_name or settings.PRINTER_SETTINGS['PRINTER_PATH']
-    DPI = settings.PRINTER_SETTINGS['PRINTER_DPI']
-    MM_TO_INCH = 25.4
-    PAPER_WIDTH_MM = settings.PRINTER_SETTINGS.get('INVOICE_PAPER_WIDTH', 48)
-    WIDTH_PX = int(PAPER_WIDTH_MM / MM_TO_INCH * DPI)
-
-    REGULAR_PATHS = [
-        "C:\\Windows\\Fonts\\arial.ttf",
-        "C:\\Windows\\Fonts\\Tahoma.ttf",
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-    ]
-    BOLD_PATHS = [
-        "C:\\Windows\\Fonts\\arialbd.ttf",
-        "C:\\Windows\\Fonts\\tahomabd.ttf",
-        "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
-    ]
-    TITLE_SIZE = 26
-    HEADING_SIZE = 20
-    BODY_SIZE = 19
-
-    def _load_font(paths, size):
-        for path in paths:
-            try:
-                return ImageFont.truetype(path, size)
-            except OSError:
-                continue
-        return ImageFont.load_default()
-
-    title_font = _load_font(BOLD_PATHS, TITLE_SIZE)
-    heading_font = _load_font(BOLD_PATHS, HEADING_SIZE)
-    body_font = _load_font(REGULAR_PATHS, BODY_SIZE)
-    body_bold_font = _load_font(BOLD_PATHS, BODY_SIZE)
-
-    LINE_GAP = 8
-    FONT_HEIGHTS = {}
-
-    def txt(text):
-        """Shape+reorder Arabic text for correct display; safe no-op on plain numbers/ASCII."""
-        return shape_arabic(str(text))
-
-    # Each entry: (text, font, align, kind) kind in {"text", "hr", "space"}
-    lines = []
-
-    def add(text, font, align="right"):
-        lines.append(("text", txt(text), font, align))
-
-    def add_rule(thick=False):
-        lines.append(("hr", None, None, thick))
-
-    def add_space(px=6):
-        lines.append(("space", px, None, None))
-
-    def add_cols(right_text, mid_text, left_text, font):
-        lines.append(("cols", (txt(right_text), txt(mid_text), txt(left_text)), font, None))
-
-    add_space(16)
-    add("صيدلية الإسراء", title_font, "center")
-    add("فاتورة مبيعات", heading_font, "center")
-    add_space(12)
-    add_rule()
-    add_space(14)
-
-    add(f"رقم الفاتورة: {sale.id}", body_font, "right")
-    add_space(4)
-    add(f"التاريخ: {extra['created_at']}", body_font, "right")
-    if extra.get('customer'):
-        add_space(4)
-        add(f"العميل: {extra['customer']}", body_font, "right")
-    add_space(12)
-    add_rule()
-    add_space(14)
-
-    add_cols("الكمية", "السعر", "الإجمالي", body_bold_font)
-    add_rule()
-    add_space(10)
-
-    for item in completed_items:
-        add(item['name'][:28], body_bold_font, "right")
-        add_space(4)
-        add_cols(
-            f"{item['quantity']} {item['unit_type']}",
-            f"{item['price']:.2f}",
-            f"{item['total']:.2f}",
-            body_font,
-        )
-        add_space(14)
-
-    add_rule()
-    add_space(14)
-
-    add(f"الإجمالي: {extra['original_total']:.2f} ج.م", body_font, "right")
-    if extra.get('discount_amount'):
-        add_space(6)
-        add(f"الخصم: {extra['discount_amount']:.2f} ج.م", body_font, "right")
-    add_space(8)
-    add(f"الصافي المطلوب: {extra['total']:.2f} ج.م", heading_font, "right")
-    add_space(10)
-    add(f"المبلغ المدفوع: {extra['cash_given']:.2f} ج.م", body_font, "right")
-    add_space(4)
-    add(f"الباقي: {extra['change_return']:.2f} ج.م", body_font, "right")
-    add_space(14)
-    add_rule(thick=True)
-    add_space(20)
-    add("شكراً لزيارتكم", heading_font, "center")
-    add_space(4)
-    add("نتمنى لكم دوام الصحة والعافية", body_font, "center")
-    add_space(50)
-
-    TOP_MARGIN = 20
-    BOTTOM_MARGIN = 10
-    SIDE_MARGIN = 12
-
-    def line_height_of(f):
-        if f not in FONT_HEIGHTS:
-            bbox = f.getbbox("Aأيگ0")
-            FONT_HEIGHTS[f] = (bbox[3] - bbox[1]) + LINE_GAP
-        return FONT_HEIGHTS[f]
-
-    height_px = TOP_MARGIN + BOTTOM_MARGIN
-    for kind, text, font, align in lines:
-        if kind == "text" or kind == "cols":
-            height_px += line_height_of(font)
-        elif kind == "hr":
-            height_px += 10 if align else 6  # `align` slot doubles as `thick` for hr rows
-        elif kind == "space":
-            height_px += text
-
-    image = Image.new("L", (WIDTH_PX, height_px), 255)
-    draw = ImageDraw.Draw(image)
-
-    y = TOP_MARGIN
-    for kind, text, font, align in lines:
-        if kind == "text":
-            h = line_height_of(font)
-            if align == "center":
-                draw.text((WIDTH_PX // 2, y), text, font=font, fill=0, anchor="ma")
-            elif align == "right":
-                draw.text((WIDTH_PX - SIDE_MARGIN, y), text, font=font, fill=0, anchor="ra")
-            else:
-                draw.text((SIDE_MARGIN, y), text, font=font, fill=0)
-            y += h
-        elif kind == "cols":
-            h = line_height_of(font)
-            right_text, mid_text, left_text = text
-            draw.text((WIDTH_PX - SIDE_MARGIN, y), right_text, font=font, fill=0, anchor="ra")
-            draw.text((WIDTH_PX // 2, y), mid_text, font=font, fill=0, anchor="ma")
-            draw.text((SIDE_MARGIN, y), left_text, font=font, fill=0, anchor="la")
-            y += h
-        elif kind == "hr":
-            thick = align
-            if thick:
-                draw.line([(SIDE_MARGIN, y + 2), (WIDTH_PX - SIDE_MARGIN, y + 2)], fill=0, width=2)
-                draw.line([(SIDE_MARGIN, y + 6), (WIDTH_PX - SIDE_MARGIN, y + 6)], fill=0, width=1)
-                y += 10
-            else:
-                draw.line([(SIDE_MARGIN, y + 3), (WIDTH_PX - SIDE_MARGIN, y + 3)], fill=0, width=1)
-                y += 6
-        elif kind == "space":
-            y += text
-
-    # Print via a raw TSPL command stream instead of the Windows GDI print path.
-    # GDI printing goes through the driver's own saved page-size/sensor defaults
-    # (tuned for the die-cut barcode roll), so on the continuous invoice roll the
-    # printer kept hunting for a label gap that doesn't exist and fed a long
-    # stretch of paper before giving up. TSPL's "GAP 0 mm,0 mm" line tells the
-    # printer firmware directly, on every single job, "this stock has no gaps" —
-    # confirmed on the real printer to print cleanly with no extra feed.
-    height_mm = (height_px / DPI) * MM_TO_INCH
-    width_px, height_px_final = image.size
-    bytes_per_row = (width_px + 7) // 8
-    pixels = image.load()
-    bitmap_data = bytearray(bytes_per_row * height_px_final)
-    for y in range(height_px_final):
-        row_offset = y * bytes_per_row
-        byte = 0
-        bit_count = 0
-        col = 0
-        for x in range(width_px):
-            bit = 0 if pixels[x, y] < 128 else 1  # this printer's BITMAP convention: 0 = printed (black), 1 = blank
-            byte = (byte << 1) | bit
-            bit_count += 1
-            if bit_count == 8:
-                bitmap_data[row_offset + col] = byte
-                col += 1
-                byte = 0
-                bit_count = 0
-        if bit_count:
-            pad = 8 - bit_count
-            bitmap_data[row_offset + col] = (byte << pad) | ((1 << pad) - 1)  # pad with blank, not black
-
-    header = (
-        f"SIZE {PAPER_WIDTH_MM} mm, {height_mm:.1f} mm\r\n"
-        "GAP 0 mm, 0 mm\r\n"
-        "DENSITY 8\r\n"
-        "DIRECTION 0\r\n"
-        "REFERENCE 0,0\r\n"
-        "CLS\r\n"
-        f"BITMAP 0,0,{bytes_per_row},{height_px_final},0,"
-    ).encode("ascii")
-    footer = b"\r\nPRINT 1\r\n"
-    payload = header + bytes(bitmap_data) + footer
-
-    hprinter = win32print.OpenPrinter(printer_name)
-    try:
-        job = win32print.StartDocPrinter(hprinter, 1, (f"Invoice {sale.id}", None, "RAW"))
-        try:
-            win32print.StartPagePrinter(hprinter)
-            win32print.WritePrinter(hprinter, payload)
-            win32print.EndPagePrinter(hprinter)
-        finally:
-            win32print.EndDocPrinter(hprinter)
-    finally:
-        win32print.ClosePrinter(hprinter)
+    payload = render_invoice_tspl(dict(extra, id=sale.id, items=completed_items))
+    get_transport().send(printer_name, f"Invoice {sale.id}", payload)
     return True
 
 
@@ -2180,7 +1726,7 @@ def barcode_print(request):
     error_message = None
     debug_info = []
     if barcode:
-        medicine = Medicine.objects.filter(barcode_number=barcode).first()
+        medicine = lookup_barcode(barcode)
         # Handle thermal printing
         if request.GET.get('thermal_print') and medicine:
             try:
@@ -2188,11 +1734,6 @@ def barcode_print(request):
                 printer_name = settings.PRINTER_SETTINGS['PRINTER_PATH']
                 debug_info.append(f"Printer name: {printer_name}")
                 logger.info(f"Attempting to print barcode {barcode} to {printer_name}")
-                import win32print
-                import win32ui
-                import tempfile
-                import uuid
-                from PIL import ImageWin
                 # --- Label settings ---
                 LABEL_WIDTH_MM = 40
                 LABEL_HEIGHT_MM = 25
@@ -2207,7 +1748,8 @@ def barcode_print(request):
                 BARCODE_VALUE = str(medicine.barcode_number)  # Ensure string
                 
                 # --- Get expiration date from latest stock entry ---
-                latest_stock = medicine.stock_entries.filter(
+                latest_stock = StockEntry.objects.filter(
+                    medicine_id=medicine.id,
                     expiration_date__gte=timezone.now().date()
                 ).order_by('-created_at').first()
                 
@@ -2216,154 +1758,153 @@ def barcode_print(request):
                     exp_date = latest_stock.expiration_date
                     EXPIRATION_DATE_FORMATTED = f"{exp_date.month:02d}/{exp_date.year % 100:02d}"
                 
-                # --- Font ---
-                FONT_PATHS = [
-                    "C:\\Windows\\Fonts\\arial.ttf",
-                    "C:\\Windows\\Fonts\\Tahoma.ttf",
-                    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-                ]
-                FONT_SIZE = 24
-                font = None
-                for path in FONT_PATHS:
-                    try:
-                        font = ImageFont.truetype(path, FONT_SIZE)
-                        break
-                    except OSError:
-                        continue
-                if font is None:
-                    font = ImageFont.load_default()
-                # --- Arabic shaping ---
-                PHARMACY_NAME_SHAPED = shape_arabic(PHARMACY_NAME)
-                PRODUCT_NAME_SHAPED = shape_arabic(PRODUCT_NAME)
-                # --- Create label image ---
-                image = Image.new("L", (WIDTH_PX, HEIGHT_PX), 255)
-                draw = ImageDraw.Draw(image)
-                def get_text_size(draw, text, font):
-                    bbox = draw.textbbox((0, 0), text, font=font)
-                    width = bbox[2] - bbox[0]
-                    height = bbox[3] - bbox[1]
-                    return width, height
-                # Pharmacy name
-                pharmacy_w, pharmacy_h = get_text_size(draw, PHARMACY_NAME_SHAPED, font)
-                draw.text(((WIDTH_PX - pharmacy_w) // 2, 5), PHARMACY_NAME_SHAPED, font=font, fill=0)
-                # Product name
-                product_w, product_h = get_text_size(draw, PRODUCT_NAME_SHAPED, font)
-                draw.text(((WIDTH_PX - product_w) // 2, 5 + pharmacy_h + 2), PRODUCT_NAME_SHAPED, font=font, fill=0)
+                if tspl_mode() and tspl_barcode_ok(BARCODE_VALUE):
+                    # Barcode, price and expiry as printer commands; one queued job for all copies
+                    payload = medicine_label_tspl(
+                        medicine, latest_stock.expiration_date if latest_stock else None, copies,
+                    )
+                    enqueue_print_job(
+                        PrintJob.RAW, payload=payload, title=f"Label {BARCODE_VALUE}", printer_name=printer_name,
+                    )
+                    printed = True
+                    messages.success(request, "تم إرسال الملصق للطباعة")
+                else:
+                    # Whole label drawn as an image and printed through GDI
+                    import win32ui
+                    import tempfile
+                    import uuid
+                    from PIL import ImageWin
+                    # --- Font (loaded once per process) ---
+                    FONT_SIZE = 24
+                    font = get_font('regular', FONT_SIZE)
+                    # --- Arabic shaping ---
+                    PHARMACY_NAME_SHAPED = shaped(PHARMACY_NAME)
+                    PRODUCT_NAME_SHAPED = shaped(PRODUCT_NAME)
+                    # --- Create label image ---
+                    image = Image.new("L", (WIDTH_PX, HEIGHT_PX), 255)
+                    draw = ImageDraw.Draw(image)
+                    def get_text_size(draw, text, font):
+                        bbox = draw.textbbox((0, 0), text, font=font)
+                        width = bbox[2] - bbox[0]
+                        height = bbox[3] - bbox[1]
+                        return width, height
+                    # Pharmacy name
+                    pharmacy_w, pharmacy_h = get_text_size(draw, PHARMACY_NAME_SHAPED, font)
+                    draw.text(((WIDTH_PX - pharmacy_w) // 2, 5), PHARMACY_NAME_SHAPED, font=font, fill=0)
+                    # Product name
+                    product_w, product_h = get_text_size(draw, PRODUCT_NAME_SHAPED, font)
+                    draw.text(((WIDTH_PX - product_w) // 2, 5 + pharmacy_h + 2), PRODUCT_NAME_SHAPED, font=font, fill=0)
                 
-                # Draw vertical expiration date on the right side
-                try:
-                    expiry_font_size = 20
-                    expiry_font = ImageFont.truetype(FONT_PATHS[0] if FONT_PATHS else "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", expiry_font_size)
-                except:
-                    expiry_font = font
+                    # Draw vertical expiration date on the right side
+                    expiry_font = get_font('regular', 20)
                 
-                # Create a larger temporary image with MUCH MORE space
-                temp_width = 200
-                temp_height = 100
-                expiry_temp_img = Image.new("L", (temp_width, temp_height), 255)
-                expiry_temp_draw = ImageDraw.Draw(expiry_temp_img)
+                    # Create a larger temporary image with MUCH MORE space
+                    temp_width = 200
+                    temp_height = 100
+                    expiry_temp_img = Image.new("L", (temp_width, temp_height), 255)
+                    expiry_temp_draw = ImageDraw.Draw(expiry_temp_img)
                 
-                # Draw text in the center of the large canvas
-                expiry_temp_draw.text((50, 40), EXPIRATION_DATE_FORMATTED, font=expiry_font, fill=0)
+                    # Draw text in the center of the large canvas
+                    expiry_temp_draw.text((50, 40), EXPIRATION_DATE_FORMATTED, font=expiry_font, fill=0)
                 
-                # Rotate 90 degrees counter-clockwise for vertical display
-                expiry_rotated = expiry_temp_img.rotate(90, expand=True)
+                    # Rotate 90 degrees counter-clockwise for vertical display
+                    expiry_rotated = expiry_temp_img.rotate(90, expand=True)
                 
-                # Check if rotated image fits in label height, if not resize it
-                if expiry_rotated.size[0] > HEIGHT_PX:
-                    # Scale down to fit
-                    scale_factor = HEIGHT_PX / expiry_rotated.size[0]
-                    new_size = (int(expiry_rotated.size[0] * scale_factor), int(expiry_rotated.size[1] * scale_factor))
-                    expiry_rotated = expiry_rotated.resize(new_size, Image.LANCZOS)
+                    # Check if rotated image fits in label height, if not resize it
+                    if expiry_rotated.size[0] > HEIGHT_PX:
+                        # Scale down to fit
+                        scale_factor = HEIGHT_PX / expiry_rotated.size[0]
+                        new_size = (int(expiry_rotated.size[0] * scale_factor), int(expiry_rotated.size[1] * scale_factor))
+                        expiry_rotated = expiry_rotated.resize(new_size, Image.LANCZOS)
                 
-                # Convert to binary (pure black and white) for sharp printing
-                expiry_binary = expiry_rotated.convert("1")
-                expiry_binary_l = expiry_binary.convert("L")
+                    # Convert to binary (pure black and white) for sharp printing
+                    expiry_binary = expiry_rotated.convert("1")
+                    expiry_binary_l = expiry_binary.convert("L")
                 
-                # Paste on the right side of the label with proper positioning
-                right_margin = 2
-                expiry_x = WIDTH_PX - expiry_binary_l.size[0] - right_margin
+                    # Paste on the right side of the label with proper positioning
+                    right_margin = 2
+                    expiry_x = WIDTH_PX - expiry_binary_l.size[0] - right_margin
                 
-                # Better vertical centering
-                expiry_y = max(2, (HEIGHT_PX - expiry_binary_l.size[1]) // 2)
+                    # Better vertical centering
+                    expiry_y = max(2, (HEIGHT_PX - expiry_binary_l.size[1]) // 2)
                 
-                image.paste(expiry_binary_l, (expiry_x, expiry_y))
+                    image.paste(expiry_binary_l, (expiry_x, expiry_y))
                 
-                # Price
-                price_w, price_h = get_text_size(draw, PRICE, font)
-                price_y = HEIGHT_PX - price_h - 15
-                if price_y < 0:
-                    price_y = 0
-                draw.text(((WIDTH_PX - price_w) // 2, price_y), PRICE, font=font, fill=0)
-                # Generate the barcode natively at the printer's DPI with a module width
-                # that is a whole number of pixels (module_width=0.25mm -> exactly 2px at
-                # 203 DPI). The previous approach rendered the barcode at python-barcode's
-                # default 300 DPI and then force-resized it with NEAREST to an unrelated
-                # target box — that resize rounds each bar's width differently, so bars
-                # end up slightly uneven, which is exactly what makes a scanner hunt/retry
-                # before it decodes. Generating at the exact target resolution up front
-                # means (in the common case) no resize is needed at all, so every bar is a
-                # clean, consistent width.
-                available_width_px = WIDTH_PX - 20  # leave a small horizontal margin
-                available_height_px = HEIGHT_PX - (5 + pharmacy_h + 2 + product_h + 5 + price_h + 15) - 10
-                if available_height_px < 24:
-                    available_height_px = 24
-                module_width_mm = 0.25  # 2px at 203 DPI
-                module_height_mm = (available_height_px / DPI) * MM_TO_INCH
-
-                # Unique-per-request path: two overlapping print requests (e.g. the
-                # auto-print fired from the "add stock" page racing a manual print from
-                # the barcode page) used to share one fixed "barcode_temp.png" filename,
-                # so whichever request wrote last would win and the other could end up
-                # reading and printing a *different product's* barcode.
-                code128 = pybarcode.get('code128', BARCODE_VALUE, writer=ImageWriter())
-                barcode_temp_base = os.path.join(tempfile.gettempdir(), f"barcode_{medicine.id}_{uuid.uuid4().hex}")
-                barcode_img_path = code128.save(barcode_temp_base, options={
-                    "module_width": module_width_mm,
-                    "module_height": module_height_mm,
-                    "quiet_zone": 2.0,
-                    "write_text": False,
-                    "dpi": DPI,
-                })
-                barcode_img = Image.open(barcode_img_path).convert("L")
-
-                # Only reached for unusually long barcode numbers that don't fit at 2px/module.
-                # Shrink both dimensions by the same factor so bar-width ratios (and therefore
-                # scannability) are preserved, instead of stretching width and height separately.
-                if barcode_img.size[0] > available_width_px:
-                    scale = available_width_px / barcode_img.size[0]
-                    new_size = (available_width_px, max(1, int(barcode_img.size[1] * scale)))
-                    barcode_img = barcode_img.resize(new_size, resample=Image.NEAREST)
-
-                # Convert to strict black & white (monochrome) to ensure printer prints solid bars
-                barcode_mono = barcode_img.point(lambda x: 0 if x < 128 else 255, '1')
-                # Paste monochrome barcode onto label (convert to 'L' to match canvas mode)
-                barcode_paste = barcode_mono.convert("L")
-                barcode_y = 5 + pharmacy_h + 2 + product_h + 5
-                barcode_x = (WIDTH_PX - barcode_img.size[0]) // 2
-                image.paste(barcode_paste, (barcode_x, barcode_y))
-                # Print to Windows printer
-                hDC = win32ui.CreateDC()
-                hDC.CreatePrinterDC(printer_name)
-                printer_size = hDC.GetDeviceCaps(110), hDC.GetDeviceCaps(111)
-                for _ in range(copies):
-                    hDC.StartDoc("Barcode Label")
-                    hDC.StartPage()
-                    dib = ImageWin.Dib(image)
-                    x = int((printer_size[0] - image.size[0]) / 2)
-                    y = int((printer_size[1] - image.size[1]) / 2)
-                    dib.draw(hDC.GetHandleOutput(), (x, y, x + image.size[0], y + image.size[1]))
-                    hDC.EndPage()
-                    hDC.EndDoc()
-                hDC.DeleteDC()
-                printed = True
-                logger.info("Print job completed successfully")
-                messages.success(request, "تمت الطباعة بنجاح")
-                # Clean up temp barcode image
-                try:
-                    os.remove(barcode_img_path)
-                except Exception:
-                    pass
+                    # Price
+                    price_w, price_h = get_text_size(draw, PRICE, font)
+                    price_y = HEIGHT_PX - price_h - 15
+                    if price_y < 0:
+                        price_y = 0
+                    draw.text(((WIDTH_PX - price_w) // 2, price_y), PRICE, font=font, fill=0)
+                    # Generate the barcode natively at the printer's DPI with a module width
+                    # that is a whole number of pixels (module_width=0.25mm -> exactly 2px at
+                    # 203 DPI). The previous approach rendered the barcode at python-barcode's
+                    # default 300 DPI and then force-resized it with NEAREST to an unrelated
+                    # target box — that resize rounds each bar's width differently, so bars
+                    # end up slightly uneven, which is exactly what makes a scanner hunt/retry
+                    # before it decodes. Generating at the exact target resolution up front
+                    # means (in the common case) no resize is needed at all, so every bar is a
+                    # clean, consistent width.
+                    available_width_px = WIDTH_PX - 20  # leave a small horizontal margin
+                    available_height_px = HEIGHT_PX - (5 + pharmacy_h + 2 + product_h + 5 + price_h + 15) - 10
+                    if available_height_px < 24:
+                        available_height_px = 24
+                    module_width_mm = 0.25  # 2px at 203 DPI
+                    module_height_mm = (available_height_px / DPI) * MM_TO_INCH
+
+                    # Unique-per-request path: two overlapping print requests (e.g. the
+                    # auto-print fired from the "add stock" page racing a manual print from
+                    # the barcode page) used to share one fixed "barcode_temp.png" filename,
+                    # so whichever request wrote last would win and the other could end up
+                    # reading and printing a *different product's* barcode.
+                    code128 = pybarcode.get('code128', BARCODE_VALUE, writer=ImageWriter())
+                    barcode_temp_base = os.path.join(tempfile.gettempdir(), f"barcode_{medicine.id}_{uuid.uuid4().hex}")
+                    barcode_img_path = code128.save(barcode_temp_base, options={
+                        "module_width": module_width_mm,
+                        "module_height": module_height_mm,
+                        "quiet_zone": 2.0,
+                        "write_text": False,
+                        "dpi": DPI,
+                    })
+                    barcode_img = Image.open(barcode_img_path).convert("L")
+
+                    # Only reached for unusually long barcode numbers that don't fit at 2px/module.
+                    # Shrink both dimensions by the same factor so bar-width ratios (and therefore
+                    # scannability) are preserved, instead of stretching width and height separately.
+                    if barcode_img.size[0] > available_width_px:
+                        scale = available_width_px / barcode_img.size[0]
+                        new_size = (available_width_px, max(1, int(barcode_img.size[1] * scale)))
+                        barcode_img = barcode_img.resize(new_size, resample=Image.NEAREST)
+
+                    # Convert to strict black & white (monochrome) to ensure printer prints solid bars
+                    barcode_mono = barcode_img.point(lambda x: 0 if x < 128 else 255, '1')
+                    # Paste monochrome barcode onto label (convert to 'L' to match canvas mode)
+                    barcode_paste = barcode_mono.convert("L")
+                    barcode_y = 5 + pharmacy_h + 2 + product_h + 5
+                    barcode_x = (WIDTH_PX - barcode_img.size[0]) // 2
+                    image.paste(barcode_paste, (barcode_x, barcode_y))
+                    # Print to Windows printer
+                    hDC = win32ui.CreateDC()
+                    hDC.CreatePrinterDC(printer_name)
+                    printer_size = hDC.GetDeviceCaps(110), hDC.GetDeviceCaps(111)
+                    for _ in range(copies):
+                        hDC.StartDoc("Barcode Label")
+                        hDC.StartPage()
+                        dib = ImageWin.Dib(image)
+                        x = int((printer_size[0] - image.size[0]) / 2)
+                        y = int((printer_size[1] - image.size[1]) / 2)
+                        dib.draw(hDC.GetHandleOutput(), (x, y, x + image.size[0], y + image.size[1]))
+                        hDC.EndPage()
+                        hDC.EndDoc()
+                    hDC.DeleteDC()
+                    printed = True
+                    logger.info("Print job completed successfully")
+                    messages.success(request, "تمت الطباعة بنجاح")
+                    # Clean up temp barcode image
+                    try:
+                        os.remove(barcode_img_path)
+                    except Exception:
+                        pass
             except Exception as e:
                 error_message = f"Error printing label: {str(e)}"
                 logger.error(error_message, exc_info=True)
@@ -2373,7 +1914,8 @@ def barcode_print(request):
     latest_stock = None
     expiry_formatted = 'MM/YY'
     if medicine:
-        latest_stock = medicine.stock_entries.filter(
+        latest_stock = StockEntry.objects.filter(
+            medicine_id=medicine.id,
             expiration_date__gte=timezone.now().date()
         ).order_by('-created_at').first()
         if latest_stock:
@@ -2403,7 +1945,7 @@ def barcode_print_optimized(request):
     quiet_zone = request.GET.get('quiet_zone', '3')
     
     if barcode:
-        medicine = Medicine.objects.filter(barcode_number=barcode).first()
+        medicine = lookup_barcode(barcode)
         
         if medicine and request.method == 'POST' and request.POST.get('print_optimized'):
             try:
@@ -2434,26 +1976,13 @@ def barcode_print_optimized(request):
                 PRICE = f"{medicine.price} ج.م"
                 BARCODE_VALUE = str(medicine.barcode_number)
                 
-                # Font
-                FONT_PATHS = [
-                    "C:\\Windows\\Fonts\\arial.ttf",
-                    "C:\\Windows\\Fonts\\Tahoma.ttf",
-                    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-                ]
+                # Font (loaded once per process)
                 FONT_SIZE = 26
-                font = None
-                for path in FONT_PATHS:
-                    try:
-                        font = ImageFont.truetype(path, FONT_SIZE)
-                        break
-                    except OSError:
-                        continue
-                if font is None:
-                    font = ImageFont.load_default()
+                font = get_font('regular', FONT_SIZE)
                 
                 # Arabic shaping
-                PHARMACY_NAME_SHAPED = shape_arabic(PHARMACY_NAME)
-                PRODUCT_NAME_SHAPED = shape_arabic(PRODUCT_NAME[:20])
+                PHARMACY_NAME_SHAPED = shaped(PHARMACY_NAME)
+                PRODUCT_NAME_SHAPED = shaped(PRODUCT_NAME[:20])
                 
                 # Create label image
                 image = Image.new("L", (WIDTH_PX, HEIGHT_PX), 255)
@@ -2470,11 +1999,7 @@ def barcode_print_optimized(request):
                 draw.text(((WIDTH_PX - pharmacy_w) // 2, 3), PHARMACY_NAME_SHAPED, font=font, fill=0)
                 
                 # Product name (smaller font but still large for visibility)
-                small_font = font if FONT_SIZE > 14 else font
-                try:
-                    small_font = ImageFont.truetype(FONT_PATHS[0] if FONT_PATHS else "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 20)
-                except:
-                    pass
+                small_font = get_font('regular', 20)
                 product_w, product_h = get_text_size(draw, PRODUCT_NAME_SHAPED, small_font)
                 draw.text(((WIDTH_PX - product_w) // 2, 3 + pharmacy_h + 1), PRODUCT_NAME_SHAPED, font=small_font, fill=0)
                 
@@ -2520,11 +2045,7 @@ def barcode_print_optimized(request):
                 image.paste(barcode_mono, (3, barcode_y))
                 
                 # Price (use larger font for better visibility)
-                price_font = font
-                try:
-                    price_font = ImageFont.truetype(FONT_PATHS[0] if FONT_PATHS else "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 24)
-                except:
-                    price_font = font
+                price_font = get_font('regular', 24)
                 
                 price_w, price_h = get_text_size(draw, PRICE, price_font)
                 price_y = HEIGHT_PX - price_h - 2
@@ -2602,10 +2123,11 @@ def invoice_print(request):
 
 @login_required
 def invoice_print_old(request, sale_id):
-    """Reprint an old sale from Sales History straight to the thermal printer —
-    same print_invoice_thermal() used for the POS checkout invoice, so a reprint
-    looks and prints identically to the original instead of going through the
-    old browser print-dialog page."""
+    """Reprint an old sale from Sales History on the thermal printer — queued
+    exactly like the POS checkout invoice, so a reprint looks and prints
+    identically to the original instead of going through the old browser
+    print-dialog page. Repeated clicks while the reprint is still queued (or
+    just printed) don't print it again."""
     referer = request.META.get('HTTP_REFERER')
     fallback_redirect = redirect(referer) if referer else redirect('pharmacy:sales_history')
     try:
@@ -2632,14 +2154,32 @@ def invoice_print_old(request, sale_id):
             'created_at': timezone.localtime(sale.created_at).strftime('%Y-%m-%d %H:%M:%S'),
         }
 
-        print_invoice_thermal(sale, completed_sale['items'], completed_sale)
-        messages.success(request, f'تمت إعادة طباعة الفاتورة رقم {sale.id}')
+        job, created = enqueue_print_job(
+            PrintJob.INVOICE, data=completed_sale, title=f"Invoice {sale.id}", dedupe=True)
+        if created:
+            messages.success(request, f'تم إرسال الفاتورة رقم {sale.id} للطباعة')
+        else:
+            messages.info(request, f'الفاتورة رقم {sale.id} قيد الطباعة بالفعل')
     except Exception as e:
         logger.error(f"Error reprinting invoice for sale {sale_id}: {str(e)}", exc_info=True)
         messages.error(request, f'حدث خطأ أثناء طباعة الفاتورة: {str(e)}')
 
     return fallback_redirect
 
+@login_required
+def print_job_status(request, job_id):
+    """JSON status of a queued print job, polled by the POS page."""
+    job = get_object_or_404(PrintJob, id=job_id)
+    return JsonResponse({
+        'id': job.id,
+        'title': job.title,
+        'status': job.status,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'error': job.last_error,
+        'printed_at': job.printed_at.isoformat() if job.printed_at else None,
+    })
+
 @login_required
 def edit_stock_entry(request, entry_id):
     stock_entry = get_object_or_404(StockEntry, id=entry_id)
@@ -2731,15 +2271,35 @@ from django.views.decorators.http import require_GET
 @login_required
 def get_expiration_dates(request):
     barcode = request.GET.get('barcode')
-    try:
-        medicine = Medicine.objects.get(barcode_number=barcode)
-        # For strips, include entries with strips_remaining > 0
-        stock_entries = medicine.stock_entries.filter(
-            expiration_date__gte=timezone.now().date()
-        ).filter(
-            Q(quantity__gt=0) | Q(strips_remaining__gt=0)
-        )
-        dates = [entry.expiration_date.strftime('%Y-%m-%d') for entry in stock_entries]
-        return JsonResponse({'success': True, 'dates': dates})
-    except Medicine.DoesNotExist:
+    medicine = lookup_barcode(barcode)
+    if medicine is None:
         return JsonResponse({'success': False, 'error': 'Medicine not found'})
+    # For strips, include entries with strips_remaining > 0
+    dates = StockEntry.objects.filter(
+        medicine_id=medicine.id,
+        expiration_date__gte=timezone.now().date()
+    ).filter(
+        Q(quantity__gt=0) | Q(strips_remaining__gt=0)
+    ).values_list('expiration_date', flat=True)
+    return JsonResponse({'success': True, 'dates': [d.strftime('%Y-%m-%d') for d in dates]})
+
+@login_required
+def barcode_cache_stats(request):
+    """Hit/miss counters of the process-wide barcode lookup cache, for monitoring."""
+    if not request.user.is_staff:
+        return JsonResponse({'error': 'Staff only'}, status=403)
+    return JsonResponse(barcode_lookup.stats())
+
+@login_required
+@require_http_methods(['GET', 'HEAD'])
+@etag(lambda request, number: image_etag(number))
+def barcode_image(request, number):
+    """EAN-13 image of a medicine's barcode number, drawn on first request.
+    The image never changes for a number, so browsers may keep it for a year."""
+    try:
+        png = barcode_png(number)
+    except ValueError:
+        raise Http404('Not the EAN-13 barcode of a medicine')
+    response = HttpResponse(png, content_type='image/png')
+    patch_cache_control(response, private=True, max_age=365 * 24 * 60 * 60, immutable=True)
+    return response
@@ -1,6 +1,7 @@
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
 from .utils_profit import get_total_profit, get_total_revenue
+from .sale_costs import sales_totals
 from pharmacy.models import Sale, SaleItem
 from django.utils.dateparse import parse_date
 
@@ -8,20 +9,16 @@ from django.utils.dateparse import parse_date
 def profit_report(request):
     start_date = request.GET.get('start_date')
     end_date = request.GET.get('end_date')
-    sale_items = SaleItem.objects.filter(sale__is_completed=True).select_related('medicine', 'sale')
     sales = Sale.objects.filter(is_completed=True)
     if start_date:
-        sale_items = sale_items.filter(sale__created_at__date__gte=start_date)
         sales = sales.filter(created_at__date__gte=start_date)
     if end_date:
-        sale_items = sale_items.filter(sale__created_at__date__lte=end_date)
         sales = sales.filter(created_at__date__lte=end_date)
-    from django.db.models import Sum
-    total_profit = sum(item.profit for item in sale_items)
-    total_revenue = sales.aggregate(total=Sum('total_amount'))['total'] or 0
+    # Revenue and profit in one aggregate query (pharmacy.sale_costs)
+    totals = sales_totals(sales)
     return render(request, 'pharmacy/profit_report.html', {
-        'total_revenue': total_revenue,
-        'total_profit': total_profit,
+        'total_revenue': totals['revenue'],
+        'total_profit': totals['profit'],
         'start_date': start_date,
         'end_date': end_date,
     })
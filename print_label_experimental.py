@@ -25,6 +25,8 @@ from PIL import Image, ImageDraw, ImageFont
 import barcode
 from barcode.writer import ImageWriter
 
+from pharmacy.raster import pack_bitmap
+
 # Optional Windows raw printing support
 try:
     import win32print
@@ -59,33 +61,13 @@ def choose_barcode_type(value):
 
 
 def pack_image_to_tspl_bytes(im):
-    """Pack a monochrome PIL image (mode '1' or 'L') into raw bytes matching test_printer packing.
-    Returns a bytes object of width_bytes * height length.
-    The packing follows the pattern used in test_printer.py: for each row, left-to-right, accumulate bits and append bytes.
+    """Pack a monochrome PIL image (mode '1' or 'L') into raw TSPL BITMAP bytes
+    (width_bytes * height long) with the shared encoder in pharmacy.raster:
+    0 bits print, 1 bits and row padding stay blank.
     """
     if im.mode != '1':
-        mono = im.convert('1')
-    else:
-        mono = im
-    pixels = mono.load()
-    w, h = mono.size
-    out = bytearray()
-    for y in range(h):
-        byte = 0
-        count = 0
-        for x in range(w):
-            # In '1' mode, pixel is 0 or 255 (0 black). Mirror test_printer logic: append 0 for black, 1 for white.
-            val = 0 if pixels[x, y] == 0 else 1
-            byte = (byte << 1) | (0 if val == 0 else 1)
-            count += 1
-            if count == 8:
-                out.append(byte)
-                byte = 0
-                count = 0
-        if count > 0:
-            byte = byte << (8 - count)
-            out.append(byte)
-    return bytes(out)
+        im = im.convert('1')
+    return pack_bitmap(im)[2]
 
 
 def shape_arabic(text):
@@ -12,4 +12,5 @@ urlpatterns = [
     path('inventory-cost/', views.inventory_cost, name='inventory_cost'),
     path('inventory-cost/export/', views.inventory_cost_export, name='inventory_cost_export'),
     path('inventory-summary/', views.inventory_summary, name='inventory_summary'),
+    path('inventory-history/', views.inventory_history, name='inventory_history'),
 ]
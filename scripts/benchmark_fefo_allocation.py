@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Benchmark the FEFO lot allocator (pharmacy.stock_allocation.LotBook).
+
+Usage (PowerShell):
+    .\\venv\\Scripts\\python.exe scripts\\benchmark_fefo_allocation.py [--lots 48] [--lines 15]
+
+Builds medicines with many expiration batches entirely in memory (no
+database writes) and times how long it takes to allocate a cart whose lines
+each span several of those batches.
+"""
+import os
+import sys
+import argparse
+import pathlib
+import time
+from datetime import timedelta
+
+# Ensure project root is on sys.path so `Elesraa` package can be imported
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+# Setup Django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Elesraa.settings')
+import django
+django.setup()
+
+from django.utils import timezone
+from pharmacy.models import Medicine, StockEntry
+from pharmacy.stock_allocation import LotBook
+
+
+def build_entries(medicines, lots):
+    today = timezone.now().date()
+    entries = []
+    next_id = 1
+    for m in medicines:
+        for day in range(lots):
+            entry = StockEntry(
+                id=next_id,
+                medicine=m,
+                quantity=2,
+                strips_remaining=2 * m.strips_per_box,
+                expiration_date=today + timedelta(days=30 + day),
+            )
+            entries.append(entry)
+            next_id += 1
+    return entries
+
+
+def run(lots, lines, rounds):
+    medicines = [
+        Medicine(id=i + 1, name=f'Bench {i}', price=10, purchase_price=5, strips_per_box=3)
+        for i in range(lines)
+    ]
+    best = None
+    for _ in range(rounds):
+        book = LotBook(build_entries(medicines, lots))
+        start = time.perf_counter()
+        for m in medicines:
+            # Each line needs most of the medicine's lots: boxes then strips
+            book.take(m.id, 'BOX', lots)
+            book.take(m.id, 'STRIP', lots)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark FEFO lot splitting')
+    p.add_argument('--lots', type=int, default=48, help='Expiration batches per medicine')
+    p.add_argument('--lines', type=int, default=15, help='Cart lines (one medicine each)')
+    p.add_argument('--rounds', type=int, default=20, help='Repetitions; best time is reported')
+    args = p.parse_args()
+
+    best = run(args.lots, args.lines, args.rounds)
+    print(f'{args.lines} lines x {args.lots} lots: {best * 1000:.2f} ms per cart '
+          f'({best / (args.lines * 2) * 1e6:.1f} us per allocation)')
+
+
+if __name__ == '__main__':
+    main()
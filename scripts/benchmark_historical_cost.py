@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Benchmark historical-cost profit (pharmacy.historical_cost).
+
+Usage (PowerShell):
+    .\\venv\\Scripts\\python.exe scripts\\benchmark_historical_cost.py [--lines 7500] [--medicines 1500]
+
+Creates a throwaway test database with a year of purchases and --lines
+sale lines (sales_2025_hist.csv has about 7,500), then totals sales and
+historical profit twice:
+
+* the loop the reports used, with a PurchaseItem query per new
+  (medicine, day);
+* sale_lines().
+
+Exits non-zero if the two disagree on the totals (to the cent).
+"""
+import os
+import sys
+import argparse
+import pathlib
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+# Ensure project root is on sys.path so `Elesraa` package can be imported
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+# Setup Django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Elesraa.settings')
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import setup_test_environment
+from django.utils import timezone
+from pharmacy.historical_cost import sale_lines
+from pharmacy.models import Medicine, Purchase, PurchaseItem, Sale, SaleItem, Supplier
+
+
+def populate(lines, medicine_count, purchases):
+    rng = random.Random(2025)
+    now = timezone.now()
+    user = User.objects.create_user(username='bench')
+    supplier = Supplier.objects.create(name='Bench', contact_person='', phone='0', email='b@example.com', address='')
+    Medicine.objects.bulk_create([
+        Medicine(name=f'Bench {i:05d}', description='', price=Decimal(20 + i % 40), purchase_price=Decimal(12 + i % 25),
+                 category='OTC', barcode_number=f'{i:012d}', strips_per_box=1 + i % 4)
+        for i in range(medicine_count)
+    ], batch_size=2000)
+    medicine_ids = list(Medicine.objects.values_list('id', flat=True))
+
+    Purchase.objects.bulk_create([
+        Purchase(supplier=supplier, invoice_number=f'B-{i}', created_by=user, status='RECEIVED')
+        for i in range(purchases)
+    ])
+    orders = list(Purchase.objects.all())
+    for i, order in enumerate(orders):
+        order.date = now - timedelta(days=365 - i * 365 // purchases)
+    Purchase.objects.bulk_update(orders, ['date'])
+    PurchaseItem.objects.bulk_create([
+        PurchaseItem(purchase=order, medicine_id=medicine_id, quantity=10, price=Decimal(10 + rng.randrange(20)),
+                     expiry_date=now.date() + timedelta(days=400))
+        for order in orders for medicine_id in rng.sample(medicine_ids, min(len(medicine_ids), 200))
+    ], batch_size=2000)
+
+    sales = [Sale(user=user, is_completed=True) for _ in range(lines // 3)]
+    Sale.objects.bulk_create(sales, batch_size=2000)
+    sales = list(Sale.objects.all())
+    for i, sale in enumerate(sales):
+        sale.created_at = now - timedelta(days=365, minutes=-i * 365 * 24 * 60 // len(sales))
+    Sale.objects.bulk_update(sales, ['created_at'], batch_size=2000)
+    SaleItem.objects.bulk_create([
+        SaleItem(sale=sales[i % len(sales)], medicine_id=rng.choice(medicine_ids), quantity=1 + rng.randrange(3),
+                 price=Decimal(25 + rng.randrange(20)), expiry_date=now.date() + timedelta(days=400),
+                 unit_type=rng.choice(['BOX', 'STRIP']))
+        for i in range(lines)
+    ], batch_size=2000)
+
+
+def legacy_loop():
+    """The reports' loop, with its PurchaseItem query per (medicine, day)."""
+    total_sold = total_profit = Decimal('0')
+    purchase_cache = {}
+    items = SaleItem.objects.select_related('sale', 'medicine').filter(sale__is_completed=True)
+    for it in items.iterator():
+        total_sold += Decimal(str(it.subtotal))
+        day = timezone.localtime(it.sale.created_at).date()
+        key = (it.medicine_id, day)
+        if key not in purchase_cache:
+            pi = PurchaseItem.objects.filter(medicine=it.medicine, purchase__date__date__lte=day).order_by(
+                '-purchase__date', '-id').first()
+            purchase_cache[key] = Decimal(str(pi.price)) if pi else Decimal(str(it.medicine.purchase_price or 0))
+        hist_price = purchase_cache[key]
+        unit_cost = hist_price / Decimal(it.medicine.strips_per_box or 1) if it.unit_type == 'STRIP' else hist_price
+        total_profit += (Decimal(str(it.price)) - unit_cost) * Decimal(it.quantity)
+    return total_sold, total_profit
+
+
+def engine():
+    total_sold = total_profit = Decimal('0')
+    for line in sale_lines():
+        total_sold += line.subtotal
+        total_profit += line.profit
+    return total_sold, total_profit
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark historical-cost profit')
+    p.add_argument('--lines', type=int, default=7500, help='Sale lines to create')
+    p.add_argument('--medicines', type=int, default=1500, help='Medicines to create')
+    p.add_argument('--purchases', type=int, default=100, help='Purchase orders over the year (200 lines each)')
+    args = p.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        start = time.perf_counter()
+        populate(args.lines, args.medicines, args.purchases)
+        print(f'{args.lines} sale lines, {args.purchases} purchases created in {time.perf_counter() - start:.1f} s')
+
+        legacy, legacy_totals = timed(legacy_loop)
+        fast, fast_totals = timed(engine)
+        print(f'per-day queries: {legacy:.2f} s')
+        print(f'sale_lines:      {fast:.2f} s ({legacy / fast:.0f}x)')
+        print(f'sold {fast_totals[0]:.2f}, profit {fast_totals[1]:.2f}')
+        if [f'{v:.2f}' for v in legacy_totals] != [f'{v:.2f}' for v in fast_totals]:
+            print(f'MISMATCH: legacy loop gives sold {legacy_totals[0]:.2f}, profit {legacy_totals[1]:.2f}')
+            sys.exit(1)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""Benchmark inventory valuation (pharmacy.inventory_valuation).
+
+Usage (PowerShell):
+    .\\venv\\Scripts\\python.exe scripts\\benchmark_inventory_valuation.py [--medicines 50000] [--lots 2]
+
+Creates a throwaway test database with --medicines medicines and --lots
+expiration batches each, then values the whole inventory three ways:
+
+* the per-medicine loop the reports used before the stock counters (a SUM
+  query for the boxes plus a query over the lots for the strips), timed on
+  --legacy-sample medicines and scaled up;
+* the same loop over Medicine instances reading the counters;
+* valued_medicines().
+
+Exits non-zero if the last two disagree on the totals (to the cent).
+"""
+import os
+import sys
+import argparse
+import pathlib
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+# Ensure project root is on sys.path so `Elesraa` package can be imported
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+# Setup Django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Elesraa.settings')
+import django
+django.setup()
+
+from django.db import connection
+from django.db.models import Sum
+from django.test.utils import setup_test_environment
+from django.utils import timezone
+from pharmacy.inventory_valuation import InventoryTotals, valued_medicines
+from pharmacy.models import Medicine, StockEntry
+
+
+def populate(count, lots):
+    today = timezone.now().date()
+    medicines = []
+    for i in range(count):
+        strips_per_box = 1 + i % 4
+        boxes = (i % 7) * lots
+        medicines.append(Medicine(
+            name=f'Bench {i:06d}', description='', price=Decimal(10 + i % 50), purchase_price=Decimal(6 + i % 30),
+            category='OTC', barcode_number=f'{i:012d}', strips_per_box=strips_per_box,
+            stock=boxes, strips_available=boxes * strips_per_box + (i % strips_per_box),
+            nearest_expiry=today + timedelta(days=30) if boxes else None,
+        ))
+    Medicine.objects.bulk_create(medicines, batch_size=2000)
+    entries = []
+    for m in Medicine.objects.only('id', 'stock', 'strips_available', 'strips_per_box').iterator(chunk_size=2000):
+        for lot in range(lots):
+            quantity = m.stock // lots
+            extra = m.strips_available - m.stock * m.strips_per_box if lot == 0 else 0
+            entries.append(StockEntry(
+                medicine_id=m.id, quantity=quantity, strips_remaining=quantity * m.strips_per_box + extra,
+                expiration_date=today + timedelta(days=30 + lot),
+            ))
+    StockEntry.objects.bulk_create(entries, batch_size=2000)
+
+
+def legacy_loop(medicines):
+    """The valuation loop with the per-medicine lot queries it used to run."""
+    today = timezone.now().date()
+    selling = cost = Decimal('0')
+    for m in medicines:
+        lots = StockEntry.objects.filter(medicine=m, expiration_date__gte=today)
+        box_qty = lots.aggregate(total=Sum('quantity'))['total'] or 0
+        total_strips = sum(
+            e.strips_remaining if e.strips_remaining is not None else e.quantity * m.strips_per_box
+            for e in lots
+        )
+        strips_per_box = m.strips_per_box or 1
+        strip_qty = max(0, total_strips - box_qty * strips_per_box)
+        box_price = Decimal(m.price or 0)
+        box_purchase = Decimal(m.purchase_price or 0)
+        strip_price = Decimal(m.get_strip_price() or box_price)
+        strip_purchase = box_purchase / Decimal(strips_per_box)
+        selling += box_price * box_qty + strip_price * strip_qty
+        cost += box_purchase * box_qty + strip_purchase * strip_qty
+    return selling, cost
+
+
+def instance_loop():
+    """The same loop over Medicine instances, reading the stock counters."""
+    selling = cost = Decimal('0')
+    for m in Medicine.objects.filter(is_active=True).order_by('name'):
+        box_qty = int(m.stock or 0)
+        strips_per_box = m.strips_per_box or 1
+        strip_qty = max(0, int(m.strips_in_stock or 0) - box_qty * strips_per_box)
+        box_price = Decimal(m.price or 0)
+        box_purchase = Decimal(m.purchase_price or 0)
+        strip_price = Decimal(m.get_strip_price() or box_price)
+        strip_purchase = box_purchase / Decimal(strips_per_box)
+        selling += box_price * box_qty + strip_price * strip_qty
+        cost += box_purchase * box_qty + strip_purchase * strip_qty
+    return selling, cost
+
+
+def engine():
+    totals = InventoryTotals()
+    for row in valued_medicines():
+        totals.add(row)
+    return totals.selling, totals.cost
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark inventory valuation')
+    p.add_argument('--medicines', type=int, default=50000, help='Medicines to create')
+    p.add_argument('--lots', type=int, default=2, help='Expiration batches per medicine')
+    p.add_argument('--legacy-sample', type=int, default=2000, help='Medicines to time the per-medicine query loop on')
+    args = p.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        start = time.perf_counter()
+        populate(args.medicines, args.lots)
+        print(f'{args.medicines} medicines x {args.lots} lots created in {time.perf_counter() - start:.1f} s')
+
+        sample = list(Medicine.objects.order_by('name')[:args.legacy_sample])
+        legacy, _ = timed(legacy_loop, sample)
+        legacy *= args.medicines / max(1, len(sample))
+        loop, loop_totals = timed(instance_loop)
+        fast, fast_totals = timed(engine)
+
+        print(f'per-medicine queries: {legacy:.2f} s (scaled from {len(sample)})')
+        print(f'instance loop:        {loop:.2f} s')
+        print(f'valued_medicines:     {fast:.2f} s ({legacy / fast:.0f}x / {loop / fast:.1f}x)')
+        print(f'selling {fast_totals[0]:.2f}, cost {fast_totals[1]:.2f}')
+        # Both print to the cent; the Decimal digits beyond that depend on the summing order
+        if [f'{v:.2f}' for v in loop_totals] != [f'{v:.2f}' for v in fast_totals]:
+            print(f'MISMATCH: instance loop gives selling {loop_totals[0]:.2f}, cost {loop_totals[1]:.2f}')
+            sys.exit(1)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""Benchmark the 1-bit TSPL bitmap encoder (pharmacy.raster.pack_bitmap).
+
+Usage (PowerShell):
+    .\\venv\\Scripts\\python.exe scripts\\benchmark_raster_packing.py [--items 30] [--min-speedup 50]
+
+Renders a real receipt (pharmacy.receipts.render_invoice_image) plus a few
+label-sized images, packs each with the per-pixel loop print_invoice_thermal
+used to run and with pack_bitmap(), checks the bytes are identical and
+reports the speedup. Exits non-zero if the outputs differ or the receipt
+speedup is below --min-speedup.
+"""
+import os
+import sys
+import argparse
+import pathlib
+import random
+import time
+
+# Ensure project root is on sys.path so `Elesraa` package can be imported
+BASE_DIR = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
+
+# Setup Django
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Elesraa.settings')
+import django
+django.setup()
+
+from PIL import Image, ImageDraw
+from pharmacy.raster import pack_bitmap
+from pharmacy.receipts import render_invoice_image
+
+
+def pack_bitmap_loop(image):
+    """The original per-pixel packing loop from print_invoice_thermal."""
+    width_px, height_px = image.size
+    bytes_per_row = (width_px + 7) // 8
+    pixels = image.load()
+    bitmap_data = bytearray(bytes_per_row * height_px)
+    for y in range(height_px):
+        row_offset = y * bytes_per_row
+        byte = 0
+        bit_count = 0
+        col = 0
+        for x in range(width_px):
+            bit = 0 if pixels[x, y] < 128 else 1  # 0 = printed (black), 1 = blank
+            byte = (byte << 1) | bit
+            bit_count += 1
+            if bit_count == 8:
+                bitmap_data[row_offset + col] = byte
+                col += 1
+                byte = 0
+                bit_count = 0
+        if bit_count:
+            pad = 8 - bit_count
+            bitmap_data[row_offset + col] = (byte << pad) | ((1 << pad) - 1)  # pad with blank
+    return bytes(bitmap_data)
+
+
+def sample_receipt(items):
+    return {
+        'id': 12345,
+        'created_at': '2025-01-01 12:00:00',
+        'customer': 'عميل تجريبي',
+        'items': [
+            {'name': f'دواء تجريبي رقم {i}', 'quantity': 1 + i % 3, 'unit_type': 'علبة',
+             'price': 12.5 + i, 'total': (12.5 + i) * (1 + i % 3)}
+            for i in range(items)
+        ],
+        'original_total': 1000.0,
+        'discount_amount': 25.0,
+        'total': 975.0,
+        'cash_given': 1000.0,
+        'change_return': 25.0,
+    }
+
+
+def sample_labels():
+    rnd = random.Random(7)
+    labels = []
+    for width, height in ((319, 199), (320, 200), (385, 97)):
+        noise = Image.frombytes('L', (width, height), bytes(rnd.randrange(256) for _ in range(width * height)))
+        labels.append(noise)
+        drawn = Image.new('1', (width, height), 1)
+        ImageDraw.Draw(drawn).rectangle((5, 5, width - 3, height // 2), fill=0)
+        labels.append(drawn)
+    return labels
+
+
+def best_time(func, image, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(image)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark 1-bit TSPL bitmap packing')
+    p.add_argument('--items', type=int, default=30, help='Receipt lines')
+    p.add_argument('--rounds', type=int, default=5, help='Repetitions; best time is reported')
+    p.add_argument('--min-speedup', type=float, default=50, help='Fail below this receipt speedup')
+    args = p.parse_args()
+
+    ok = True
+    for image in sample_labels():
+        reference = pack_bitmap_loop(image.convert('L'))
+        if pack_bitmap(image)[2] != reference:
+            print(f'MISMATCH on {image.mode} {image.size[0]}x{image.size[1]} label')
+            ok = False
+
+    receipt = render_invoice_image(sample_receipt(args.items))
+    if pack_bitmap(receipt)[2] != pack_bitmap_loop(receipt):
+        print('MISMATCH on receipt')
+        ok = False
+
+    loop = best_time(pack_bitmap_loop, receipt, max(1, args.rounds // 2))
+    fast = best_time(pack_bitmap, receipt, args.rounds * 10)
+    speedup = loop / fast
+    print(f'receipt {receipt.size[0]}x{receipt.size[1]} px ({args.items} items): '
+          f'loop {loop * 1000:.1f} ms, pack_bitmap {fast * 1000:.2f} ms, {speedup:.0f}x'
+          f'{"" if ok else " (OUTPUT DIFFERS)"}')
+    if not ok or speedup < args.min_speedup:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
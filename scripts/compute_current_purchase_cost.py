@@ -22,53 +22,26 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Elesraa.settings')
 import django
 django.setup()
 
-from pharmacy.models import Medicine
-from django.utils import timezone
+from pharmacy.inventory_valuation import valued_medicines
 import csv
 
 
 def compute(write_csv_path=None):
     total_cost = Decimal('0')
     rows = []
-    now = timezone.now()
-
-    for m in Medicine.objects.filter(is_active=True).order_by('name'):
-        try:
-            box_qty = int(m.calculate_available_stock() or 0)
-        except Exception:
-            box_qty = int(m.stock or 0)
-
-        # Compute strips not already counted as full boxes
-        try:
-            total_strips = int(m.strips_in_stock or 0)
-        except Exception:
-            strips_per_box = m.strips_per_box or 1
-            total_strips = box_qty * strips_per_box if box_qty else 0
-        strips_per_box = m.strips_per_box or 1
-        strip_qty = total_strips - (box_qty * strips_per_box)
-        if strip_qty < 0:
-            strip_qty = 0
-
-        box_purchase = Decimal(m.purchase_price or 0)
-        strips_per_box = m.strips_per_box or 1
-        strip_purchase = (box_purchase / Decimal(strips_per_box)) if strips_per_box else Decimal('0')
-
-        cost_box = box_purchase * Decimal(box_qty)
-        cost_strip = strip_purchase * Decimal(strip_qty)
-        cost_total = cost_box + cost_strip
-
-        total_cost += cost_total
 
+    for m in valued_medicines():
+        total_cost += m.cost
         rows.append({
             'id': m.id,
             'name': m.name,
-            'box_qty': box_qty,
-            'strip_qty': strip_qty,
-            'box_purchase': f"{box_purchase:.2f}",
-            'strip_purchase': f"{strip_purchase:.2f}",
-            'cost_box': f"{cost_box:.2f}",
-            'cost_strip': f"{cost_strip:.2f}",
-            'cost_total': f"{cost_total:.2f}",
+            'box_qty': m.boxes,
+            'strip_qty': m.strips,
+            'box_purchase': f"{m.box_purchase:.2f}",
+            'strip_purchase': f"{m.strip_purchase:.2f}",
+            'cost_box': f"{m.cost_box:.2f}",
+            'cost_strip': f"{m.cost_strip:.2f}",
+            'cost_total': f"{m.cost:.2f}",
         })
 
     if write_csv_path: